@@ -11,14 +11,22 @@ from ib_insync import *
 sys.path.append(r'/home/adam/ib')
 from market import backtest
 from market import bars
+from market import cache
 from market import config
 from market import connect
 from market import contract
 from market import data
 from market import detector
 from market import fatal
+from market import fills
+from market import indicators
+from market import npbacktest
 from market import order
 from market import rand 
+from market import results
+from market import search
+from market import sweep
+from market import walkforward
 
 import argparse
 parser = argparse.ArgumentParser()
@@ -27,8 +35,25 @@ parser.add_argument('--debug', action='store_true', default=None)
 parser.add_argument('--info', action='store_true', default=None)
 parser.add_argument('--error', action='store_true', default=None)
 parser.add_argument('--conf', type=str, required=True)
+parser.add_argument('--vectorized', action='store_true', default=None) # Crossover only, see market/npbacktest.py
+parser.add_argument('--parity', action='store_true', default=None) # run both engines and compare
+parser.add_argument('--workers', default=None, type=int) # run the sweep on a process pool
+parser.add_argument('--intrabar', action='store_true', default=None) # settle ambiguous bars with cached 5 sec bars
+parser.add_argument('--walkForward', action='store_true', default=None) # optimize in-sample, evaluate out-of-sample, Crossover only
+parser.add_argument('--inSample', default=24, type=float) # hours per walk-forward window
+parser.add_argument('--outOfSample', default=6, type=float)
+parser.add_argument('--step', default=None, type=float) # hours between windows, defaults to --outOfSample
+parser.add_argument('--search', action='store_true', default=None) # successive halving instead of the full grid, Crossover only
+parser.add_argument('--rungs', default=4, type=int) # history lengths the search goes through
+parser.add_argument('--eta', default=3, type=int) # 1/eta of each rung goes on to the next
+parser.add_argument('--sample', default=None, type=int) # combinations at the first rung
 
-parser.add_argument("--duration", default=2, type=int)
+parser.add_argument('--cacheDir', default=cache.defaultDir, type=str)
+parser.add_argument('--noCache', action='store_true', default=None)
+parser.add_argument('--offline', action='store_true', default=None) # backtest from the cache without a gateway
+parser.add_argument('--results', default=results.defaultPath, type=str) # sqlite file the sweep is recorded in
+parser.add_argument('--noResults', action='store_true', default=None)
+parser.add_argument("--duration", default=2, type=int) # hours of bars before --endDate, plus the long interval
 parser.add_argument("--endDate", default='', type=str)
 
 parser.add_argument('--shortEMA', default=15, type=int)
@@ -44,51 +69,128 @@ def modTotals(totals):
     return totals
 
 conf = config.getConfig(args.conf, detectorOn=True)
-ibc = connect.connect(conf, args.debug)
+ibc = None
+if not args.offline:
+    ibc = connect.connect(conf, args.debug)
 if args.info:
     util.logToConsole(logging.INFO)
 if args.error:
     util.logToConsole(logging.ERROR)
 conf = config.overrideConfig(conf, args.profitTarget, args.stopTarget, args.shortEMA, args.longEMA, args.watchCount)
 
-wc = contract.wContract(ibc, conf.symbol, conf.localSymbol)
-
 useRth = False if conf.enterOutsideRth else True
-backtestArgs = {'watchCount': args.watchCount, 'shortInterval': args.shortEMA, 'longInterval': args.longEMA, 'e': args.endDate, 'd': args.duration, 't': 'MIDPOINT', 'r': useRth, 'f': 2, 'k': False}
+cacheDir = None if args.noCache else args.cacheDir
+if args.offline:
+    wc = cache.backtestContract(cacheDir, conf.localSymbol, conf.barSizeStr, data.barSizeToDuration[conf.barSizeStr]['value'], 'MIDPOINT', useRth)
+    if wc is None:
+        fatal.errorAndExit('nothing cached for {} in {}'.format(conf.localSymbol, cacheDir))
+else:
+    wc = contract.wContract(ibc, conf.symbol, conf.localSymbol)
+
+backtestArgs = {'watchCount': args.watchCount, 'shortInterval': args.shortEMA, 'longInterval': args.longEMA, 'e': args.endDate, 'd': args.duration, 't': 'MIDPOINT', 'r': useRth, 'f': 2, 'k': False, 'c': cacheDir}
 dataStore, dataStream = detector.setupData(wc, conf, backtestArgs)
 
 if conf.detector == 'threeBarPattern':
     dataStream = backtest.anotateBars(dataStream)
 
+resolver, dates = None, None
+if args.intrabar:
+    if cacheDir is None:
+        fatal.errorAndExit('intrabar fills need the bar cache')
+    # fill the cache with the 5 sec bars over the same period, only missing bars are fetched
+    data.getHistData(wc, barSizeStr='5 secs', longInterval=0, e=args.endDate, d=args.duration, t='MIDPOINT', r=useRth, c=cacheDir)
+    resolver = fills.fromCache(cacheDir, conf.localSymbol, 'MIDPOINT', useRth, data.barSizeToDuration[conf.barSizeStr]['value'])
+    dates = fills.toDates(dataStream)
+
+emaCache = None
+if conf.detector == 'Crossover':
+    highs, lows, closes = npbacktest.toArrays(dataStream)
+    emaCache = indicators.EMACache(closes) # ema series are shared by all the combinations
+
+def runBacktest(dataStore, sI, lI, w, p):
+    if args.vectorized and not args.parity:
+        return npbacktest.backtest(wc, conf, highs, lows, closes, sI, lI, w, dataStore.byPeriod, emaCache, resolver, dates)
+    totals = backtest.backtest(wc, dataStream, dataStore, conf, p, resolver)
+    if args.parity:
+        vTotals = npbacktest.backtest(wc, conf, highs, lows, closes, sI, lI, w, dataStore.byPeriod, emaCache, resolver, dates)
+        if not npbacktest.sameTotals(totals, vTotals):
+            logging.error('engines disagree for lI:{}, sI:{}, w:{}, sT:{}, pT:{}: loop {} vectorized {}'.format(lI, sI, w, conf.stopTarget, conf.profitTarget, totals, vTotals))
+    return totals
+
 if args.single:
-    totals = backtest.backtest(wc, dataStream, dataStore, conf)
+    if conf.detector == 'Crossover':
+        totals = runBacktest(dataStore, args.shortEMA, args.longEMA, args.watchCount, None)
+    else:
+        totals = backtest.backtest(wc, dataStream, dataStore, conf, None, resolver)
     print(modTotals(totals))
     sys.exit(0)
-#for p in [1, 5, 10, 14, 30, 60]:
-for p in [1]:#, 2, 4, 8]:
-    for lI in [5, 10, 15, 20, 30, 40, 60, 120, 200]:
-    #for lI in [20]:
-        for sI in [2, 5, 10, 15, 20, 25, 30, 50]:
-            if sI > lI:
-                continue
-            for w in [2, 3, 5, 7, 15, 30]:
-                for sT in [0.5, 1, 1.5, 2, 3]:#, 1.5, 2, 2.5, 3, 4, 5, 6, 7]:
-                #for sT in [2]:
-                    for pT in [0.5, 1, 1.5, 2]:#, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 15, 20, 30]:
-                        ID = 'lI:'+str(lI)+', sI:'+str(sI)+', w:'+str(w)+', sT:'+str(sT)+', pT:'+str(pT)+', pD:'+str(p)
-                        #logging.error('running %s', ID)
-                        conf.profitTarget = pT
-                        conf.stopTarget = sT
-                        if conf.detector == 'Crossover':
-                            dataStore = detector.Crossover(conf.barSizeStr, wc, sI, lI, w)
-                            dataStore.backTest = True
-                            dataStore.byPeriod = p
-                            dataStore.initIndicators(dataStream)
-                        totals = modTotals( backtest.backtest(wc, dataStream, dataStore, conf, p) )
-                        r = totals['gl']/totals['mf']*100 if totals['mf'] > 0 else 0
-                        if totals['gl'] > 0:
-                            er = int(totals['gl']/totals['op'])
-                            logging.error(str(ID)+'; gl:'+str(totals['gl'])+', op:'+str(totals['op'])+', er:'+str(er) +', lo:'+str(totals['lo']))
+store, run = None, None
+if not args.noResults and not args.walkForward:
+    store = results.Store(args.results)
+    run = store.newRun(conf.symbol, conf.localSymbol, conf.detector, args.endDate, args.duration)
+
+def report(combination, totals):
+    if store is not None:
+        store.add(run, combination, totals)
+    p, lI, sI, w, sT, pT = combination
+    ID = 'lI:'+str(lI)+', sI:'+str(sI)+', w:'+str(w)+', sT:'+str(sT)+', pT:'+str(pT)+', pD:'+str(p)
+    r = totals['gl']/totals['mf']*100 if totals['mf'] > 0 else 0
+    if totals['gl'] > 0:
+        er = int(totals['gl']/totals['op'])
+        logging.error(str(ID)+'; gl:'+str(totals['gl'])+', op:'+str(totals['op'])+', er:'+str(er) +', lo:'+str(totals['lo']))
+
+grid = search.Grid(
+    [5, 10, 15, 20, 30, 40, 60, 120, 200],
+    [2, 5, 10, 15, 20, 25, 30, 50],
+    [2, 3, 5, 7, 15, 30],
+    [0.5, 1, 1.5, 2, 3], #, 1.5, 2, 2.5, 3, 4, 5, 6, 7]
+    [0.5, 1, 1.5, 2]) #, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 15, 20, 30]
+combinations = sweep.combinations(
+    [1], # [1, 2, 4, 8] [1, 5, 10, 14, 30, 60]
+    *grid.values)
+
+def runCombination(combination):
+    p, lI, sI, w, sT, pT = combination
+    conf.profitTarget = pT
+    conf.stopTarget = sT
+    if conf.detector == 'Crossover':
+        dataStore = detector.Crossover(conf.barSizeStr, wc, sI, lI, w)
+        dataStore.backTest = True
+        dataStore.byPeriod = p
+        if not args.parity: # the loop calculates its own emas when checking parity
+            dataStore.emaCache = emaCache
+        if not args.vectorized or args.parity:
+            dataStore.initIndicators(dataStream)
+        return modTotals( runBacktest(dataStore, sI, lI, w, p) )
+    return modTotals( backtest.backtest(wc, dataStream, None, conf, p, resolver) )
+
+# [(combination, totals)] for a list of combinations, reported as they are run
+def runCombinations(combinations):
+    if args.workers:
+        running = ((c, modTotals(t)) for c, t in sweep.sweep(wc, conf, dataStream, combinations, args.workers, args.vectorized, resolver))
+    else:
+        running = ((c, runCombination(c)) for c in combinations)
+    ran = []
+    for combination, totals in running:
+        report(combination, totals)
+        ran.append((combination, totals))
+    return ran
+
+if args.walkForward:
+    windows, totals = walkforward.walkForward(wc, conf, dataStream, combinations, args.inSample, args.outOfSample, args.step, args.workers, resolver)
+    for w in windows:
+        logging.error('bars {}-{}-{}; lI:{}, sI:{}, w:{}, sT:{}, pT:{}; in:{}; out:{}'.format(w.first, w.split, w.stop, *w.best[1:], modTotals(w.inSample), modTotals(w.outOfSample)))
+    print('out-of-sample over {} windows: {}'.format(len(windows), modTotals(totals)))
+elif args.search:
+    if conf.detector != 'Crossover':
+        fatal.errorAndExit('the search only runs the Crossover')
+    hours = len(dataStream) *data.barSizeToDuration[conf.barSizeStr]['value'] /60/60
+    ranked, evaluations = search.successiveHalving(runCombinations, grid, search.rungPeriods(hours, args.rungs, args.eta), args.sample, args.eta)
+    print('ran {} backtests, a full grid is {}'.format(evaluations, len(grid.points())))
+    for combination, totals in ranked[:30]:
+        print('lI:{}, sI:{}, w:{}, sT:{}, pT:{}; {}'.format(*combination[1:], totals))
+else:
+    runCombinations(list(combinations))
 
 #backtest.backtest(wc, dataStream, dataStore, conf)
 ## are any positions left open?
@@ -96,6 +198,10 @@ for p in [1]:#, 2, 4, 8]:
 ##lastClose = dataStream[len(dataStream)-1].close
 ##for position in positions:
 #    #totals['gl'] += lastClose - position.entryOrder.lmtPrice   
-connect.close(ibc)
+if store is not None:
+    store.summarize(run)
+    store.close()
+if ibc is not None:
+    connect.close(ibc)
 
 sys.exit(0)
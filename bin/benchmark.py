@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+import logging
+import sys
+
+sys.path.append(r'/home/adam/ib')
+from market import bench
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--bars', default=100000, type=int) # length of the synthetic series
+parser.add_argument('--combinations', default=20, type=int) # per case
+parser.add_argument('--seed', default=1, type=int)
+parser.add_argument('--case', action='append', default=None, choices=bench.cases) # defaults to all of them
+parser.add_argument('--benchDir', default=bench.defaultDir, type=str) # where runs are saved
+parser.add_argument('--noSave', action='store_true', default=None)
+parser.add_argument('--compare', default=None, type=str) # a saved run, defaults to the newest one
+parser.add_argument('--threshold', default=0.1, type=float) # fraction worse that counts as a regression
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.ERROR)
+
+before = args.compare if args.compare is not None else bench.latest(args.benchDir)
+result = bench.run(args.bars, args.combinations, args.seed, args.case or bench.cases)
+for case, r in result['cases'].items():
+    print('{}: {:.0f} bars/s, latency mean {:.4f}s p50 {:.4f}s p95 {:.4f}s, setup {:.4f}s, peak memory {:.1f}MB'.format(
+        case, r['barsPerSecond'], r['latency']['mean'], r['latency']['p50'], r['latency']['p95'], r['setupSeconds'], r['peakMemory']/1e6))
+if not args.noSave:
+    print('saved as', bench.save(result, args.benchDir))
+regressed = False
+if before is not None:
+    print('compared with', before)
+    for line in bench.compare(bench.load(before), result, args.threshold):
+        regressed = regressed or line.endswith('REGRESSION')
+        print(line)
+sys.exit(1 if regressed else 0)
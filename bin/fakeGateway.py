@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+import logging
+import signal
+import sys
+
+sys.path.append(r'/home/adam/ib')
+from market import gateway
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', default=gateway.defaultPort, type=int)
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--rate', default=0.2, type=float) # realtime bars streamed per second, 0.2 is the real pace
+parser.add_argument('--account', action='append', default=None) # managed accounts, defaults to one
+parser.add_argument('--funds', default=1000000.0, type=float) # starting equity of each account
+parser.add_argument('--history', default=17280, type=int) # 5 second bars of history, a day by default
+parser.add_argument('--hours', default=24, type=float) # of synthetic bars to stream
+parser.add_argument('--journal', default=None, type=str) # feed contracts from their newest journal in this dir
+parser.add_argument('--seed', default=None, type=int)
+parser.add_argument('--info', action='store_true', default=None)
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.INFO if args.info else logging.WARN)
+
+def term(*args):
+    sys.exit(0)
+signal.signal(signal.SIGTERM, term)
+
+g = gateway.FakeGateway(args.port, args.rate, args.account, args.funds, args.history, args.hours, args.journal, args.seed)
+g.run(args.host)
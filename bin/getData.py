@@ -14,7 +14,7 @@ def collector(t, ib):
         m = t.marketPrice()
         if m > d['high']:
             d['high'] = m
-        elif m < d['low']:
+        if m < d['low']:
             d['low'] = m
         ib.sleep(0.250)
     d['close'] = t.marketPrice()
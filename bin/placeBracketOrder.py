@@ -37,8 +37,7 @@ logging.warn('created an order for contract %s %s', wc.contract, orderDetails)
 orders = order.CreateBracketOrder(orderDetails, conf.account)
 
 if args.go is not None:
-    trades = trade.PlaceBracketTrade(orders, orderDetails, ibc)
-    trade.CheckTradeExecution(trades, orderDetails)
+    trades = trade.PlaceBracketTrade(orders, orderDetails, conf.fillTimeout)
 else:
     logging.warn('would place this order: %s', orders)
 
@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+from datetime import datetime, timezone
+import logging
+import sys
+
+sys.path.append(r'/home/adam/ib')
+from market import journal
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--journal', type=str, required=True) # a file written by bin/autoOrder
+parser.add_argument('--barSizeStr', default='1 min', type=str)
+parser.add_argument('--shortEMA', default=15, type=int)
+parser.add_argument('--longEMA', default=40, type=int)
+parser.add_argument('--watchCount', default=15, type=int)
+parser.add_argument('--info', action='store_true', default=None)
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.INFO if args.info else logging.ERROR)
+
+records = journal.read(args.journal)
+print('{} realtime bars in {}'.format(len(records), args.journal))
+for clock, entryAction, entryPrice in journal.replayCrossover(records, args.barSizeStr, args.shortEMA, args.longEMA, args.watchCount):
+    print('{} {} at {}'.format(datetime.fromtimestamp(clock, timezone.utc), entryAction, entryPrice))
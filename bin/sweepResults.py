@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+import logging
+import sys
+
+sys.path.append(r'/home/adam/ib')
+from market import results
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--results', default=results.defaultPath, type=str)
+parser.add_argument('--run', default=None, type=int) # defaults to the latest run
+parser.add_argument('--period', default=None, type=float)
+parser.add_argument('--metric', default='gl', type=str)
+parser.add_argument('--top', default=None, type=int)
+parser.add_argument('--where', default=None, type=str) # eg 'lI:40,sI:15,w:(5|15),sT.*'
+parser.add_argument('--stable', default=None, type=float) # growth multiplier every period must beat, see results.Store.stable
+parser.add_argument('--best', action='store_true', default=None)
+parser.add_argument('--importScriptOutput', default=None, type=str) # an old esData file
+args = parser.parse_args()
+
+def output(rows):
+    for r in rows:
+        print(', '.join('{}:{}'.format(k, r[k]) for k in r.keys()))
+
+store = results.Store(args.results)
+if args.importScriptOutput is not None:
+    print('imported as run', results.importScriptOutput(store, args.importScriptOutput))
+if args.top is not None:
+    output(store.top(args.top, args.run, args.period, args.metric))
+if args.where is not None:
+    output(store.where(args.where, args.run, args.metric))
+if args.stable is not None:
+    output(store.stable(args.stable, args.run))
+if args.best:
+    for mult, rows in store.best(run=args.run).items():
+        print('at multiplier ', mult)
+        output(rows)
+        print('')
+store.close()
@@ -1,3 +1,6 @@
+import logging
+import time
+
 from market import fatal
 
 def validate(aSum, account):
@@ -34,8 +37,117 @@ def valuesField(ibc, account, field, usd=None):
             return aVal[i][2]
     fatal.errorAndExit('problem: did not find {} in account values: {}'.format(field, aVal))
 
+# account values kept current from accountValueEvent, keyed by (account, tag, currency)
+# so a lookup is a dict read instead of a scan of accountValues.  ib resends a value when
+# it changes (and the whole account every few minutes).  a value not heard of in maxAge
+# seconds is used as is while the account's updates are re-requested without waiting, the
+# resent values land through update.  only a value never received waits on the request
+class AccountIndex:
+    ibc: object # ib_insync.IB
+    maxAge: float
+    values: dict # (account, tag, currency) to (value, epoch received)
+    requested: dict # account to epoch of the last re-request
+    refreshes: int = 0
+
+    def __init__(self, ibc, maxAge=600):
+        self.ibc = ibc
+        self.maxAge = maxAge
+        self.values = {}
+        self.requested = {}
+        now = time.time()
+        for v in ibc.accountValues():
+            self.values[(v.account, v.tag, v.currency)] = (v.value, now)
+        ibc.accountValueEvent += self.update
+
+    def __repr__(self):
+        return 'values:{},maxAge:{},refreshes:{}'.format(len(self.values), self.maxAge, self.refreshes)
+
+    # accountValueEvent handler
+    def update(self, v):
+        self.values[(v.account, v.tag, v.currency)] = (v.value, time.time())
+
+    # re-subscribe to the account's updates, at most once per maxAge, without waiting
+    def refresh(self, account):
+        now = time.time()
+        if now - self.requested.get(account, 0) < self.maxAge:
+            return
+        self.requested[account] = now
+        self.refreshes += 1
+        logging.warn('refreshing the account values of {}'.format(account))
+        self.ibc.client.reqAccountUpdates(True, account)
+
+    def field(self, account, tag, currency='USD'):
+        key = (account, tag, currency)
+        v = self.values.get(key)
+        if v is None:
+            # nothing to go on, wait for the account's values
+            self.refreshes += 1
+            logging.warn('waiting on the account values of {} for {} {}'.format(account, tag, currency))
+            self.ibc.reqAccountUpdates(account)
+            v = self.values.get(key)
+            if v is None:
+                fatal.errorAndExit('problem: did not find {} {} in account values of {}'.format(tag, currency, account))
+        elif time.time() - v[1] > self.maxAge:
+            self.refresh(account)
+        return v[0]
+
+# an AccountIndex per connection, made on first use
+indexes = {}
+def index(ibc):
+    i = indexes.get(ibc)
+    if i is None:
+        i = indexes[ibc] = AccountIndex(ibc)
+    return i
+
+# the portfolio by conId, kept current from updatePortfolioEvent so a symbol's position
+# is a dict read instead of a scan of portfolio() comparing contracts.  like the wrapper,
+# an item with no position is dropped
+class PortfolioIndex:
+    items: dict # conId to {account: PortfolioItem}
+
+    def __init__(self, ibc):
+        self.items = {}
+        for p in ibc.portfolio():
+            self.update(p)
+        ibc.updatePortfolioEvent += self.update
+
+    def __repr__(self):
+        return 'items:{}'.format(sum(len(i) for i in self.items.values()))
+
+    # updatePortfolioEvent handler
+    def update(self, p):
+        conId = p.contract.conId
+        if p.position == 0:
+            held = self.items.get(conId)
+            if held is not None:
+                held.pop(p.account, None)
+                if not held:
+                    del self.items[conId]
+        else:
+            self.items.setdefault(conId, {})[p.account] = p
+
+    # the PortfolioItem of conId in account, or in any account, None when not held
+    def item(self, conId, account=None):
+        held = self.items.get(conId)
+        if not held:
+            return None
+        if account is not None:
+            return held.get(account)
+        return next(iter(held.values()))
+
+    def position(self, conId, account=None):
+        p = self.item(conId, account)
+        return 0 if p is None else p.position
+
+portfolioIndexes = {}
+def portfolioIndex(ibc):
+    i = portfolioIndexes.get(ibc)
+    if i is None:
+        i = portfolioIndexes[ibc] = PortfolioIndex(ibc)
+    return i
+
 def availableFunds(ibc, account):
-    return float( valuesField(ibc, account, 'AvailableFunds', usd=True) )
+    return float( index(ibc).field(account, 'AvailableFunds') )
 
 def buyingPower(ibc, account):
-    return float( valuesField(ibc, account, 'BuyingPower', usd=True) )
+    return float( index(ibc).field(account, 'BuyingPower') )
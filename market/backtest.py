@@ -1,25 +1,19 @@
 import logging
-import re
+
+import numpy as np
 
 from market import bars
+from market import book
+from market import fills
 from market import order
+from market import ticks
 
+# returns a bars.barDtype record array, rows read like an anotated bars.Bar
 def anotateBars(histBars):
-    newBars = []
-    for i in range(0, len(histBars)):
-        newBars.append(makeBar(histBars[i]))
-        newBars[i].anotate()
+    newBars = bars.anotateArray(bars.toBarArray(histBars))
     logging.info('got %d bars', len(newBars))
     return newBars
 
-def makeBar(histBar):
-    bar = bars.Bar(0)
-    bar.open = histBar.open
-    bar.close = histBar.close
-    bar.high = histBar.high
-    bar.low = histBar.low
-    return bar
-
 def getNextBar(dataStream, index):
     return dataStream[index]
 
@@ -31,13 +25,17 @@ def setupThreeBar(dataStream, period):
     dataStore.third = getNextBar(dataStream, index+2)
     return index+3, dataStore
 
-def backtest(wc, dataStream, dataStore, conf, period):
+# resolver is a fills.IntrabarResolver to settle ambiguous bars with finer bars, optional
+def backtest(wc, dataStream, dataStore, conf, period, resolver=None):
     totals = {'gl': 0, 'tf': 0, 'mf': 0, 'op': 0, 'lo': 0}
-    positions = []
+    positions = book.PositionBook(wc.priceIncrement)
     startIndex = None
     # which data point in the dataStream/bar set to evaluate on this round about enter or not
     if conf.detector == 'threeBarPattern':
         startIndex, dataStore = setupThreeBar(dataStream, period)
+        signals = None
+        if isinstance(dataStream, np.recarray): # from anotateBars, scan it all at once
+            signals = bars.threeBarSignals(dataStream, conf.secondToFirst, conf.secondToThird)
     elif conf.detector == 'Crossover':
         # FIXME: might be a bug here
         # we just stored (at init) the last EMA calculated, eg we are examining curClosePriceIndex
@@ -46,12 +44,17 @@ def backtest(wc, dataStream, dataStore, conf, period):
     for i in range(startIndex, len(dataStream)-1):
         # first, see if any positions changed
         logging.info('number of positions open: {}'.format(len(positions)))
-        positions, totals = checkPositions(wc, positions, conf, dataStore, dataStream, i, totals)
+        positions, totals = checkPositions(wc, positions, conf, dataStore, dataStream, i, totals, resolver)
     
         # see if we calculated an entryPrice
         entryAction, entryPrice = None, None
         if conf.detector == 'threeBarPattern':
-            entryPrice = dataStore.analyze()
+            if signals is None:
+                entryPrice = dataStore.analyze(conf.secondToFirst, conf.secondToThird)
+            elif signals[i-1]: # the third bar
+                entryPrice = dataStore.third.close
+            if entryPrice is not None:
+                entryAction = 'BUY' # the pattern only enters long
         elif conf.detector == 'Crossover':
             entryAction, entryPrice = dataStore.checkForEntry(dataStream)
     
@@ -67,23 +70,23 @@ def backtest(wc, dataStream, dataStore, conf, period):
                 if orders.stopOrder.orderType == 'TRAIL': # have to store for position tracking
                     if od.config.stopPercent is not None:
                         if orders.entryOrder.action == 'BUY':
-                            orders.stopOrder.auxPrice = order.Round( orders.entryOrder.lmtPrice *(100.0 - orders.stopOrder.trailingPercent)/100.0, od.wContract.priceIncrement)
+                            orders.stopOrder.auxPrice = ticks.Round( orders.entryOrder.lmtPrice *(100.0 - orders.stopOrder.trailingPercent)/100.0, od.wContract.priceIncrement)
                         else:
-                            orders.stopOrder.auxPrice = order.Round( orders.entryOrder.lmtPrice *(100.0 + orders.stopOrder.trailingPercent)/100.0, od.wContract.priceIncrement)
+                            orders.stopOrder.auxPrice = ticks.Round( orders.entryOrder.lmtPrice *(100.0 + orders.stopOrder.trailingPercent)/100.0, od.wContract.priceIncrement)
                     elif od.config.stopTarget:
                         if orders.entryOrder.action == 'BUY':
                             orders.stopOrder.auxPrice = orders.entryOrder.lmtPrice - od.config.stopTarget
                         else:
                             orders.stopOrder.auxPrice = orders.entryOrder.lmtPrice + od.config.stopTarget
                 if conf.detector == 'threeBarPattern':
-                    orders, amount = checkTradeExecution(dataStore.third, orders)
+                    orders, amount = checkTradeExecution(dataStore.third, orders, resolver)
                 elif conf.detector == 'Crossover':
-                    orders, amount = checkTradeExecution(dataStream[dataStore.curEmaIndex+1], orders)
+                    orders, amount = checkTradeExecution(dataStream[dataStore.curEmaIndex+1], orders, resolver)
                 logging.warn('position config %s', od.config)
                 # check if the trade executed
                 if orders is not None:
                     logging.warn('opened a position: %s', orders)
-                    positions.append(orders)
+                    positions.add(orders, od.config)
                     totals['tf'] += orders.entryOrder.lmtPrice * orders.entryOrder.totalQuantity
                     totals['op'] += orders.entryOrder.totalQuantity
                 elif orders is None and amount is not None:
@@ -95,18 +98,21 @@ def backtest(wc, dataStream, dataStore, conf, period):
             dataStore.second = dataStore.third
             dataStore.third = getNextBar(dataStream, i)
     if len(positions) != 0:
-        positions, totals = checkPositions(wc, positions, conf, dataStore, dataStream, i, totals)
-        for p in positions:
+        positions, totals = checkPositions(wc, positions, conf, dataStore, dataStream, i, totals, resolver)
+        for p in positions.openOrders():
             if p.entryOrder.action == 'BUY':
-                totals['lo'] = (dataStream[len(dataStream)-1].close - p.entryOrder.lmtPrice) *p.entryOrder.totalQuantity
+                totals['lo'] = (float(dataStream[len(dataStream)-1].close) - p.entryOrder.lmtPrice) *p.entryOrder.totalQuantity
             else:
-                totals['lo'] = (p.entryOrder.lmtPrice - dataStream[len(dataStream)-1].close) *p.entryOrder.totalQuantity
+                totals['lo'] = (p.entryOrder.lmtPrice - float(dataStream[len(dataStream)-1].close)) *p.entryOrder.totalQuantity
     return totals
 
 # only used to check the third bar for if the order bought/sold in the third bar during "blur"
-# eg this is an unknown because we aren't analyzing by-second data
-def checkTradeExecution(bar, orders):
+# eg this is an unknown because we aren't analyzing by-second data, unless there is a resolver
+def checkTradeExecution(bar, orders, resolver=None):
     if orders.entryOrder.lmtPrice <= bar.high and orders.stopOrder.auxPrice >= bar.low:
+        if resolver is not None and resolver.stoppedAfterEntry(fills.barStart(bar), orders.entryOrder.action, orders.entryOrder.lmtPrice, orders.stopOrder.auxPrice) == False:
+            logging.info('resolved blur using finer bars, stop not hit after entry: {}'.format(bar))
+            return orders, None
         amount = None
         if orders.entryOrder.action == 'BUY':
             amount = (orders.stopOrder.auxPrice - orders.entryOrder.lmtPrice) *orders.entryOrder.totalQuantity
@@ -116,217 +122,11 @@ def checkTradeExecution(bar, orders):
     else:
         return orders, None
 
-# check all the open positions
-def checkPositions(wc, positions, conf, dataStore, dataStream, index, totals):
-    for position in positions:
-        closed, amount = None, None
-        if conf.detector == 'threeBarPattern':
-            closed, amount = checkPosition(dataStore.third, position)
-        elif conf.detector == 'Crossover':
-            closed, amount = checkPosition(dataStream[index], position)
-
-        if closed:
-            logging.warn('closed a position: {} {} {} {} {}'.format(amount, closed, position, dataStore, dataStream[index]))
-            totals['gl'] += amount
-            if totals['tf'] > totals['mf']:
-                totals['mf'] = totals['tf']
-            totals['tf'] -= position.entryOrder.lmtPrice * position.entryOrder.totalQuantity
-            positions.remove(position)
-        elif not closed and position.stopOrder.orderType == 'TRAIL':
-            closePrice = dataStream[index].close
-            if closePrice > position.entryOrder.lmtPrice:
-                if conf.stopPercent is not None:
-                    if position.entryOrder.action == 'BUY':
-                        position.stopOrder.auxPrice = order.Round( closePrice * (100.0 - position.stopOrder.trailingPercent)/100.0, wc.priceIncrement)
-                    else:
-                        position.stopOrder.auxPrice = order.Round( closePrice * (100.0 + position.stopOrder.trailingPercent)/100.0, wc.priceIncrement)
-                elif conf.stopTarget:
-                    if position.entryOrder.action == 'BUY':
-                        position.stopOrder.auxPrice = order.Round( closePrice - conf.stopTarget, wc.priceIncrement)
-                    else:
-                        position.stopOrder.auxPrice = order.Round( closePrice + conf.stopTarget, wc.priceIncrement)
-        #else position stays, no changes
+# check all the open positions (a book.PositionBook) against the bar at index
+def checkPositions(wc, positions, conf, dataStore, dataStream, index, totals, resolver=None):
+    bar = dataStream[index]
+    if conf.detector == 'threeBarPattern':
+        bar = dataStore.third
+    totals = positions.check(bar, dataStream[index].close, totals, resolver)
     return positions, totals
 
-# check if a "position" (represented by a fictitious order) changed in the bar
-# returns orderDetails and amount
-def checkPosition(bar, position):
-    amount, executed = checkStopProfit(position, bar)
-    if executed == False:
-        # order became a position, say so
-        return False, None
-    elif executed == True or executed == None:
-        # position closed, return amount
-        return True, amount
-    else:
-        logging.error('problem with position checking %s %s', position, bar)
-        return None, None
-
-# orderDetails represents a ficitious order which:
-#   fails to execute
-#   opens and closes really fast (inside the next bar)
-#   becomes a "position" representing shares held
-# returns amount or None (error condition)
-# need another value which is "continue"
-# returns
-#       True|False as to whether the trade executed
-#       amount neg or pos (loss/gain) or None if unknown
-def checkStopProfit(position, bar):
-    amount = None
-    executed = None
-    # executed at stop price
-    if position.stopOrder.auxPrice >= bar.low and position.exitOrder.lmtPrice > bar.high:
-        if position.entryOrder.action == 'BUY':
-            amount = position.stopOrder.auxPrice - position.entryOrder.lmtPrice
-        else:
-            amount = position.entryOrder.lmtPrice - position.stopOrder.auxPrice
-        logging.info('closing position at a loss: {} {} {}'.format(amount, position, bar))
-        executed = True
-    # executed at profit price
-    elif position.stopOrder.auxPrice < bar.low and position.exitOrder.lmtPrice <= bar.high:
-        if position.entryOrder.action == 'BUY':
-            amount = position.exitOrder.lmtPrice - position.entryOrder.lmtPrice
-        else:
-            amount = position.entryOrder.lmtPrice - position.exitOrder.lmtPrice
-        logging.info('closing position at a gain: {} {} {}'.format(amount, position, bar))
-        executed = True
-    # did not execute, no delta, stays as a position
-    elif position.stopOrder.auxPrice < bar.low and position.exitOrder.lmtPrice > bar.high:
-        logging.info('not closing a position {} {}'.format(position, bar))
-        executed = False
-        amount = None
-    # unknown execution, assume loss
-    elif position.stopOrder.auxPrice >= bar.low and position.exitOrder.lmtPrice <= bar.high:
-        logging.info('wonky: closing position: {}'.format(position))
-        executed = None
-        if position.entryOrder.action == 'BUY':
-            amount = position.stopOrder.auxPrice - position.entryOrder.lmtPrice
-        else:
-            amount = position.entryOrder.lmtPrice - position.stopOrder.auxPrice
-    else:
-        logging.fatal('unhandled {} {}'.format(position, bar))
-    if amount is not None:
-        amount = amount * position.entryOrder.totalQuantity
-    return amount, executed
-
-
-
-
-
-
-
-########################DRAGONS!
-def processScriptOutput():
-    ds = {}
-    with open('../esData', 'r') as f:
-        while True:
-            s = f.readline()
-            if not s:
-                break
-            kv = s.split()
-            vh = kv[1].split(':')
-            try:
-                ds[kv[0]][vh[0]] = vh[1]
-            except KeyError:
-                ds[kv[0]] = {}
-                ds[kv[0]][vh[0]] = vh[1]
-    one={}
-    five={}
-    ten={}
-    fourteen={}
-    thirty={}
-    sixty={}
-    total = {}
-    for k, v in ds.items():
-        for d, gl in v.items():
-            d = int(d)
-            gl = float(gl)
-            if d == 1:
-                one[k] = gl
-            elif d == 5:
-                five[k] = gl
-            elif d == 10:
-                ten[k] = gl
-            elif d == 14:
-                fourteen[k] = gl
-            elif d == 30:
-                thirty[k] = gl
-            elif d == 60:
-                sixty[k] = gl
-    return one, five, ten, fourteen, thirty, sixty
-
-# send output of processscriptoutput
-# inFromOut is output of script outputthing above
-def findUnion(inFromOut):
-    best = set()
-    for arr in inFromOut:
-        i = 0
-        for k in sorted(arr, key=arr.get, reverse=True):
-            i += 1
-            if i > 30:
-                break
-            best.add(k)
-    return best
-
-# regex is like 'lI:40,sI:15,w:15,sT:5,pT:7'
-def filterBest(regex, inFromOut):
-    #r = re.compile('lI:40,sI:15,w:(5|15),sT.*')
-    r = re.compile(regex)
-    for arr in inFromOut:
-        print('mark')
-        for k in sorted(arr, key=arr.get, reverse=True):
-            m = r.match(k)
-            if m:
-                print(k, arr[k])
-
-def feedFromUnionToPositiveKeyFinder(best, mult, inFromOut):
-    d = {}
-    for k in best:
-        r = getFromIn(k, mult, inFromOut)
-        if r:
-            # FIXME: make -1
-            for i in range(len(inFromOut)-1, 0, -1):
-                try:
-                    t = None
-                    t = inFromOut[i][k]
-                    if t is not None:
-                        d[k] = t
-                        break
-                except KeyError:
-                    zz =5
-    return d
-
-def getBestValue(inFromOut):
-    best = findUnion(inFromOut)
-    ds = []
-    for i in [1.5, 2, 2.5, 3]:
-        print('at multiplier ', i)
-        d = feedFromUnionToPositiveKeyFinder(best, i, inFromOut)
-        for k, v in d.items():
-            if v > 20000:
-                print(k, v)
-        print('')
-
-def getFromIn(key, mult, inFromOut):
-    v = []
-    for i in inFromOut:
-        try:
-            v.append(i[key])
-        except KeyError:
-            zzz = 5
-    p = v[0]
-    f = False
-    for j in v:
-        if j < 1:
-            f = False
-            break
-        elif j > mult * p:
-            f = True
-        else:
-            f = False
-        p = j
-    if f:
-        return key
-    return None
-
-
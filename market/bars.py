@@ -1,16 +1,24 @@
+import collections
+import datetime
 import logging
 import math
+import time
+
+import numpy as np
 
 from market import fatal
 
+# slotted, the live path makes one a minute and backtests used to make one per bar
 class Bar:
-    open_: float = 0.0
-    close: float = 0.0
-    high: float = 0.0
-    low: float = 92233720368547758.0
-    barSize: float = 0.0
-    lineSize: float = 0.0
-    color: str = 'X'
+    __slots__ = ('open', 'close', 'high', 'low', 'barSize', 'lineSize', 'color', 'date')
+    open: float
+    close: float
+    high: float
+    low: float
+    barSize: float
+    lineSize: float
+    color: str
+    date: object # start of the bar, set from historical data
 
     # just create a bar, will update
     def __init__(self, init):
@@ -18,11 +26,15 @@ class Bar:
         self.close = init
         self.high = init
         self.low = init
+        self.barSize = 0.0
+        self.lineSize = 0.0
+        self.color = 'X'
+        self.date = None
 
     def __repr__(self):
         pieces = []
-        for k, v in self.__dict__.items():
-            pieces.append('{}:{}'.format(k, v))
+        for k in self.__slots__:
+            pieces.append('{}:{}'.format(k, getattr(self, k)))
         return ','.join(pieces)
 
     def cleanUp(self):
@@ -44,22 +56,33 @@ class Bar:
         elif math.isnan(self.close) or math.isnan(self.open):
             fatal.errorAndExit('got a self with NaN: {}'.format(self))
 
+# bar size ratios the three bar pattern tests, second to first and second to third bar
+secondToFirst = 0.3
+secondToThird = 0.5
+
 class BarSet:
-    first: Bar = None
-    second: Bar = None
-    third: Bar = None
+    __slots__ = ('first', 'second', 'third')
+    first: Bar
+    second: Bar
+    third: Bar
+
+    def __init__(self):
+        self.first = None
+        self.second = None
+        self.third = None
+
     def __repr__(self):
         pieces = []
-        for k, v in self.__dict__.items():
-            pieces.append('{}:{}'.format(k, v))
+        for k in self.__slots__:
+            pieces.append('{}:{}'.format(k, getattr(self, k)))
         return ','.join(pieces)
 
-    def analyze(self):
+    def analyze(self, secondToFirst=secondToFirst, secondToThird=secondToThird):
         entryPrice = None
         if self.first.color == 'X' or self.second.color == 'X' or self.third.color == 'X':
             logging.debug('got a partial bar')
         #FIXME: the bar size testing seems to have a large impact on not entering, to the detriment of the return
-        elif not self.first.color == 'G' and not self.second.color == 'R' and not self.third.color == 'G' and not self.second.barSize < 0.3 * self.first.barSize and not self.second.barSize < 0.5 * self.third.barSize and not self.third.barSize > self.second.barSize:
+        elif not self.first.color == 'G' and not self.second.color == 'R' and not self.third.color == 'G' and not self.second.barSize < secondToFirst * self.first.barSize and not self.second.barSize < secondToThird * self.third.barSize and not self.third.barSize > self.second.barSize:
             entryPrice = None
         else:
             entryPrice = self.third.close
@@ -68,3 +91,285 @@ class BarSet:
         
             logging.info('found a potential entry point: %d', entryPrice)
         return entryPrice
+
+# rolls pieces of bars (eg 5 second realtime bars) up into Bars of barSize seconds as
+# they arrive.  a bar completes when a piece ends on its boundary, or when a piece of a
+# later bar shows up first (the closing piece went missing)
+class BarAggregator:
+    __slots__ = ('barSize', 'bar', 'start')
+    barSize: int # seconds
+    bar: Bar # the one filling, None between bars
+    start: float # epoch start of the filling bar, or of the next one expected
+
+    def __init__(self, barSize):
+        self.barSize = barSize
+        self.bar = None
+        self.start = None
+
+    def __repr__(self):
+        pieces = []
+        for k in self.__slots__:
+            pieces.append('{}:{}'.format(k, getattr(self, k)))
+        return ','.join(pieces)
+
+    # a piece starting at start (epoch) lasting seconds, returns the bars it completed
+    def add(self, start, seconds, open_, high, low, close):
+        done = []
+        bucket = start - start % self.barSize
+        if self.start is not None and bucket < self.start: # late piece of a completed bar
+            return done
+        if self.bar is not None and bucket > self.start:
+            done.append(self.complete(bucket))
+        if self.bar is None:
+            self.start = bucket
+            self.bar = Bar(open_)
+            self.bar.date = datetime.datetime.fromtimestamp(bucket, datetime.timezone.utc)
+        bar = self.bar
+        if high > bar.high:
+            bar.high = high
+        if low < bar.low:
+            bar.low = low
+        bar.close = close
+        if start + seconds >= bucket + self.barSize:
+            done.append(self.complete(bucket + self.barSize))
+        return done
+
+    # a trade or quote at time (epoch), a bar of ticks completes with the first tick of a
+    # later bar, or by flush
+    def addTick(self, time, price):
+        return self.add(time, 0, price, price, price, price)
+
+    # complete the filling bar if its time is up by now (epoch), for quiet markets
+    def flush(self, now):
+        if self.bar is not None and now >= self.start + self.barSize:
+            return [self.complete(self.start + self.barSize)]
+        return []
+
+    # seconds from now (epoch) until the filling (or next) bar ends
+    def untilClose(self, now):
+        start = now - now % self.barSize if self.start is None or self.start + self.barSize <= now else self.start
+        return start + self.barSize - now
+
+    def complete(self, nextStart):
+        bar = self.bar
+        bar.anotate()
+        self.bar = None
+        self.start = nextStart
+        return bar
+
+# bars of barSize seconds from every tick of an ib_insync Ticker, rather than sampling
+# its marketPrice: the bid/ask midpoint (the last price until there is a bid and ask),
+# like Ticker.marketPrice.  a handler per ticker, so many share the event loop
+class TickerBars:
+    __slots__ = ('ticker', 'aggregator', 'bid', 'ask', 'last', 'completed')
+    ticker: object # ib_insync.Ticker
+    aggregator: BarAggregator
+    bid: float
+    ask: float
+    last: float
+    completed: collections.deque # of Bar, completed and not yet taken by next
+
+    def __init__(self, ticker, barSize=60):
+        self.ticker = ticker
+        self.aggregator = BarAggregator(barSize)
+        self.bid = None
+        self.ask = None
+        self.last = None
+        self.completed = collections.deque()
+        # the quote so far, the ticks before subscribing are gone
+        for k in ['bid', 'ask', 'last']:
+            price = getattr(ticker, k, None)
+            if price is not None and price > 0:
+                setattr(self, k, price)
+        ticker.updateEvent += self.update
+
+    def __repr__(self):
+        return 'bid:{},ask:{},last:{},aggregator:{},completed:{}'.format(self.bid, self.ask, self.last, self.aggregator, len(self.completed))
+
+    # Ticker.updateEvent handler, ticker.ticks are the ticks of this update
+    def update(self, ticker):
+        for tick in ticker.ticks:
+            if not tick.price > 0: # size only ticks carry -1, and nan
+                continue
+            if tick.tickType in (1, 66):
+                self.bid = tick.price
+            elif tick.tickType in (2, 67):
+                self.ask = tick.price
+            elif tick.tickType in (4, 68):
+                self.last = tick.price
+            else:
+                continue
+            price = (self.bid + self.ask) /2 if self.bid is not None and self.ask is not None else self.last
+            if price is not None:
+                self.completed.extend(self.aggregator.addTick(tick.time.timestamp(), price))
+
+    # the next completed bar, sleeping (sleepFunc, eg ib.sleep so the ticks keep coming)
+    # until the filling one ends
+    def next(self, sleepFunc):
+        while not self.completed:
+            sleepFunc(self.aggregator.untilClose(time.time()))
+            self.completed.extend(self.aggregator.flush(time.time()))
+        return self.completed.popleft()
+
+    def cancel(self):
+        self.ticker.updateEvent -= self.update
+
+# the latest realtime bars of one contract and whatToShow in fixed memory, a ring of
+# capacity bars.  the last bar's fields are plain reads, and the low/high over the last
+# window bars are kept by monotonic queues so they are reads too
+class RealtimeRing:
+    __slots__ = ('capacity', 'window', 'time', 'open', 'high', 'low', 'close', 'count', 'lows', 'highs')
+    capacity: int
+    window: int # bars the queues track, windowLow/windowHigh
+    time: np.ndarray # epoch start of the bar
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    count: int # bars pushed, the last one is at (count-1) % capacity
+    lows: collections.deque # (count, low), increasing lows within the window
+    highs: collections.deque # (count, high), decreasing highs within the window
+
+    def __init__(self, capacity=720, window=12):
+        if window > capacity:
+            raise ValueError('window {} is longer than the ring {}'.format(window, capacity))
+        self.capacity = capacity
+        self.window = window
+        self.time = np.full(capacity, np.nan)
+        self.open = np.full(capacity, np.nan)
+        self.high = np.full(capacity, np.nan)
+        self.low = np.full(capacity, np.nan)
+        self.close = np.full(capacity, np.nan)
+        self.count = 0
+        self.lows = collections.deque()
+        self.highs = collections.deque()
+
+    def __repr__(self):
+        return 'capacity:{},window:{},count:{},last:{}'.format(self.capacity, self.window, self.count,
+                (self.lastTime(), self.lastLow(), self.lastHigh(), self.lastClose()) if self.count else None)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def push(self, time, open_, high, low, close):
+        i = self.count % self.capacity
+        self.time[i] = time
+        self.open[i] = open_
+        self.high[i] = high
+        self.low[i] = low
+        self.close[i] = close
+        n = self.count
+        self.count += 1
+        while self.lows and self.lows[-1][1] >= low:
+            self.lows.pop()
+        self.lows.append((n, low))
+        while self.highs and self.highs[-1][1] <= high:
+            self.highs.pop()
+        self.highs.append((n, high))
+        if self.lows[0][0] <= n - self.window:
+            self.lows.popleft()
+        if self.highs[0][0] <= n - self.window:
+            self.highs.popleft()
+
+    # RealTimeBarList.updateEvent handler
+    def update(self, bb, hasNewBar):
+        if hasNewBar and len(bb) > 0:
+            b = bb[-1]
+            self.push(b.time.timestamp(), b.open_, b.high, b.low, b.close)
+
+    def last(self):
+        return (self.count-1) % self.capacity
+    def lastTime(self):
+        return float(self.time[self.last()])
+    def lastHigh(self):
+        return float(self.high[self.last()])
+    def lastLow(self):
+        return float(self.low[self.last()])
+    def lastClose(self):
+        return float(self.close[self.last()])
+
+    # low/high over the last window bars (fewer until that many came)
+    def windowLow(self):
+        return float(self.lows[0][1])
+    def windowHigh(self):
+        return float(self.highs[0][1])
+
+    # the last n bars of a column, oldest first (a copy when they wrap around the ring)
+    def lastN(self, column, n):
+        n = min(n, len(self))
+        end = self.count % self.capacity
+        if n <= end:
+            return column[end-n:end]
+        return np.concatenate((column[self.capacity-(n-end):], column[:end]))
+
+    # low/high over the last n bars, a read for the window and a scan of n otherwise
+    def lowOver(self, n):
+        if n == self.window:
+            return self.windowLow()
+        return float(self.lastN(self.low, n).min())
+    def highOver(self, n):
+        if n == self.window:
+            return self.windowHigh()
+        return float(self.lastN(self.high, n).max())
+
+# compact bars for backtests, a numpy record array with a row per bar
+#   rows read like a Bar (bar.close, bar.color, ...), date is the bar start in epoch
+#   seconds or nan when unknown
+barDtype = np.dtype([('date', 'f8'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'), ('close', 'f8'),
+        ('barSize', 'f8'), ('lineSize', 'f8'), ('color', 'U1')])
+
+def fromColumns(date, open_, high, low, close):
+    barArray = np.recarray(len(close), dtype=barDtype)
+    barArray.date = date
+    barArray.open = open_
+    barArray.high = high
+    barArray.low = low
+    barArray.close = close
+    barArray.barSize = 0.0
+    barArray.lineSize = 0.0
+    barArray.color = 'X'
+    return barArray
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# from historical data (BarData or Bar)
+def toBarArray(dataStream):
+    n = len(dataStream)
+    prices = [np.fromiter((getattr(b, c) for b in dataStream), dtype=np.float64, count=n) for c in ['open', 'high', 'low', 'close']]
+    try:
+        date = np.fromiter(((b.date - epoch).total_seconds() for b in dataStream), dtype=np.float64, count=n)
+    except (AttributeError, TypeError): # missing dates, or dates without a timezone
+        dates = (getattr(b, 'date', None) for b in dataStream)
+        date = np.fromiter((d.timestamp() if isinstance(d, datetime.datetime) else np.nan for d in dates), dtype=np.float64, count=n)
+    return fromColumns(date, *prices)
+
+# Bar.anotate for every row at once
+def anotateArray(barArray):
+    o, c, h, l = barArray.open, barArray.close, barArray.high, barArray.low
+    nan = np.isnan(o) | np.isnan(c)
+    if nan.any():
+        fatal.errorAndExit('got a bar with NaN: {}'.format(barArray[nan.argmax()]))
+    barArray.barSize = np.abs(o - c)
+    barArray.lineSize = np.abs(h - l)
+    barArray.color = np.where((o < c) | ((c == o) & (h != l)), 'G', np.where(c < o, 'R', 'X'))
+    return barArray
+
+# BarSet.analyze over a whole barDtype array, True at the third bar of every entry
+def threeBarSignals(barArray, secondToFirst=secondToFirst, secondToThird=secondToThird):
+    n = len(barArray)
+    signals = np.zeros(n, dtype=bool)
+    if n < 3:
+        return signals
+    color, size = barArray.color, barArray.barSize
+    first, second, third = slice(0, n-2), slice(1, n-1), slice(2, n)
+    partial = (color[first] == 'X') | (color[second] == 'X') | (color[third] == 'X')
+    rejected = ((color[first] != 'G') & (color[second] != 'R') & (color[third] != 'G')
+            & ~(size[second] < secondToFirst * size[first]) & ~(size[second] < secondToThird * size[third])
+            & ~(size[third] > size[second]))
+    signals[2:] = ~partial & ~rejected
+    return signals
+
+# the index of the third bar and the entry price of every entry in a barDtype array
+def threeBarEntries(barArray, secondToFirst=secondToFirst, secondToThird=secondToThird):
+    entries = np.flatnonzero(threeBarSignals(barArray, secondToFirst, secondToThird))
+    return entries, barArray.close[entries]
@@ -0,0 +1,180 @@
+# backtest throughput benchmarks over synthetic bars, no gateway needed
+#
+# each case runs a number of parameter combinations over the same bars and reports
+# bars/second, the latency of a combination and the peak memory (traced allocations,
+# measured on a separate pass so the tracing does not slow down the timings).  runs
+# are saved as yaml so a later run can be compared against them.
+import datetime
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import yaml
+
+from market import backtest
+from market import config
+from market import contract
+from market import detector
+from market import indicators
+from market import npbacktest
+from market import sweep
+from market import synthetic
+
+defaultDir = os.path.join(os.path.expanduser('~'), '.ibBench')
+
+cases = ['threeBarPattern', 'Crossover', 'CrossoverVectorized']
+
+def benchConfig(detectorName):
+    conf = config.Config()
+    conf.symbol = 'ES'
+    conf.localSymbol = 'ESZ0'
+    conf.percents = False
+    conf.profitTarget = 2
+    conf.stopTarget = 1
+    conf.trail = False
+    conf.dayOrder = False
+    conf.byPrice = False
+    conf.qty = 1
+    conf.openPositions = 3
+    conf.exitOutsideRth = True
+    conf.detector = detectorName
+    conf.barSizeStr = '1 min'
+    return conf
+
+# (p, lI, sI, w, sT, pT), the same pick for a given count and seed
+def pickCombinations(count, seed=None):
+    combinations = list(sweep.combinations([None], [5, 10, 20, 40, 60], [2, 5, 10, 15], [2, 3, 5, 7], [0.5, 1, 2], [0.5, 1, 2]))
+    random.Random(seed).shuffle(combinations)
+    return combinations[:count]
+
+# returns setup(dataStream), which returns run(combination) for the case
+def caseRunner(case, wc):
+    conf = benchConfig('threeBarPattern' if case == 'threeBarPattern' else 'Crossover')
+    def withTargets(sT, pT):
+        conf.stopTarget = sT
+        conf.profitTarget = pT
+        return conf
+
+    if case == 'threeBarPattern':
+        def setup(dataStream):
+            annotated = backtest.anotateBars(dataStream)
+            period = (len(annotated) - 4) //(24*60) # whole days, see backtest.setupThreeBar
+            if period < 1:
+                raise ValueError('the three bar pattern needs more than a day of bars, got {}'.format(len(annotated)))
+            def run(combination):
+                p, lI, sI, w, sT, pT = combination
+                return backtest.backtest(wc, annotated, None, withTargets(sT, pT), period)
+            return run
+    elif case == 'Crossover':
+        def setup(dataStream):
+            def run(combination):
+                p, lI, sI, w, sT, pT = combination
+                dataStore = detector.Crossover(conf.barSizeStr, wc, sI, lI, w)
+                dataStore.backTest = True
+                dataStore.initIndicators(dataStream)
+                return backtest.backtest(wc, dataStream, dataStore, withTargets(sT, pT), None)
+            return run
+    elif case == 'CrossoverVectorized':
+        def setup(dataStream):
+            high, low, close = npbacktest.toArrays(dataStream)
+            emaCache = indicators.EMACache(close)
+            def run(combination):
+                p, lI, sI, w, sT, pT = combination
+                return npbacktest.backtest(wc, withTargets(sT, pT), high, low, close, sI, lI, w, None, emaCache)
+            return run
+    else:
+        raise ValueError('unknown benchmark case {}, one of {}'.format(case, cases))
+    return setup
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) *pct/100))]
+
+def measure(case, wc, dataStream, combinations):
+    setup = caseRunner(case, wc)
+    started = time.perf_counter()
+    run = setup(dataStream)
+    setupSeconds = time.perf_counter() - started
+    latencies = []
+    for combination in combinations:
+        started = time.perf_counter()
+        run(combination)
+        latencies.append(time.perf_counter() - started)
+    seconds = setupSeconds + sum(latencies)
+
+    # memory on its own pass, setup plus one combination
+    tracemalloc.start()
+    try:
+        caseRunner(case, wc)(dataStream)(combinations[0])
+        peakMemory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'combinations': len(combinations),
+        'seconds': seconds,
+        'setupSeconds': setupSeconds,
+        'barsPerSecond': len(dataStream) *len(combinations) /seconds,
+        'latency': {'mean': statistics.mean(latencies), 'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'max': max(latencies)},
+        'peakMemory': peakMemory,
+    }
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(n=100000, combinations=20, seed=1, which=cases):
+    wc = contract.BacktestContract('ES', 'ESZ0', 0.25)
+    dataStream = synthetic.randomWalk(n, seed, priceIncrement=wc.priceIncrement)
+    picked = pickCombinations(combinations, seed)
+    result = {'version': version(), 'createdAt': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'bars': n, 'seed': seed, 'cases': {}}
+    for case in which:
+        logging.error('benchmarking {} over {} bars, {} combinations'.format(case, n, len(picked)))
+        result['cases'][case] = measure(case, wc, dataStream, picked)
+    return result
+
+def save(result, benchDir=defaultDir):
+    os.makedirs(benchDir, exist_ok=True)
+    path = os.path.join(benchDir, '{}.yaml'.format(result['createdAt'].replace(':', '')))
+    with open(path, 'w') as f:
+        yaml.safe_dump(result, f)
+    return path
+
+def load(path):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+# the newest saved run, None if there is none
+def latest(benchDir=defaultDir):
+    if not os.path.isdir(benchDir):
+        return None
+    paths = sorted(p for p in os.listdir(benchDir) if p.endswith('.yaml'))
+    return os.path.join(benchDir, paths[-1]) if paths else None
+
+# lines comparing two runs, marking anything threshold (a fraction) worse than before
+def compare(before, after, threshold=0.1):
+    lines = []
+    if before['bars'] != after['bars'] or before['seed'] != after['seed']:
+        lines.append('runs over different bars, {}/{} vs {}/{}'.format(before['bars'], before['seed'], after['bars'], after['seed']))
+    for case, a in after['cases'].items():
+        b = before['cases'].get(case)
+        if b is None:
+            continue
+        # bars/second is better higher, the rest better lower
+        for name, old, new, higher in [('barsPerSecond', b['barsPerSecond'], a['barsPerSecond'], True),
+                ('latency.p50', b['latency']['p50'], a['latency']['p50'], False),
+                ('latency.p95', b['latency']['p95'], a['latency']['p95'], False),
+                ('peakMemory', b['peakMemory'], a['peakMemory'], False)]:
+            change = (new - old) /old if old else 0
+            worse = -change if higher else change
+            flag = ' REGRESSION' if worse > threshold else ''
+            lines.append('{} {}: {:.6g} -> {:.6g} ({:+.1%}){}'.format(case, name, old, new, change, flag))
+    return lines
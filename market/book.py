@@ -0,0 +1,141 @@
+# the simulated positions of a backtest, kept in parallel arrays
+#
+# every open position is checked against a bar in one step by PositionBook.check, the
+# one place the backtests settle a position: the stop, the profit, the wonky case (both
+# inside one bar) and the trailing stop updates.  positions stay in the order they were
+# opened so the totals add up the same way.
+import logging
+
+import numpy as np
+
+from market import fills
+from market import ticks
+
+class PositionBook:
+    priceIncrement: float
+    orders: list # the BracketOrder for each slot
+    lmt: np.ndarray # entry price
+    qty: np.ndarray
+    stop: np.ndarray
+    profit: np.ndarray
+    buy: np.ndarray # entry side is BUY
+    trailPercent: np.ndarray # nan unless trailing by percent
+    trailOffset: np.ndarray # nan unless trailing by a fixed amount
+    active: np.ndarray
+    size: int = 0 # slots used, open or closed
+    count: int = 0 # open positions
+
+    def __init__(self, priceIncrement, capacity=16):
+        self.priceIncrement = priceIncrement
+        self.orders = []
+        self.lmt = np.zeros(capacity)
+        self.qty = np.zeros(capacity)
+        self.stop = np.zeros(capacity)
+        self.profit = np.zeros(capacity)
+        self.buy = np.zeros(capacity, dtype=bool)
+        self.trailPercent = np.full(capacity, np.nan)
+        self.trailOffset = np.full(capacity, np.nan)
+        self.active = np.zeros(capacity, dtype=bool)
+
+    def __repr__(self):
+        return 'open:{},orders:{}'.format(self.count, self.openOrders())
+
+    def __len__(self):
+        return self.count
+
+    def arrays(self):
+        return ['lmt', 'qty', 'stop', 'profit', 'buy', 'trailPercent', 'trailOffset', 'active']
+
+    # make room for one more, dropping closed slots first
+    def reserve(self):
+        if self.size < len(self.active):
+            return
+        keep = np.flatnonzero(self.active[:self.size])
+        capacity = max(len(self.active), 2*len(keep) + 1)
+        for name in self.arrays():
+            old = getattr(self, name)
+            new = np.full(capacity, np.nan) if old.dtype != bool else np.zeros(capacity, dtype=bool)
+            new[:len(keep)] = old[keep]
+            setattr(self, name, new)
+        self.orders = [self.orders[i] for i in keep]
+        self.size = len(keep)
+
+    # orders is an order.BracketOrder with the stop already an absolute price (see backtest.backtest)
+    def add(self, orders, conf):
+        self.reserve()
+        i = self.size
+        self.orders.append(orders)
+        self.lmt[i] = orders.entryOrder.lmtPrice
+        self.qty[i] = orders.entryOrder.totalQuantity
+        self.stop[i] = orders.stopOrder.auxPrice
+        self.profit[i] = orders.exitOrder.lmtPrice
+        self.buy[i] = orders.entryOrder.action == 'BUY'
+        self.trailPercent[i] = np.nan
+        self.trailOffset[i] = np.nan
+        if orders.stopOrder.orderType == 'TRAIL':
+            if conf.stopPercent is not None:
+                self.trailPercent[i] = orders.stopOrder.trailingPercent
+            elif conf.stopTarget:
+                self.trailOffset[i] = conf.stopTarget
+        self.active[i] = True
+        self.size += 1
+        self.count += 1
+
+    def openOrders(self):
+        return [self.orders[i] for i in np.flatnonzero(self.active[:self.size])]
+
+    def amount(self, i, price):
+        if self.buy[i]:
+            return (price - self.lmt[i].item()) * self.qty[i].item()
+        return (self.lmt[i].item() - price) * self.qty[i].item()
+
+    # check every open position against bar, updating totals
+    #   a position closes at its stop when the bar reaches it, at its profit when the bar
+    #   reaches that, and when it reaches both (wonky) at the stop unless the finer bars
+    #   say the profit came first
+    #   closePrice is what the trailing stops follow, the bar's close for Crossover
+    #   resolver is a fills.IntrabarResolver for the wonky case, optional
+    def check(self, bar, closePrice, totals, resolver=None):
+        if self.count == 0:
+            return totals
+        n = self.size
+        active = self.active[:n]
+        atStop = active & (self.stop[:n] >= bar.low)
+        atProfit = active & (self.profit[:n] <= bar.high)
+        closing = atStop | atProfit # nothing closes on a bar with NaN
+        if np.isnan(bar.low) or np.isnan(bar.high):
+            logging.error('unhandled bar for positions {} {}'.format(self, bar))
+
+        for i in np.flatnonzero(closing).tolist():
+            price = self.profit[i].item()
+            if atStop[i]:
+                price = self.stop[i].item()
+                if atProfit[i]: # wonky, assume a loss unless the finer bars say otherwise
+                    hit = None
+                    if resolver is not None:
+                        action = 'BUY' if self.buy[i] else 'SELL'
+                        hit = resolver.firstHit(fills.barStart(bar), action, price, self.profit[i].item())
+                    if hit == 'profit':
+                        price = self.profit[i].item()
+            amount = self.amount(i, price)
+            logging.warn('closed a position: {} {} {}'.format(amount, self.orders[i], bar))
+            totals['gl'] += amount
+            if totals['tf'] > totals['mf']:
+                totals['mf'] = totals['tf']
+            totals['tf'] -= self.lmt[i].item() * self.qty[i].item()
+            self.active[i] = False
+            self.count -= 1
+
+        # trail the stops of what is still open when the close is over the entry
+        trailing = ~(np.isnan(self.trailPercent[:n]) & np.isnan(self.trailOffset[:n]))
+        moving = self.active[:n] & trailing & (closePrice > self.lmt[:n])
+        idx = np.flatnonzero(moving)
+        if len(idx):
+            buy = self.buy[idx]
+            percent, offset = self.trailPercent[idx], self.trailOffset[idx]
+            pct = np.where(buy, 100.0 - percent, 100.0 + percent)
+            stops = np.where(np.isnan(percent), closePrice + np.where(buy, -offset, offset), closePrice * pct/100.0)
+            self.stop[idx] = ticks.RoundArray(stops, self.priceIncrement)
+            for i in idx.tolist():
+                self.orders[i].stopOrder.auxPrice = self.stop[i].item()
+        return totals
@@ -0,0 +1,153 @@
+# on disk cache of historical bars, sits behind data.getHistData for backtests
+#
+# one directory per contract/bar size/whatToShow/useRTH holding a .npy file per column
+# sorted by bar time, and a meta.yaml with the time range covered plus enough of the
+# contract to run a backtest without a gateway connection.  requests are served from
+# disk and only the part outside the covered range is fetched.
+from datetime import datetime, timezone
+import logging
+import os
+
+import numpy as np
+import pytz
+import yaml
+
+from ib_insync.objects import BarData
+
+from market import contract
+from market import date
+
+defaultDir = os.path.join(os.path.expanduser('~'), '.ibBars')
+
+columns = {'date': np.int64, 'open': np.float64, 'high': np.float64, 'low': np.float64, 'close': np.float64, 'volume': np.float64, 'average': np.float64, 'barCount': np.int64}
+
+# the largest request (in seconds) made to the gateway in one go, by bar size
+maxFetch = {'5 secs': 3600, '1 min': 86400}
+
+def keyName(localSymbol, barSizeStr, whatToShow, useRth):
+    return '{}_{}_{}_{}'.format(localSymbol, barSizeStr.replace(' ', ''), whatToShow, 'rth' if useRth else 'all')
+
+# '' means now, otherwise the 'yyyymmdd hh:mm:ss [tz]' format used by ib (utc when tz is left off)
+def parseEndDateTime(e):
+    if not e:
+        return date.nowInUtc()
+    pieces = e.split()
+    dt = datetime.strptime(' '.join(pieces[:2]), '%Y%m%d %H:%M:%S')
+    tz = date.parseTimezone(pieces[2]) if len(pieces) > 2 else pytz.utc
+    return tz.localize(dt).astimezone(pytz.utc)
+
+def toEpoch(dt):
+    return int(dt.timestamp())
+
+# same tzinfo as the bars ib_insync returns, which keeps bars.toBarArray on its fast path
+def toDatetime(ts):
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+# end, moved back to the end of the last full bar when it is in the future
+def fullBarsEnd(end, barSize):
+    now = toEpoch(date.nowInUtc())
+    return min(end, now - now % barSize)
+
+# fetch(endDateTime, durationStr) returns bars from the gateway, called backwards from end
+# in requests of at most maxFetch.  returns (epoch, bar) of the bars in [start, end)
+def fetchRange(fetch, barSizeStr, start, end, label=''):
+    fetched = []
+    while end > start:
+        span = min(maxFetch[barSizeStr], end - start)
+        logging.info('fetching {} seconds of bars ending at {} for {}'.format(span, toDatetime(end), label))
+        for bar in fetch(toDatetime(end), '{} S'.format(span)):
+            ts = toEpoch(bar.date)
+            if start <= ts < end:
+                fetched.append((ts, bar))
+        end -= span
+    return fetched
+
+class HistCache:
+    path: str
+    barSizeStr: str
+    barSize: int # seconds
+    whatToShow: str
+    useRth: bool
+    meta: dict = None # symbol, localSymbol, priceIncrement and the covered range, start/end (epoch)
+    bars: dict = None # column name to np.ndarray
+
+    def __init__(self, cacheDir, localSymbol, barSizeStr, barSize, whatToShow, useRth):
+        self.path = os.path.join(cacheDir, keyName(localSymbol, barSizeStr, whatToShow, useRth))
+        self.barSizeStr = barSizeStr
+        self.barSize = barSize
+        self.whatToShow = whatToShow
+        self.useRth = useRth
+        self.load()
+
+    def __repr__(self):
+        return 'path:{},meta:{}'.format(self.path, self.meta)
+
+    def load(self):
+        metaFile = os.path.join(self.path, 'meta.yaml')
+        if not os.path.exists(metaFile):
+            return
+        with open(metaFile, 'r') as f:
+            self.meta = yaml.safe_load(f)
+        self.bars = {}
+        for c in columns:
+            self.bars[c] = np.load(os.path.join(self.path, c + '.npy'))
+
+    # columns first, then meta, so a partial write is never picked up as covering more
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        for c in columns:
+            tmp = os.path.join(self.path, c + '.tmp.npy')
+            np.save(tmp, self.bars[c])
+            os.replace(tmp, os.path.join(self.path, c + '.npy'))
+        tmp = os.path.join(self.path, 'meta.yaml.tmp')
+        with open(tmp, 'w') as f:
+            yaml.safe_dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, 'meta.yaml'))
+
+    def covers(self, start, end):
+        return self.meta is not None and self.meta['start'] <= start and end <= self.meta['end']
+
+    def fetchRange(self, fetch, start, end):
+        return fetchRange(fetch, self.barSizeStr, start, end, self.path)
+
+    # merge new bars in, newer bars win when the time is already cached
+    def merge(self, fetched, start, end):
+        new = {c: np.array([getattr(b, c) if c != 'date' else ts for ts, b in fetched], dtype=t) for c, t in columns.items()}
+        if self.bars is not None:
+            new = {c: np.concatenate((new[c], self.bars[c])) for c in columns}
+            start = min(start, self.meta['start'])
+            end = max(end, self.meta['end'])
+        dates, index = np.unique(new['date'], return_index=True)
+        self.bars = {c: new[c][index] for c in columns}
+        self.meta['start'] = start
+        self.meta['end'] = end
+
+    def get(self, wc, start, end, fetch=None):
+        # only full bars go in the cache
+        end = fullBarsEnd(end, self.barSize)
+        if not self.covers(start, end):
+            if fetch is None:
+                logging.warn('not connected, using what is cached for {} {}-{}: {}'.format(wc.localSymbol, toDatetime(start), toDatetime(end), self))
+            else:
+                if self.meta is None:
+                    self.meta = {'start': start, 'end': start}
+                fetched = []
+                if start < self.meta['start']:
+                    fetched += self.fetchRange(fetch, start, self.meta['start'])
+                if end > self.meta['end']:
+                    fetched += self.fetchRange(fetch, self.meta['end'], end)
+                self.meta.update({'symbol': wc.symbol, 'localSymbol': wc.localSymbol, 'priceIncrement': wc.priceIncrement})
+                self.merge(fetched, start, end)
+                self.save()
+        if self.bars is None:
+            return []
+        i, j = np.searchsorted(self.bars['date'], [start, end])
+        rows = zip(*[self.bars[c][i:j].tolist() for c in columns])
+        return [BarData(toDatetime(r[0]), *r[1:]) for r in rows]
+
+# a contract for backtests from the cache, no gateway needed
+def backtestContract(cacheDir, localSymbol, barSizeStr, barSize, whatToShow, useRth):
+    hc = HistCache(cacheDir, localSymbol, barSizeStr, barSize, whatToShow, useRth)
+    if hc.meta is None:
+        return None
+    return contract.BacktestContract(hc.meta['symbol'], hc.meta['localSymbol'], hc.meta['priceIncrement'])
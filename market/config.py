@@ -44,11 +44,14 @@ class Config:
     dollarAmt: float
     bufferAmt: float # used by order creation to keep money aside, untouched.
     maxLoss: float # used to know when to stop
+    fillTimeout: float = 3 # seconds an entry has to fill before its bracket is reported as timed out, see trade.BracketTrade
     detector: str
     barSizeStr: str
     longEMA: int
     shortEMA: int
     watchCount: int
+    secondToFirst: float = 0.3 # three bar pattern bar size ratios, see bars.BarSet.analyze
+    secondToThird: float = 0.5
     def __repr__(self):
         pieces = []
         for k, v in self.__dict__.items():
@@ -69,6 +72,7 @@ def ProcessConfig(conf, detectorOn=None):
 
     config.bufferAmt = conf['bufferAmt']
     config.maxLoss = conf['maxLoss']
+    config.fillTimeout = conf.get('fillTimeout', config.fillTimeout)
 
     if config.byPrice:
         config.dollarAmt = conf['dollarAmt']
@@ -101,6 +105,9 @@ def ProcessConfig(conf, detectorOn=None):
             config.shortEMA = conf['shortEMA']
             config.longEMA = conf['longEMA']
             config.watchCount = conf['watchCount']
+        elif config.detector == 'threeBarPattern':
+            config.secondToFirst = conf.get('secondToFirst', config.secondToFirst)
+            config.secondToThird = conf.get('secondToThird', config.secondToThird)
 
     logging.warn('config %s', config)
     return config
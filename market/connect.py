@@ -9,11 +9,13 @@ from market import rand
 def getPort(prod=False):
     return 4001 if prod else 4002
 
-def connect(conf=None, debug=None):
+# port defaults to the gateway for conf.prod, eg set it to run against a gateway.FakeGateway
+def connect(conf=None, debug=None, port=None):
     util.logToConsole(logging.WARN)
     if debug:
         util.logToConsole(logging.DEBUG)
 
+    port = getPort(conf.prod) if port is None else port
     ibc = IB()
     connected = False
     n = 0
@@ -23,9 +25,9 @@ def connect(conf=None, debug=None):
             if conf.prod:
                 if conf.tradingMode != 'live':
                     fatal.fatal(conf, 'prod set but trading mode is not live')
-                ibc.connect(host="localhost", port=getPort(conf.prod), clientId=rand.Int(), timeout=3, readonly=False, account=conf.account)
+                ibc.connect(host="localhost", port=port, clientId=rand.Int(), timeout=3, readonly=False, account=conf.account)
             else:
-                ibc.connect(host="localhost", port=getPort(conf.prod), clientId=rand.Int(), account=conf.account)
+                ibc.connect(host="localhost", port=port, clientId=rand.Int(), account=conf.account)
             ibc.sleep(0.25)
             connected = ibc.isConnected()
         except:
@@ -10,7 +10,9 @@ from ib_insync.objects import PnLSingle
 from ib_insync.objects import PriceIncrement
 from ib_insync.objects import RealTimeBarList
 
+from market import bars
 from market import fatal
+from market import ticks
 
 # wrapper for ib's contract since things are spread out among the contract and its details
 class wContract:
@@ -20,12 +22,15 @@ class wContract:
     localSymbol: str
     marketRule: [PriceIncrement]
     priceIncrement: float
+    tickRule: ticks.TickRule # every increment of the market rule, see order.RoundPrice
     ibClient: IB
     pnl: PnLSingle
     midpointBars: RealTimeBarList = None
     bidBars: RealTimeBarList = None
+    realtimeRings: dict # whatToShow to bars.RealtimeRing, see realtimeBarsUpdate
     def __init__(self, ibc, symbol, localSymbol=None):
         self.symbol = symbol
+        self.realtimeRings = {}
         self.localSymbol = localSymbol
         self.ibClient = ibc
         self.ibContract()
@@ -113,6 +118,7 @@ class wContract:
                 fatal.errorAndExit('multiple market rules for a single contract {}'.format(self.details))
         mr = self.ibClient.reqMarketRule(r0)
         self.marketRule = mr
+        self.tickRule = ticks.TickRule(mr)
         penny = False
         if len(self.marketRule) > 1:
             for r in self.marketRule:
@@ -132,19 +138,23 @@ class wContract:
         if self.bidBars == None:
             self.bidBars = self.ibClient.reqRealTimeBars(self.contract, 5, 'BID', False)
             self.bidBars.updateEvent += self.realtimeBarsUpdate
-    # keep just the last minute of midpointBars
+    # the bars are kept in a ring per whatToShow, the list only needs the latest one for the
+    # other handlers of the update
     def realtimeBarsUpdate(self, bb, new):
-        if len(bb) > 12:
-            for i in range(0, len(bb)-12):
-                bb.pop(i)
+        ring = self.realtimeRings.get(bb.whatToShow)
+        if ring is None:
+            ring = self.realtimeRings[bb.whatToShow] = bars.RealtimeRing()
+        ring.update(bb, new)
+        if len(bb) > 1:
+            del bb[:-1]
     def realtimeLowBid(self):
-        return self.bidBars[-1].low
+        return self.realtimeRings['BID'].lastLow()
     def realtimeHighMidpoint(self):
-        return self.midpointBars[-1].high
+        return self.realtimeRings['MIDPOINT'].lastHigh()
     def realtimeLowMidpoint(self):
-        return self.midpointBars[-1].low
+        return self.realtimeRings['MIDPOINT'].lastLow()
     def realtimeMidpoint(self):
-        return self.midpointBars[-1].close
+        return self.realtimeRings['MIDPOINT'].lastClose()
 
     def updatePnl(self, account):
         pnlR = self.ibClient.pnlSingle(account=account, conId=self.contract.conId)
@@ -160,3 +170,23 @@ class wContract:
     def validatePriceIncrement(self):
         if self.details.minTick != self.priceIncrement and len(self.marketRule) < 2:
             fatal.errorAndExit('ticks dont match: {} {}'.format(self.details.minTick, self.priceIncrement))
+
+# the parts of a wContract that a backtest uses, without the ib client so it can be
+# pickled (eg handed to sweep workers)
+class BacktestContract:
+    symbol: str
+    localSymbol: str
+    priceIncrement: float
+    tickRule: ticks.TickRule = None # backtests round on priceIncrement
+    def __init__(self, symbol, localSymbol, priceIncrement):
+        self.symbol = symbol
+        self.localSymbol = localSymbol
+        self.priceIncrement = priceIncrement
+    def __repr__(self):
+        pieces = []
+        for k, v in self.__dict__.items():
+            pieces.append('{}:{}'.format(k, v))
+        return ','.join(pieces)
+
+def backtestContract(wc):
+    return BacktestContract(wc.symbol, wc.localSymbol, wc.priceIncrement)
@@ -1,6 +1,7 @@
 import logging
 import re
 
+from market import cache
 from market import fatal
 
 def dataStreamErrorHandler(reqId, errorCode, errorString, contract):
@@ -28,25 +29,39 @@ def dataStreamErrorHandler(reqId, errorCode, errorString, contract):
 # duration (d) is specified in number of barSizes via lookupDuration
 # FIXME: this kind of sucks
 barSizeToDuration = {'5 secs': {'unit': 'S', 'value': 5}, '1 min': {'unit': 'S', 'value': 60}}
-def getHistData(wc, barSizeStr, longInterval, e='', d=None, t='MIDPOINT', r=False, f=2, k=False):
+#
+# d is in hours, the bars from d hours plus longInterval bars before e up to e.  c is a
+# cache directory (see market/cache.py), used for backtests (d is set).  without a gateway
+# connection (wc is a contract.BacktestContract) only cached bars are returned
+def getHistData(wc, barSizeStr, longInterval, e='', d=None, t='MIDPOINT', r=False, f=2, k=False, c=None):
     duration = barSizeToDuration[barSizeStr]
     if not duration['unit'] or duration['unit'] != 'S' or not duration['value'] or not isinstance(duration['value'], int):
         fatal.errorAndExit('using seconds is supported')
 
-    durationStr = ''
     if d is not None: # doing a backtest, so add the long interval to build the SMA
-        d = d *60*60 + longInterval*duration['value'] # force to seconds, then back up to bar size
-        if d > 86400: # d is in minutes because barSizeToDuration supports minutes atm
-            d = int(d /60/60) if int(d /60/60) > 0 else 1
-            durationStr = str(d) + ' D'
-        else:
-            durationStr = str(d) + ' S'
-    else: # not doing a backtest
-        # add one because when market closed, latest bar is not yet ready (crazy but true)
-        # happens especially when there are two closes (like with the futures maintenace
-        # window)
-        d = 2 * longInterval +1
-        durationStr = str(d *duration['value']) + ' ' + duration['unit']
+        # d hours back from e plus longInterval bars, cached or not the same window of bars
+        end = cache.toEpoch(cache.parseEndDateTime(e))
+        start = end - (d *60*60 + longInterval*duration['value'])
+        fetch = None
+        if getattr(wc, 'ibClient', None) is not None:
+            fetch = lambda endDateTime, durationStr: wc.ibClient.reqHistoricalData(contract=wc.contract, endDateTime=endDateTime, durationStr=durationStr, barSizeSetting=barSizeStr, whatToShow=t, useRTH=r, formatDate=2, keepUpToDate=False)
+        if c is not None:
+            hc = cache.HistCache(c, wc.localSymbol, barSizeStr, duration['value'], t, r)
+            histData = hc.get(wc, start, end, fetch)
+            logging.info('got {} bars for c:{}, e:{}, d:{} from the cache {}'.format(len(histData), wc.localSymbol, e, d, hc))
+            return histData
+        logging.info('getting historical data for c:{}/{}, e:{}, d:{}, b:{}, w:{}, u:{}'.format(wc.symbol, wc.localSymbol, e, d, barSizeStr, t, r))
+        if fetch is None:
+            fatal.errorAndExit('no gateway connection and no cache for {}'.format(wc.localSymbol))
+        end = cache.fullBarsEnd(end, duration['value'])
+        return [bar for ts, bar in sorted(cache.fetchRange(fetch, barSizeStr, start, end, wc.localSymbol), key=lambda f: f[0])]
+
+    # not doing a backtest
+    # add one because when market closed, latest bar is not yet ready (crazy but true)
+    # happens especially when there are two closes (like with the futures maintenace
+    # window)
+    d = 2 * longInterval +1
+    durationStr = str(d *duration['value']) + ' ' + duration['unit']
 
     logging.info('getting historical data for c:{}/{}, e:{}, d:{}, b:{}, w:{}, u:{}, f:{}, k:{}'.format(wc.symbol, wc.localSymbol, e, durationStr, barSizeStr, t, r, f, k))
     histData = wc.ibClient.reqHistoricalData(contract=wc.contract, endDateTime=e, durationStr=durationStr, barSizeSetting=barSizeStr, whatToShow=t, useRTH=r, formatDate=f, keepUpToDate=k)
@@ -72,7 +87,7 @@ def calcSMA(interval, data, startIndex):
         try:
             sma += data[i].close
         except (AttributeError, KeyError):
-            sma += histData[i]
+            sma += data[i]
     return sma/interval
 
 # exponential moving average (higher weighting recent data)
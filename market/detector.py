@@ -1,4 +1,5 @@
 # functions to detect changes which indicate an entry point for various securities
+import collections
 import datetime
 import logging
 import math
@@ -51,22 +52,24 @@ def setupData(wc, conf, backtestArgs=None):
         if conf.detector == 'Crossover':
             dataStore = Crossover(conf.barSizeStr, wc, backtestArgs['shortInterval'], backtestArgs['longInterval'], backtestArgs['watchCount'])
             dataStore.backTest = True
-            dataStream = data.getHistData(wc, barSizeStr=conf.barSizeStr, longInterval=dataStore.longInterval, e=backtestArgs['e'], d=backtestArgs['d'], t=backtestArgs['t'], r=backtestArgs['r'], f=backtestArgs['f'], k=backtestArgs['k'])
+            dataStream = data.getHistData(wc, barSizeStr=conf.barSizeStr, longInterval=dataStore.longInterval, e=backtestArgs['e'], d=backtestArgs['d'], t=backtestArgs['t'], r=backtestArgs['r'], f=backtestArgs['f'], k=backtestArgs['k'], c=backtestArgs.get('c'))
             dataStore.initIndicators(dataStream)
         else:
-            dataStream = data.getHistData(wc, barSizeStr=conf.barSizeStr, longInterval=backtestArgs['longInterval'], e=backtestArgs['e'], d=backtestArgs['d'], t=backtestArgs['t'], r=backtestArgs['r'], f=backtestArgs['f'], k=backtestArgs['k'])
+            dataStream = data.getHistData(wc, barSizeStr=conf.barSizeStr, longInterval=backtestArgs['longInterval'], e=backtestArgs['e'], d=backtestArgs['d'], t=backtestArgs['t'], r=backtestArgs['r'], f=backtestArgs['f'], k=backtestArgs['k'], c=backtestArgs.get('c'))
     elif conf.detector == 'threeBarPattern':
-        dataStream = wc.getTicker()
+        dataStream = bars.TickerBars(wc.getTicker(), data.barSizeToDuration[conf.barSizeStr]['value'])
     elif conf.detector == 'Crossover':
         dataStore = Crossover(conf.barSizeStr, wc, conf.shortEMA, conf.longEMA, conf.watchCount)
 
         # disable wrapper logging to hide the API error for canceling the data every hour
         logging.getLogger('ib_insync.wrapper').setLevel(logging.CRITICAL)
-        logging.warn('ignoring hdms broken errors')
-        wc.ibClient.errorEvent += data.dataStreamErrorHandler
-
-        logging.warn('installing auto restart handler.')
-        wc.ibClient.errorEvent += connectivityError
+        # once per connection, the engine sets up many symbols on one
+        if data.dataStreamErrorHandler not in wc.ibClient.errorEvent:
+            logging.warn('ignoring hdms broken errors')
+            wc.ibClient.errorEvent += data.dataStreamErrorHandler
+        if connectivityError not in wc.ibClient.errorEvent:
+            logging.warn('installing auto restart handler.')
+            wc.ibClient.errorEvent += connectivityError
 
         useRth = False if conf.enterOutsideRth else True
         histData = data.getHistData(wc, barSizeStr=conf.barSizeStr, longInterval=dataStore.longInterval, r=useRth)
@@ -78,35 +81,22 @@ def setupData(wc, conf, backtestArgs=None):
         fatal.errorAndExit('do not know what to do!')
     return dataStore, dataStream
 
-# get the next minute's bar
-def GetNextBar(ticker, sleepFunc):
-    numberOfTicksInBar = 60
-    sleepSecs = 1
-    logging.debug('getting points every 250ms')
-
-    bar = bars.Bar(ticker.marketPrice())
-    for i in range(0, numberOfTicksInBar):
-        sleepFunc(sleepSecs)
-        m = ticker.marketPrice()
-        if m > bar.high:
-            bar.high = m
-        elif m < bar.low:
-            bar.low = m
-    bar.close = ticker.marketPrice()
-    bar.cleanUp()
-    bar.anotate()
+# get the next bar, rolled up from every tick of the ticker (a bars.TickerBars)
+def GetNextBar(tickerBars, sleepFunc):
+    bar = tickerBars.next(sleepFunc)
+    logging.debug('got bar %s', bar)
     return bar
 
 # a three bar pattern is a set of three bars where it's g/r/g or r/g/r
 # indicating a momentum change
-def threeBarPattern(barSet, ticker, sleepFunc):
+def threeBarPattern(barSet, tickerBars, sleepFunc):
     if barSet.first is None and barSet.second is None:
-        barSet.first = GetNextBar(ticker, sleepFunc)
-        barSet.second = GetNextBar(ticker, sleepFunc)
+        barSet.first = GetNextBar(tickerBars, sleepFunc)
+        barSet.second = GetNextBar(tickerBars, sleepFunc)
     else:
         barSet.first = barSet.second
         barSet.second = barSet.third
-    barSet.third = GetNextBar(ticker, sleepFunc)
+    barSet.third = GetNextBar(tickerBars, sleepFunc)
     return barSet.analyze()
 
 from market.contract import wContract
@@ -135,6 +125,11 @@ class Crossover:
     backTest: bool = None
     curEmaIndex: int = None
     byPeriod: int = None # number of days of bars to examine during iterative backtest
+    emaCache = None # indicators.EMACache, backtest only, shares the ema series between runs
+    shortSeries = None # from emaCache
+    longSeries = None
+    aggregator: bars.BarAggregator = None # event driven, rolls the realtime midpoint bars up, see watchRealtimeBars
+    closedBars: collections.deque = None # of bars.Bar, closed and not yet evaluated
 
     def __init__(self, barSizeStr, wContract, shortInterval=None, longInterval=None, watchCount=None):
         if shortInterval is not None:
@@ -190,6 +185,9 @@ class Crossover:
         short = 0
         long_ = 0
         logging.info('datastream is {}'.format(len(dataStream)))
+        if self.backTest and self.emaCache is not None:
+            self.initFromCache(dataStream)
+            return
         for interval in [self.shortInterval, self.longInterval]:
             if self.backTest: # in backtest, we can just start from 0 instead of later
                 sma = 0
@@ -223,14 +221,25 @@ class Crossover:
             elif interval == self.longInterval:
                 long_ = ema
         self.updateIndicators(short, long_)
-    def recalcIndicators(self, dataStream):
-        midpoint = None
+    # same values as the loop in initIndicators/recalcIndicators, read from the shared series
+    def initFromCache(self, dataStream):
+        startIndex = 0
+        if self.byPeriod:
+            startIndex = len(dataStream)-1 - int(self.byPeriod *60*60 /self.barSize)
+        self.curEmaIndex, self.shortSeries, self.longSeries = self.emaCache.crossover(self.shortInterval, self.longInterval, startIndex)
+        self.updateIndicators(float(self.shortSeries[self.curEmaIndex]), float(self.longSeries[self.curEmaIndex]))
+    # midpoint is the close to use in a live run, defaults to the latest realtime midpoint
+    def recalcIndicators(self, dataStream, midpoint=None):
         if self.backTest:
             self.curEmaIndex = self.curEmaIndex + 1
             midpoint = dataStream[self.curEmaIndex].close
             logging.info('recalculating indicators at index {} using price of {}'.format(self.curEmaIndex, midpoint))
+            if self.shortSeries is not None:
+                self.updateIndicators(float(self.shortSeries[self.curEmaIndex]), float(self.longSeries[self.curEmaIndex]))
+                return midpoint
         else:
-            midpoint = self.wContract.realtimeMidpoint()
+            if midpoint is None:
+                midpoint = self.wContract.realtimeMidpoint()
             logging.info('recalculating indicators using market midpoint of {}'.format(midpoint))
 
         if math.isnan(midpoint):
@@ -246,13 +255,20 @@ class Crossover:
     #   if the short-term ema crossed and is above the long-term ema for n (watchCount) intervals
     #       can enter buy side
     #       reverse is sell side
-    def checkForEntry(self, dataStream, sleepFunc=None):
-        if not self.backTest:
+    #
+    # live, sleepFunc waits out a bar first, without it (see checkClosedBar) the caller has
+    # waited for the bar to close and passes its midpoint
+    def checkForEntry(self, dataStream, sleepFunc=None, midpoint=None):
+        if not self.backTest and sleepFunc is not None:
             sleepFunc(self.barSize) # if you change this, be sure to understand the call to data.getHistData and the p argument
 
-        midpoint = self.recalcIndicators(dataStream)
-        lowMidpoint, highMidpoint = self.wContract.realtimeLowMidpoint(), self.wContract.realtimeHighMidpoint()
-        lowBid = self.wContract.realtimeLowBid()
+        midpoint = self.recalcIndicators(dataStream, midpoint)
+        if self.backTest: # no realtime bars during a backtest, use the bar being examined
+            lowMidpoint, highMidpoint = dataStream[self.curEmaIndex].low, dataStream[self.curEmaIndex].high
+            lowBid = lowMidpoint
+        else:
+            lowMidpoint, highMidpoint = self.wContract.realtimeLowMidpoint(), self.wContract.realtimeHighMidpoint()
+            lowBid = self.wContract.realtimeLowBid()
         logging.info('before checks: %s', self)
         if self.count > 0 and self.entryAction == 'BUY' and midpoint < self.long:
             logging.warn('midpoint fell below long ema during buy watch, stopping watch')
@@ -297,3 +313,32 @@ class Crossover:
         elif self.count == self.watchCount and self.entryAction == 'BUY':
             logging.warn('midpoint did not increase over lifespan of watch')
         return None, None
+
+    # event driven instead of sleeping a bar per check: the realtime midpoint bars (after
+    # wContract.realtimeBars) are rolled up into bars of barSize as they arrive, and each
+    # one is evaluated as soon as it closes
+    def watchRealtimeBars(self):
+        self.aggregator = bars.BarAggregator(self.barSize)
+        self.closedBars = collections.deque()
+        self.wContract.midpointBars.updateEvent += self.realtimeBarUpdate
+    def realtimeBarUpdate(self, bb, hasNewBar):
+        if hasNewBar and len(bb) > 0:
+            b = bb[-1]
+            self.closedBars.extend(self.aggregator.add(b.time.timestamp(), 5, b.open_, b.high, b.low, b.close)) # 5 second bars, see wContract.realtimeBars
+    # checkForEntry on the next closed bar, waiting for up to two bars on the ib client for
+    # it to close, returns (None, None) when none did
+    def checkClosedBar(self, ibc):
+        deadline = time.time() + 2 *self.barSize
+        while not self.closedBars and time.time() < deadline:
+            ibc.waitOnUpdate(timeout=deadline - time.time())
+        if not self.closedBars:
+            logging.warn('no bar closed in {} seconds'.format(2 *self.barSize))
+            return None, None
+        bar = self.closedBars.popleft()
+        logging.info('evaluating the bar of {}, {:.3f}s after it closed, {} more waiting'.format(bar.date, time.time() - bar.date.timestamp() - self.barSize, len(self.closedBars)))
+        return self.checkForEntry(None, None, bar.close)
+    # drop the closed bars not evaluated, eg after waiting out a market close
+    def skipClosedBars(self):
+        if self.closedBars:
+            logging.warn('skipping {} closed bars'.format(len(self.closedBars)))
+            self.closedBars.clear()
@@ -0,0 +1,183 @@
+# many symbols in one process: a Crossover per conf on a single ib connection
+#
+# each symbol is a Runner, its Crossover watches the realtime bars (watchRealtimeBars)
+# and the engine loop wakes on every update of the connection to evaluate the bars
+# that closed, so nothing sleeps a bar per symbol.  the symbols share the connection,
+# the account and the event loop, and a symbol that fails is stopped on its own.
+import logging
+from datetime import timedelta
+
+from market import account
+from market import contract
+from market import date
+from market import detector
+from market import journal
+from market import order
+from market import trade
+
+# pendingQty/pendingCost are of entries placed and not yet filled, which the portfolio
+# does not show
+def isMaxQty(p, conf, pendingQty=0, pendingCost=0.0):
+    position = p.position if p is not None else 0
+    if conf.byPrice:
+        # super wonky: avg cost is avg cost per share
+        # .position is share count
+        # dollarAmt is the max we'll spend
+        # openPositions is the number of amounts
+        #  $25 * 4 sh >= $500 * 2
+        avgCost = p.avgCost if p is not None else 0.0
+        return avgCost * position + pendingCost >= conf.dollarAmt * conf.openPositions
+    else:
+        return position + pendingQty >= conf.qty * conf.openPositions
+
+# the quantity and cost of the brackets (trade.BracketTrade) with entries still waiting on
+# a fill.  brackets are in flight until closed resolves, the closed ones are dropped
+def pendingEntries(brackets):
+    brackets[:] = [bt for bt in brackets if not bt.closed.done()]
+    pending = [bt for bt in brackets if bt.state in ('Submitted', 'TimedOut')]
+    qty = sum(bt.entry.remaining() for bt in pending)
+    cost = sum(bt.entry.remaining() * bt.entry.order.lmtPrice for bt in pending)
+    return qty, cost
+
+# the position in wc, of account or any account, see account.PortfolioIndex
+def getPortfolio(wc, accountName=None):
+    return account.portfolioIndex(wc.ibClient).item(wc.contract.conId, accountName)
+
+def outputIfHolding(wc):
+    p = getPortfolio(wc)
+    if p is not None:
+        out = ''
+        if p.position > 0:
+            out += 'holding an open position on {} of {}; '.format(p.contract.symbol, p.position)
+        else:
+            out += 'no open position on {}; '.format(p.contract.symbol)
+        out += 'marketPrice: {} unrealizedPNL: {}, realizedPNL: {}'.format(p.marketPrice, p.unrealizedPNL, p.realizedPNL)
+        logging.warn(out)
+
+# places the bracket for an entry unless the position is full or the funds are short,
+# without waiting on the fill.  returns the trade.BracketTrade (None when not placed,
+# otherwise it is added to brackets, the ones in flight) and the number of errors
+def placeEntry(wc, conf, entryAction, entryPrice, brackets):
+    try:
+        orderDetails = order.OrderDetails(entryPrice, conf, wc, entryAction)
+    except FloatingPointError as e:
+        logging.error('got an NaN during order creation: {} {}'.format(e, entryPrice))
+        return None, 1
+
+    p = getPortfolio(wc, conf.account)
+    if isMaxQty(p, conf, *pendingEntries(brackets)):
+        logging.warn('passing on trade as max positions already open')
+        return None, 0
+
+    orders = order.CreateBracketOrder(orderDetails, conf.account)
+    if not order.adequateFunds(orderDetails, orders):
+        logging.error('not enough funds to place a trade.')
+        return None, 1
+
+    bt = trade.SubmitBracketTrade(orders, orderDetails, conf.fillTimeout)
+    brackets.append(bt)
+    logging.debug(bt.trades)
+    return bt, 0
+
+# the engine's state for one symbol
+class Runner:
+    conf: object # config.Config
+    wc: contract.wContract
+    dataStore: detector.Crossover
+    recorder: journal.Recorder = None
+    totalTrades: int = 0
+    errorCount: int = 0
+    portfolioCheck: object # datetime of the last outputIfHolding
+    brackets: list # trade.BracketTrade in flight until closed, see pendingEntries
+    stopped: str = None # why the runner stopped, None while running
+
+    def __init__(self, ibc, conf, journalDir=None):
+        if conf.detector != 'Crossover':
+            raise ValueError('the engine only runs the Crossover, {} uses {}'.format(conf.symbol, conf.detector))
+        self.conf = conf
+        self.brackets = []
+        self.wc = contract.wContract(ibc, conf.symbol, conf.localSymbol)
+        ibc.reqPnLSingle(account=conf.account, modelCode='', conId=self.wc.contract.conId) # request updates
+        self.dataStore, _ = detector.setupData(self.wc, conf)
+        if journalDir is not None:
+            self.recorder = journal.Recorder(journalDir, self.wc.localSymbol)
+            self.recorder.attach(self.wc)
+        self.dataStore.watchRealtimeBars()
+        self.portfolioCheck = date.nowInUtc()
+        outputIfHolding(self.wc)
+
+    def __repr__(self):
+        return 'symbol:{},localSymbol:{},totalTrades:{},errorCount:{},stopped:{}'.format(self.wc.symbol, self.wc.localSymbol,
+                self.totalTrades, self.errorCount, self.stopped)
+
+    def stop(self, reason):
+        logging.error('stopping {}: {}'.format(self.wc.localSymbol, reason))
+        self.stopped = reason
+        self.dataStore.areWatching = False
+        self.dataStore.skipClosedBars()
+        self.wc.midpointBars.updateEvent -= self.dataStore.realtimeBarUpdate
+
+    def disableWatch(self):
+        self.dataStore.areWatching = False
+        self.dataStore.skipClosedBars()
+
+    # evaluate the bars that closed since the last step, without waiting
+    def step(self):
+        if self.stopped is not None:
+            return
+        while self.dataStore.closedBars and self.stopped is None:
+            bar = self.dataStore.closedBars.popleft()
+            now = date.nowInUtc()
+            if not date.isMarketOpen(self.wc.details):
+                logging.warn('market closed for {}, skipping its bars'.format(self.wc.localSymbol))
+                self.disableWatch()
+                return
+            elif not date.isMarketOpen(self.wc.details, now + timedelta(minutes=self.conf.greyzone)) or date.marketOpenedLessThan(self.wc.details, timedelta(minutes=self.conf.greyzone)):
+                logging.info('{} in the greyzone, only updating the indicators'.format(self.wc.localSymbol))
+                self.dataStore.recalcIndicators(None, bar.close)
+                self.dataStore.areWatching = False
+                continue
+
+            try:
+                entryAction, entryPrice = self.dataStore.checkForEntry(None, None, bar.close)
+            except Exception as e:
+                self.stop('got an exception while checking for an entry: {}'.format(e))
+                return
+            if entryPrice is not None:
+                bt, errors = placeEntry(self.wc, self.conf, entryAction, entryPrice, self.brackets)
+                self.errorCount += errors
+                if bt is not None:
+                    self.totalTrades += 1
+            self.check()
+
+    def check(self):
+        if self.totalTrades >= self.conf.totalTrades:
+            logging.warn('completed total number of trades {}/{} on {}'.format(self.totalTrades, self.conf.totalTrades, self.wc.localSymbol))
+            self.stop('completed total number of trades')
+        elif detector.lossTooHigh(self.wc, self.conf):
+            self.stop('lost too many dollars.  {} {} {}'.format(self.conf.maxLoss, self.wc.pnl, self.conf.account))
+        elif self.errorCount > 10:
+            self.stop('got excess errors')
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+
+# runs the runners until hours have passed or they have all stopped
+def run(ibc, runners, hours=20):
+    startTime = date.nowInUtc()
+    logging.warn('running the engine for {} symbols: {}'.format(len(runners), ', '.join(r.wc.localSymbol for r in runners)))
+    while date.nowInUtc() < startTime + timedelta(hours=hours):
+        running = [r for r in runners if r.stopped is None]
+        if not running:
+            logging.warn('every symbol has stopped, exiting')
+            break
+        ibc.waitOnUpdate(timeout=60)
+        for r in running:
+            r.step()
+            if date.nowInUtc() > r.portfolioCheck + timedelta(minutes=30):
+                r.portfolioCheck = date.nowInUtc()
+                outputIfHolding(r.wc)
+                r.check()
+    for r in runners:
+        logging.warn('engine finished {}'.format(r))
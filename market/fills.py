@@ -0,0 +1,93 @@
+# resolve what happened inside a bar using finer (5 sec) bars
+#
+# a backtest on 1 min bars cannot tell whether the stop or the profit price was hit
+# first when both fall inside one bar (the wonky case in book.PositionBook.check),
+# or whether the stop was hit after the entry filled (backtest.checkTradeExecution).
+# for those bars only, the fine bars covering the minute are found by binary search
+# on their times and replayed in order.
+import logging
+
+import numpy as np
+
+from market import cache
+
+class IntrabarResolver:
+    dates: np.ndarray # start of each fine bar, epoch seconds, sorted
+    high: np.ndarray
+    low: np.ndarray
+    barSize: int # seconds in the bars being resolved
+    lookups: int = 0
+    resolved: int = 0
+
+    def __init__(self, dates, high, low, barSize):
+        self.dates = dates
+        self.high = high
+        self.low = low
+        self.barSize = barSize
+
+    def __repr__(self):
+        return 'bars:{},barSize:{},lookups:{},resolved:{}'.format(len(self.dates), self.barSize, self.lookups, self.resolved)
+
+    # fine bar highs/lows inside the bar starting at start (epoch seconds)
+    def window(self, start):
+        self.lookups += 1
+        i, j = np.searchsorted(self.dates, [start, start + self.barSize])
+        return self.high[i:j], self.low[i:j]
+
+    # which of stop and profit a position on the entryAction side hit first in the bar
+    # starting at start: 'stop', 'profit' or None when the fine bars cannot tell
+    def firstHit(self, start, entryAction, stop, profit):
+        if start is None:
+            return None
+        high, low = self.window(start)
+        if entryAction == 'BUY':
+            stopHit, profitHit = low <= stop, high >= profit
+        else:
+            stopHit, profitHit = high >= stop, low <= profit
+        s = stopHit.argmax() if stopHit.any() else len(high)
+        p = profitHit.argmax() if profitHit.any() else len(high)
+        if s == p: # inside the same fine bar (or no data), still unknown
+            return None
+        self.resolved += 1
+        return 'stop' if s < p else 'profit'
+
+    # whether the stop was hit after the entry limit filled in the bar starting at start
+    # True/False, or None when there are no fine bars for it
+    def stoppedAfterEntry(self, start, entryAction, lmt, stop):
+        if start is None:
+            return None
+        high, low = self.window(start)
+        if len(high) == 0:
+            return None
+        filled = low <= lmt if entryAction == 'BUY' else high >= lmt
+        self.resolved += 1
+        if not filled.any():
+            return False
+        f = filled.argmax()
+        stopped = low[f:] <= stop if entryAction == 'BUY' else high[f:] >= stop
+        return bool(stopped.any())
+
+# bar start as epoch seconds, None when the bar has no date (eg bars.Bar from the live path)
+#   rows of a bars.barDtype array already hold epoch seconds, nan when unknown
+def barStart(bar):
+    d = getattr(bar, 'date', None)
+    if d is None or d != d:
+        return None
+    if hasattr(d, 'timestamp'):
+        return int(d.timestamp())
+    return int(d)
+
+# epoch seconds for each bar of historical data, nan when there is no date
+def toDates(dataStream):
+    if isinstance(dataStream, np.recarray):
+        return dataStream.date.astype(np.float64)
+    return np.fromiter((np.nan if barStart(b) is None else barStart(b) for b in dataStream), dtype=np.float64, count=len(dataStream))
+
+# resolver over the fine bars in the cache, None if nothing is cached
+#   fill the cache first with data.getHistData(barSizeStr='5 secs', ..., c=cacheDir)
+def fromCache(cacheDir, localSymbol, whatToShow, useRth, barSize, fineBarSizeStr='5 secs', fineBarSize=5):
+    hc = cache.HistCache(cacheDir, localSymbol, fineBarSizeStr, fineBarSize, whatToShow, useRth)
+    if hc.bars is None:
+        logging.warn('no {} bars cached for {}, intrabar fills cannot be resolved'.format(fineBarSizeStr, localSymbol))
+        return None
+    return IntrabarResolver(hc.bars['date'], hc.bars['high'], hc.bars['low'], barSize)
@@ -0,0 +1,749 @@
+# a local stand in for the ib gateway, for load and latency testing the live loop
+#
+# speaks enough of the tws api (as ib_insync sends and decodes it, at serverVersion) for
+# connect.connect, contract.wContract, account, data.getHistData and order/trade: the
+# connection handshake and sync, contract details and market rules, historical data,
+# realtime bars and market data ticks, bracket orders filled against the bars, what if
+# margin, account values/summary, the portfolio and pnlSingle.
+#
+# every contract gets a feed of scripted 5 second midpoint bars, a synthetic.randomWalk
+# or the midpoint records of a journal (see market/journal.py).  the first part of a
+# feed is history (for reqHistoricalData), the rest is streamed at rate bars per second
+# to every realtime bar and market data subscriber, so the market clock can run faster
+# than the wall clock.  the time from the last bar written to a connection to an entry
+# order coming back on it is kept as the signal to order latency.
+import asyncio
+from datetime import datetime, timezone
+import logging
+import os
+import statistics
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from market import bars
+from market import bench
+from market import cache
+from market import journal
+from market import synthetic
+
+serverVersion = 176 # the highest ib_insync speaks
+defaultPort = 4002 # connect.getPort for paper, so autoOrder runs against it unchanged
+defaultAccount = 'DU000000'
+
+# price increment, multiplier, price, initial margin per contract
+futures = {'ES': (0.25, 50, 3000.0, 12000.0), 'NQ': (0.25, 20, 12000.0, 16000.0)}
+stockPrice = 100.0
+stockMargin = 0.5 # reg t, of the value
+
+# seconds per bar size setting unit, and per duration unit
+barSizeUnits = {'sec': 1, 'secs': 1, 'min': 60, 'mins': 60, 'hour': 3600, 'hours': 3600, 'day': 86400}
+durationUnits = {'S': 1, 'D': 86400, 'W': 7*86400}
+
+class Instrument:
+    conId: int
+    symbol: str
+    localSymbol: str
+    secType: str
+    exchange: str
+    primaryExchange: str
+    currency: str = 'USD'
+    multiplier: int = 1
+    minTick: float
+    marketRuleId: int
+    price: float
+    margin: float # per contract (or per share of price for stocks)
+    timeZoneId: str
+
+    def __init__(self, symbol, localSymbol, secType, exchange, primaryExchange=''):
+        self.symbol = symbol
+        self.localSymbol = localSymbol
+        self.secType = secType
+        self.exchange = exchange
+        self.primaryExchange = primaryExchange
+        self.conId = zlib.crc32(localSymbol.encode()) & 0x7fffffff
+        if secType == 'FUT':
+            self.minTick, self.multiplier, self.price, self.margin = futures[symbol]
+            self.timeZoneId = 'US/Central'
+            self.marketRuleId = 67
+        else:
+            self.minTick, self.price, self.margin = 0.01, stockPrice, stockMargin *stockPrice
+            self.timeZoneId = 'US/Eastern'
+            self.marketRuleId = 26
+
+    def __repr__(self):
+        pieces = []
+        for k, v in self.__dict__.items():
+            pieces.append('{}:{}'.format(k, v))
+        return ','.join(pieces)
+
+    # the 12 fields ib_insync sends for a contract
+    def fields(self):
+        return [self.conId, self.symbol, self.secType, '', 0.0, '', self.multiplier, self.exchange,
+                self.primaryExchange, self.currency, self.localSymbol, self.localSymbol]
+
+    # open the week around now and the week after, two ranges as date.marketOpenedLessThan
+    # insists on more than one
+    def tradingHours(self, now):
+        day = 86400
+        days = [datetime.fromtimestamp(now + d *day, timezone.utc).strftime('%Y%m%d') for d in [-7, 7, 8, 15]]
+        return '{}:0000-{}:0000;{}:0000-{}:0000'.format(days[0], days[1], days[2], days[3])
+
+# 5 second midpoint bars of an instrument, history up to cursor, the rest still to come
+class Feed:
+    instrument: Instrument
+    rows: np.recarray # bars.barDtype
+    cursor: int # first row not yet streamed
+
+    def __init__(self, instrument, rows, cursor):
+        self.instrument = instrument
+        self.rows = rows
+        self.cursor = cursor
+
+    def __repr__(self):
+        return 'localSymbol:{},streamed:{}/{}'.format(self.instrument.localSymbol, self.cursor, len(self.rows))
+
+    def finished(self):
+        return self.cursor >= len(self.rows)
+
+    # the market clock, start of the next bar
+    def clock(self):
+        if self.finished():
+            return float(self.rows.date[-1]) + journal.realtimeBarSize
+        return float(self.rows.date[self.cursor])
+
+    def next(self):
+        row = self.rows[self.cursor]
+        self.cursor += 1
+        return row
+
+    # streamed bars from end - duration up to end, rolled up into bars of barSize seconds
+    # returns (start, open, high, low, close) arrays
+    def rollUp(self, barSize, duration, end=None):
+        end = self.clock() if end is None else end
+        date = self.rows.date[:self.cursor]
+        first, stop = np.searchsorted(date, [end - duration, end])
+        rows = self.rows[first:stop]
+        if len(rows) == 0:
+            return np.empty(0), np.empty(0), np.empty(0), np.empty(0), np.empty(0)
+        starts = rows.date - rows.date % barSize
+        idx = np.concatenate([[0], np.flatnonzero(np.diff(starts)) + 1])
+        last = np.concatenate([idx[1:] - 1, [len(rows) - 1]])
+        return (starts[idx], rows.open[idx], np.maximum.reduceat(rows.high, idx),
+                np.minimum.reduceat(rows.low, idx), rows.close[last])
+
+# a synthetic feed, history bars before start and hours of bars from it
+def syntheticFeed(instrument, start, history, hours, seed=None):
+    n = history + int(hours *3600 /journal.realtimeBarSize)
+    walk = synthetic.randomWalk(n, seed, instrument.price, instrument.minTick, barSize=journal.realtimeBarSize,
+            regimeLength=720, startTime=int(start) - history *journal.realtimeBarSize)
+    return Feed(instrument, bars.toBarArray(walk), history)
+
+# a feed of the midpoint records of a journal, restamped so its history ends at start
+def journalFeed(instrument, records, start, history):
+    mid = records[records.kind == journal.kinds['MIDPOINT']]
+    history = min(history, len(mid) //2)
+    date = start + (np.arange(len(mid)) - history) *journal.realtimeBarSize
+    rows = bars.fromColumns(date.astype(np.float64), mid.open_, mid.high, mid.low, mid.close)
+    return Feed(instrument, rows, history)
+
+class Order:
+    orderId: int
+    clientId: int
+    permId: int
+    conId: int
+    account: str
+    action: str
+    qty: float
+    orderType: str
+    lmtPrice: float
+    auxPrice: float
+    trailingPercent: float
+    parentId: int
+    transmit: bool
+    status: str = None
+    filled: float = 0.0
+    avgFillPrice: float = 0.0
+    extreme: float = None # best price since a TRAIL became active
+    session: object = None
+
+    def __repr__(self):
+        pieces = []
+        for k, v in self.__dict__.items():
+            if k != 'session':
+                pieces.append('{}:{}'.format(k, v))
+        return ','.join(pieces)
+
+    # the price it fills at in a bar, None if it does not
+    def fillPrice(self, bar):
+        buy = self.action == 'BUY'
+        if self.orderType == 'MKT':
+            return bar.open
+        elif self.orderType in ['LMT', 'LOC']:
+            if buy and bar.low <= self.lmtPrice:
+                return min(self.lmtPrice, bar.open)
+            elif not buy and bar.high >= self.lmtPrice:
+                return max(self.lmtPrice, bar.open)
+        elif self.orderType == 'STP':
+            if buy and bar.high >= self.auxPrice:
+                return max(self.auxPrice, bar.open)
+            elif not buy and bar.low <= self.auxPrice:
+                return min(self.auxPrice, bar.open)
+        elif self.orderType == 'TRAIL':
+            # checked against the stop trailed up to the last bar, then trailed
+            stop = self.trailStop()
+            if stop is not None:
+                if buy and bar.high >= stop:
+                    return max(stop, bar.open)
+                elif not buy and bar.low <= stop:
+                    return min(stop, bar.open)
+            self.extreme = (bar.low if buy else bar.high) if self.extreme is None else (min(self.extreme, bar.low) if buy else max(self.extreme, bar.high))
+        return None
+
+    def trailStop(self):
+        if self.extreme is None:
+            return None
+        offset = self.extreme *self.trailingPercent /100.0 if self.trailingPercent else self.auxPrice
+        return self.extreme + offset if self.action == 'BUY' else self.extreme - offset
+
+class Position:
+    qty: float = 0.0
+    avgPrice: float = 0.0
+    realized: float = 0.0
+    marketPrice: float = 0.0
+
+    def __repr__(self):
+        return 'qty:{},avgPrice:{},realized:{},marketPrice:{}'.format(self.qty, self.avgPrice, self.realized, self.marketPrice)
+
+    def fill(self, qty, price, multiplier):
+        if self.qty == 0 or (self.qty > 0) == (qty > 0): # opening or adding
+            self.avgPrice = (self.avgPrice *self.qty + price *qty) /(self.qty + qty)
+            self.qty += qty
+            return
+        closed = min(abs(qty), abs(self.qty)) *(1 if self.qty > 0 else -1)
+        self.realized += (price - self.avgPrice) *closed *multiplier
+        self.qty += qty
+        if self.qty == 0:
+            self.avgPrice = 0.0
+        elif (self.qty > 0) == (qty > 0): # flipped
+            self.avgPrice = price
+
+    def unrealized(self, multiplier):
+        return (self.marketPrice - self.avgPrice) *self.qty *multiplier
+
+# a placeOrder message (non BAG contracts) walked the way client.placeOrder builds it
+def parseOrder(fields):
+    get = iter(fields[1:]).__next__
+    def skip(n):
+        for _ in range(n):
+            get()
+    o = Order()
+    o.orderId = int(get())
+    contract = [get() for _ in range(12)]
+    skip(2) # secIdType, secId
+    o.action, o.qty, o.orderType = get(), float(get()), get()
+    o.lmtPrice, o.auxPrice = float(get() or 0), float(get() or 0)
+    skip(2) # tif, ocaGroup
+    o.account = get()
+    skip(3) # openClose, origin, orderRef
+    o.transmit, o.parentId = get() == '1', int(get() or 0)
+    skip(6 + 30) # blockOrder .. hidden, '', discretionaryAmt .. volatilityType
+    if get(): # deltaNeutralOrderType
+        skip(1 + 8)
+    else:
+        skip(1)
+    skip(3) # continuousUpdate, referencePriceType, trailStopPrice
+    o.trailingPercent = float(get() or 0)
+    skip(2) # scaleInitLevelSize, scaleSubsLevelSize
+    increment = get()
+    if increment and 0 < float(increment) < 1.7976931348623157e308:
+        skip(7)
+    skip(3) # scaleTable, activeStartTime, activeStopTime
+    if get(): # hedgeType
+        skip(1)
+    skip(4) # optOutSmartRouting, clearingAccount, clearingIntent, notHeld
+    if get() == '1': # deltaNeutralContract
+        skip(3)
+    if get(): # algoStrategy
+        skip(2 *int(get()))
+    skip(1) # algoId
+    whatIf = get() == '1'
+    return o, contract, whatIf
+
+# one api connection
+class Session:
+    gateway: object
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    clientId: int = None
+    realtimeBars: dict # reqId to (conId, whatToShow)
+    mktData: dict # reqId to conId
+    pnlSingle: dict # reqId to (account, conId)
+    accountUpdates: str = None # the account subscribed to with reqAccountUpdates
+    lastBar: dict # conId to when the last bar of it was written
+
+    def __init__(self, gateway, reader, writer):
+        self.gateway = gateway
+        self.reader = reader
+        self.writer = writer
+        self.realtimeBars = {}
+        self.mktData = {}
+        self.pnlSingle = {}
+        self.lastBar = {}
+
+    def __repr__(self):
+        return 'clientId:{},realtimeBars:{},mktData:{},pnlSingle:{}'.format(self.clientId, len(self.realtimeBars), len(self.mktData), len(self.pnlSingle))
+
+    def send(self, *fields):
+        msg = ''.join('{}\0'.format(f) for f in fields).encode()
+        self.writer.write(struct.pack('>I', len(msg)) + msg)
+
+    def error(self, reqId, code, text):
+        self.send(4, 2, reqId, code, text, '')
+
+    async def readMsg(self):
+        size = struct.unpack('>I', await self.reader.readexactly(4))[0]
+        return (await self.reader.readexactly(size)).decode(errors='backslashreplace').split('\0')[:-1]
+
+    async def run(self):
+        if await self.reader.readexactly(4) != b'API\0':
+            return
+        versions = await self.readMsg() # v157..176
+        logging.info('client versions {}'.format(versions))
+        self.send(serverVersion, datetime.now(timezone.utc).strftime('%Y%m%d %H:%M:%S UTC'))
+        while True:
+            fields = await self.readMsg()
+            if not fields:
+                continue
+            handler = self.gateway.handlers.get(int(fields[0]))
+            if handler is None:
+                logging.info('ignoring message {}'.format(fields))
+                continue
+            carryOn = handler(self, fields)
+            await self.writer.drain()
+            if carryOn == False:
+                break
+
+class FakeGateway:
+    port: int
+    rate: float # realtime bars (5 seconds of market) streamed per second
+    accounts: list
+    funds: float # starting equity of each account
+    history: int # 5 second bars of history before the stream starts
+    hours: float # of synthetic bars to stream
+    journalDir: str = None # feeds from the newest journal of a contract, when there is one
+    seed: int = None
+    start: float # the market clock the stream starts at
+    sessions: dict # clientId to Session
+    instruments: dict # conId to Instrument
+    feeds: dict # conId to Feed
+    orders: dict # permId to Order
+    positions: dict # (account, conId) to Position
+    latencies: list # seconds from the last bar to an entry order
+    nextPermId: int = 1
+
+    def __init__(self, port=defaultPort, rate=0.2, accounts=None, funds=1000000.0, history=17280, hours=24, journalDir=None, seed=None):
+        self.port = port
+        self.rate = rate
+        self.accounts = accounts or [defaultAccount]
+        self.funds = funds
+        self.history = history
+        self.hours = hours
+        self.journalDir = journalDir
+        self.seed = seed
+        self.start = time.time() //journal.realtimeBarSize *journal.realtimeBarSize
+        self.sessions = {}
+        self.instruments = {}
+        self.feeds = {}
+        self.orders = {}
+        self.positions = {}
+        self.latencies = []
+        self.handlers = {
+            71: self.startApi,
+            61: self.reqPositions,
+            5: self.reqOpenOrders,
+            99: self.reqCompletedOrders,
+            6: self.reqAccountUpdates,
+            76: self.reqAccountUpdatesMulti,
+            7: self.reqExecutions,
+            8: self.reqIds,
+            49: self.reqCurrentTime,
+            9: self.reqContractDetails,
+            91: self.reqMarketRule,
+            20: self.reqHistoricalData,
+            50: self.reqRealTimeBars,
+            51: self.cancelRealTimeBars,
+            1: self.reqMktData,
+            2: self.cancelMktData,
+            62: self.reqAccountSummary,
+            94: self.reqPnLSingle,
+            95: self.cancelPnLSingle,
+            3: self.placeOrder,
+            4: self.cancelOrder,
+        }
+
+    def __repr__(self):
+        return 'port:{},rate:{},sessions:{},feeds:{},orders:{}'.format(self.port, self.rate, len(self.sessions), list(self.feeds.values()), len(self.orders))
+
+    # Instrument for the 12 contract fields of a request, None if there is no such contract
+    def instrument(self, fields):
+        conId, symbol, secType, localSymbol = int(fields[0] or 0), fields[1], fields[2], fields[10]
+        if conId:
+            return self.instruments.get(conId)
+        if secType == 'FUT' and symbol in futures and localSymbol:
+            i = Instrument(symbol, localSymbol, 'FUT', 'GLOBEX')
+        elif secType == 'STK' and symbol:
+            i = Instrument(symbol, symbol, 'STK', fields[7] or 'SMART', fields[8] or 'NASDAQ')
+        else:
+            return None
+        i = self.instruments.setdefault(i.conId, i)
+        self.feed(i)
+        return i
+
+    def feed(self, i):
+        if i.conId not in self.feeds:
+            path = self.newestJournal(i.localSymbol)
+            if path is not None:
+                logging.warn('feeding {} from {}'.format(i.localSymbol, path))
+                self.feeds[i.conId] = journalFeed(i, journal.read(path), self.start, self.history)
+            else:
+                seed = None if self.seed is None else self.seed + i.conId
+                self.feeds[i.conId] = syntheticFeed(i, self.start, self.history, self.hours, seed)
+        return self.feeds[i.conId]
+
+    def newestJournal(self, localSymbol):
+        if self.journalDir is None:
+            return None
+        d = os.path.join(self.journalDir, localSymbol)
+        paths = sorted(p for p in os.listdir(d) if p.endswith('.rtbj')) if os.path.isdir(d) else []
+        return os.path.join(d, paths[-1]) if paths else None
+
+    def startApi(self, s, fields):
+        clientId = int(fields[2])
+        if clientId in self.sessions:
+            s.error(-1, 326, 'Unable to connect as the client id is already in use. Retry with a unique client id.')
+            return False
+        s.clientId = clientId
+        self.sessions[clientId] = s
+        logging.warn('client {} connected, {} connections'.format(clientId, len(self.sessions)))
+        s.send(15, 1, ','.join(self.accounts))
+        s.send(9, 1, max([1] + [o.orderId + 1 for o in self.orders.values() if o.clientId == clientId]))
+
+    def reqPositions(self, s, fields):
+        for (account, conId), p in self.positions.items():
+            if p.qty != 0:
+                i = self.instruments[conId]
+                c = i.fields()
+                s.send(61, 3, account, *c[:8], *c[9:], p.qty, p.avgPrice *i.multiplier)
+        s.send(62, 1)
+
+    def reqOpenOrders(self, s, fields):
+        s.send(53, 1)
+
+    def reqCompletedOrders(self, s, fields):
+        s.send(102)
+
+    def reqExecutions(self, s, fields):
+        s.send(55, 1, fields[2])
+
+    def reqIds(self, s, fields):
+        s.send(9, 1, max([1] + [o.orderId + 1 for o in self.orders.values() if o.clientId == s.clientId]))
+
+    def reqCurrentTime(self, s, fields):
+        s.send(49, 1, int(time.time()))
+
+    def reqContractDetails(self, s, fields):
+        reqId = fields[2]
+        i = self.instrument(fields[3:15])
+        if i is None:
+            s.error(reqId, 200, 'No security definition has been found for the request')
+            return
+        hours = i.tradingHours(time.time())
+        s.send(10, reqId, i.symbol, i.secType, '', 0.0, '', i.exchange, i.currency, i.localSymbol, i.localSymbol,
+                i.localSymbol, i.conId, i.minTick, i.multiplier, 'LMT,MKT,STP,TRAIL', i.exchange, 1, 0, i.symbol,
+                i.primaryExchange, '', '', '', '', i.timeZoneId, hours, hours, '', '', 0,
+                1, i.symbol, '', i.marketRuleId, '', '', 1, 1, 1)
+        s.send(52, 1, reqId)
+
+    def reqMarketRule(self, s, fields):
+        ruleId = int(fields[1])
+        increment = {i.marketRuleId: i.minTick for i in self.instruments.values()}.get(ruleId, 0.01)
+        s.send(93, ruleId, 1, 0, increment)
+
+    def reqHistoricalData(self, s, fields):
+        reqId = fields[1]
+        i = self.instrument(fields[2:14])
+        if i is None:
+            s.error(reqId, 200, 'No security definition has been found for the request')
+            return
+        endDateTime, barSizeSetting, durationStr, formatDate = fields[15], fields[16], fields[17], fields[20]
+        feed = self.feeds[i.conId]
+        n, unit = barSizeSetting.split()
+        barSize = int(n) *barSizeUnits[unit]
+        n, unit = durationStr.split()
+        duration = int(n) *durationUnits[unit]
+        end = cache.toEpoch(cache.parseEndDateTime(endDateTime)) if endDateTime else None
+        starts, opens, highs, lows, closes = feed.rollUp(barSize, duration, end)
+        rows = []
+        for t, o, h, l, c in zip(starts, opens, highs, lows, closes):
+            date = int(t) if formatDate == '2' else datetime.fromtimestamp(t, timezone.utc).strftime('%Y%m%d  %H:%M:%S')
+            rows += [date, o, h, l, c, -1, -1, -1]
+        end = feed.clock() if end is None else end
+        s.send(17, reqId, datetime.fromtimestamp(end - duration, timezone.utc).strftime('%Y%m%d  %H:%M:%S'),
+                datetime.fromtimestamp(end, timezone.utc).strftime('%Y%m%d  %H:%M:%S'), len(starts), *rows)
+
+    def reqRealTimeBars(self, s, fields):
+        reqId = int(fields[2])
+        i = self.instrument(fields[3:15])
+        if i is None:
+            s.error(reqId, 200, 'No security definition has been found for the request')
+            return
+        s.realtimeBars[reqId] = (i.conId, fields[16])
+
+    def cancelRealTimeBars(self, s, fields):
+        s.realtimeBars.pop(int(fields[2]), None)
+
+    def reqMktData(self, s, fields):
+        reqId = int(fields[2])
+        i = self.instrument(fields[3:15])
+        if i is None:
+            s.error(reqId, 200, 'No security definition has been found for the request')
+            return
+        snapshot = fields[17 if fields[15] == '0' else 20] == '1'
+        feed = self.feeds[i.conId]
+        if feed.cursor > 0:
+            self.sendTicks(s, reqId, i, feed.rows[feed.cursor-1])
+        if snapshot:
+            s.send(57, 1, reqId)
+        else:
+            s.mktData[reqId] = i.conId
+
+    def cancelMktData(self, s, fields):
+        s.mktData.pop(int(fields[2]), None)
+
+    def sendTicks(self, s, reqId, i, row):
+        half = i.minTick /2
+        s.send(1, 6, reqId, 1, row.close - half, 1, 0) # bid
+        s.send(1, 6, reqId, 2, row.close + half, 1, 0) # ask
+        s.send(1, 6, reqId, 4, row.close, 1, 0) # last
+
+    # account values by tag for an account, from the positions marked to the last bar
+    def accountValues(self, account):
+        equity, margin = self.funds, 0.0
+        for (a, conId), p in self.positions.items():
+            if a == account:
+                i = self.instruments[conId]
+                equity += p.realized + p.unrealized(i.multiplier)
+                margin += abs(p.qty) *(i.margin if i.secType == 'FUT' else stockMargin *p.marketPrice)
+        available = equity - margin
+        return {'NetLiquidation': equity, 'EquityWithLoanValue': equity, 'InitMarginReq': margin,
+                'AvailableFunds': available, 'BuyingPower': 4 *available, 'TotalCashValue': equity}
+
+    def sendAccount(self, s, account):
+        for tag, value in self.accountValues(account).items():
+            s.send(6, 2, tag, value, 'USD', account)
+        for (a, conId), p in self.positions.items():
+            if a == account:
+                i = self.instruments[conId]
+                c = i.fields()
+                s.send(7, 8, *c[:7], c[8], *c[9:], p.qty, p.marketPrice, p.qty *p.marketPrice *i.multiplier,
+                        p.avgPrice *i.multiplier, p.unrealized(i.multiplier), p.realized, account)
+        s.send(8, 1, datetime.now(timezone.utc).strftime('%H:%M'))
+
+    def reqAccountUpdates(self, s, fields):
+        account = fields[3]
+        if fields[2] != '1':
+            s.accountUpdates = None
+            return
+        s.accountUpdates = account
+        self.sendAccount(s, account)
+        s.send(54, 1, account)
+
+    def reqAccountUpdatesMulti(self, s, fields):
+        reqId, account = fields[2], fields[3]
+        for tag, value in self.accountValues(account).items():
+            s.send(73, 1, reqId, account, '', tag, value, 'USD')
+        s.send(74, 1, reqId)
+
+    def reqAccountSummary(self, s, fields):
+        reqId = fields[2]
+        for account in self.accounts:
+            for tag, value in self.accountValues(account).items():
+                s.send(63, 1, reqId, account, tag, value, 'USD')
+        s.send(64, 1, reqId)
+
+    def sendPnl(self, s, reqId, account, conId):
+        p = self.positions.get((account, conId), Position())
+        i = self.instruments.get(conId)
+        multiplier = i.multiplier if i is not None else 1
+        unrealized = p.unrealized(multiplier)
+        s.send(95, reqId, p.qty, p.realized + unrealized, unrealized, p.realized, p.qty *p.marketPrice *multiplier)
+
+    def reqPnLSingle(self, s, fields):
+        reqId, account, conId = int(fields[1]), fields[2], int(fields[4])
+        s.pnlSingle[reqId] = (account, conId)
+        self.sendPnl(s, reqId, account, conId)
+
+    def cancelPnLSingle(self, s, fields):
+        s.pnlSingle.pop(int(fields[1]), None)
+
+    def placeOrder(self, s, fields):
+        received = time.time()
+        try:
+            o, contract, whatIf = parseOrder(fields)
+        except (StopIteration, ValueError) as e:
+            logging.error('could not parse an order {}: {}'.format(e, fields))
+            s.error(int(fields[1]), 321, 'Error validating request: the fake gateway could not parse the order')
+            return
+        i = self.instrument(contract)
+        if i is None:
+            s.error(o.orderId, 200, 'No security definition has been found for the request')
+            return
+        o.account = o.account or self.accounts[0]
+        o.conId, o.clientId, o.session = i.conId, s.clientId, s
+        if whatIf:
+            self.whatIf(s, o, i)
+            return
+        if o.parentId == 0 and i.conId in s.lastBar:
+            latency = received - s.lastBar[i.conId]
+            self.latencies.append(latency)
+            logging.warn('entry order {} from client {} {:.3f}s after the last bar'.format(o.orderId, s.clientId, latency))
+        o.permId = self.nextPermId
+        self.nextPermId += 1
+        self.orders[o.permId] = o
+        if o.transmit: # the bracket is complete, release it
+            for held in self.bracket(o):
+                self.setStatus(held, 'PreSubmitted' if self.parentOpen(held) else 'Submitted')
+
+    # the order, its parent and the parent's other children
+    def bracket(self, o):
+        parentId = o.parentId or o.orderId
+        return [b for b in self.orders.values() if b.clientId == o.clientId and (b.orderId == parentId or b.parentId == parentId)]
+
+    def parentOpen(self, o):
+        for b in self.orders.values():
+            if o.parentId and b.clientId == o.clientId and b.orderId == o.parentId:
+                return b.status != 'Filled'
+        return False
+
+    def whatIf(self, s, o, i):
+        values = self.accountValues(o.account)
+        before = values['InitMarginReq']
+        change = o.qty *(i.margin if i.secType == 'FUT' else stockMargin *(o.lmtPrice or i.price))
+        equity = values['EquityWithLoanValue']
+        c = i.fields()
+        s.send(5, o.orderId, *c[:8], *c[9:], o.action, o.qty, o.orderType, o.lmtPrice, o.auxPrice, '', '', o.account,
+                '', '', '', o.clientId, 0, *([''] *32), o.parentId, *([''] *5),
+                *([''] *7), 0, 0, 0, '', '', '', '', '', '', '', '', 0, '',
+                '', 1, 'PreSubmitted', before, before, equity, change, change, 0.0, before + change, before + change, equity,
+                '', '', '', '', '', '', '', 0, *([''] *16), '', '', '', *([''] *5))
+
+    def setStatus(self, o, status):
+        o.status = status
+        if o.session is None or o.session.writer.is_closing():
+            return
+        o.session.send(3, o.orderId, status, o.filled, o.qty - o.filled, o.avgFillPrice, o.permId, o.parentId,
+                o.avgFillPrice, o.clientId, '', 0.0)
+
+    def cancelOrder(self, s, fields):
+        orderId = int(fields[2])
+        for o in list(self.orders.values()):
+            if o.clientId == s.clientId and o.orderId == orderId and o.status not in ['Filled', 'Cancelled']:
+                self.setStatus(o, 'Cancelled')
+                for child in self.bracket(o):
+                    if child.parentId == orderId and child.status not in ['Filled', 'Cancelled']:
+                        self.setStatus(child, 'Cancelled')
+
+    # fill the working orders of an instrument against a bar
+    def match(self, i, row):
+        working = [o for o in self.orders.values() if o.conId == i.conId and o.status == 'Submitted']
+        for o in working:
+            if o.status != 'Submitted': # cancelled by a sibling filling in this bar
+                continue
+            price = o.fillPrice(row)
+            if price is None:
+                continue
+            o.filled, o.avgFillPrice = o.qty, float(price)
+            p = self.positions.setdefault((o.account, i.conId), Position())
+            p.fill(o.qty if o.action == 'BUY' else -o.qty, o.avgFillPrice, i.multiplier)
+            p.marketPrice = float(row.close)
+            self.setStatus(o, 'Filled')
+            logging.info('filled {}'.format(o))
+            for b in self.bracket(o):
+                if b is o or b.status in ['Filled', 'Cancelled']:
+                    continue
+                if b.parentId == o.orderId: # children of a filled entry go live from the next bar
+                    self.setStatus(b, 'Submitted')
+                elif o.parentId and b.parentId == o.parentId: # the other exits, one cancels all
+                    self.setStatus(b, 'Cancelled')
+            s = o.session
+            if s is not None and s.accountUpdates == o.account and not s.writer.is_closing():
+                self.sendAccount(s, o.account)
+
+    # stream the next bar of every feed
+    def step(self):
+        now = time.time()
+        for conId, feed in self.feeds.items():
+            if feed.finished():
+                continue
+            row = feed.next()
+            i = feed.instrument
+            for p in [p for (a, c), p in self.positions.items() if c == conId]:
+                p.marketPrice = float(row.close)
+            self.match(i, row)
+            half = i.minTick /2
+            for s in list(self.sessions.values()):
+                if s.writer.is_closing():
+                    continue
+                for reqId, (c, whatToShow) in s.realtimeBars.items():
+                    if c == conId:
+                        shift = -half if whatToShow == 'BID' else half if whatToShow == 'ASK' else 0.0
+                        s.send(50, 3, reqId, int(row.date), row.open + shift, row.high + shift, row.low + shift, row.close + shift, -1, -1, -1)
+                        s.lastBar[conId] = now
+                for reqId, c in s.mktData.items():
+                    if c == conId:
+                        self.sendTicks(s, reqId, i, row)
+                for reqId, (account, c) in s.pnlSingle.items():
+                    if c == conId:
+                        self.sendPnl(s, reqId, account, conId)
+
+    async def clock(self):
+        started = time.perf_counter()
+        steps = 0
+        while True:
+            steps += 1
+            await asyncio.sleep(max(0.0, started + steps /self.rate - time.perf_counter()))
+            self.step()
+
+    async def connected(self, reader, writer):
+        s = Session(self, reader, writer)
+        try:
+            await s.run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if s.clientId is not None and self.sessions.get(s.clientId) is s:
+                del self.sessions[s.clientId]
+                logging.warn('client {} disconnected, {} connections'.format(s.clientId, len(self.sessions)))
+            writer.close()
+
+    def latencyStats(self):
+        if not self.latencies:
+            return None
+        return {'orders': len(self.latencies), 'mean': statistics.mean(self.latencies), 'p50': bench.percentile(self.latencies, 50),
+                'p95': bench.percentile(self.latencies, 95), 'max': max(self.latencies)}
+
+    async def serve(self, host='127.0.0.1'):
+        server = await asyncio.start_server(self.connected, host, self.port)
+        logging.warn('fake gateway listening on {}:{}, streaming {} bars/s'.format(host, self.port, self.rate))
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.clock())
+
+    def run(self, host='127.0.0.1'):
+        try:
+            asyncio.run(self.serve(host))
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        logging.warn('signal to order latency: {}'.format(self.latencyStats()))
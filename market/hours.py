@@ -0,0 +1,148 @@
+# trading hours as sorted epoch arrays, parsed once per contract details
+#
+# date.isMarketOpen and friends used to parse the month of sessions in the details
+# (split, regex, strptime, localize, a DateTimeRange each) on every call and then scan
+# them.  a Calendar holds the session starts and ends in epoch seconds and answers by
+# binary search, and calendar() keeps one per conId until its hours or time zone change.
+#
+# calendars combine with intersect (eg the hours both the LSE and NASDAQ are open, for
+# the LSE listed lines against US hours) and union, a linear sweep over the sorted
+# sessions so years of them are cheap to combine for backtests.
+from bisect import bisect_right
+from datetime import datetime
+import heapq
+
+from datetimerange import DateTimeRange
+import pytz
+
+from market import fatal
+
+class Calendar:
+    __slots__ = ('starts', 'ends')
+    starts: list # epoch seconds, sorted
+    ends: list # epoch seconds, a session is open from its start to its end inclusive (as DateTimeRange)
+
+    def __init__(self, starts, ends):
+        self.starts = starts
+        self.ends = ends
+
+    def __repr__(self):
+        return 'sessions:{},first:{},last:{}'.format(len(self.starts),
+                utc(self.starts[0]) if self.starts else None, utc(self.ends[-1]) if self.ends else None)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # index of the session open at t (epoch), None when closed
+    def session(self, t):
+        i = bisect_right(self.starts, t) - 1
+        if i >= 0 and t <= self.ends[i]:
+            return i
+        return None
+
+    def isOpen(self, t):
+        return self.session(t) is not None
+
+    # end of the session open at t, None when closed
+    def nextClose(self, t):
+        i = self.session(t)
+        return None if i is None else self.ends[i]
+
+    # start of the session open at t, None when closed
+    def openedAt(self, t):
+        i = self.session(t)
+        return None if i is None else self.starts[i]
+
+    # open at t, and opened less than seconds before it
+    def openedLessThan(self, t, seconds):
+        i = self.session(t)
+        return i is not None and t - seconds < self.starts[i]
+
+    # t when open at t, otherwise the start of the next session, None when there is none
+    def nextOpen(self, t):
+        i = bisect_right(self.starts, t)
+        if i > 0 and t <= self.ends[i-1]:
+            return t
+        return self.starts[i] if i < len(self.starts) else None
+
+    def ranges(self):
+        return [DateTimeRange(utc(s), utc(e)) for s, e in zip(self.starts, self.ends)]
+
+# from a list of DateTimeRange, as date.openHours makes
+def fromRanges(ranges):
+    sessions = sorted((r.start_datetime.timestamp(), r.end_datetime.timestamp()) for r in ranges)
+    return Calendar([s for s, e in sessions], [e for s, e in sessions])
+
+# the times all of the calendars are open, sessions of no length are dropped
+def intersect(*calendars):
+    if not calendars:
+        return Calendar([], [])
+    starts, ends = calendars[0].starts, calendars[0].ends
+    for c in calendars[1:]:
+        starts, ends = intersectSessions(starts, ends, c.starts, c.ends)
+    return Calendar(list(starts), list(ends))
+
+def intersectSessions(s0, e0, s1, e1):
+    starts, ends = [], []
+    i, j = 0, 0
+    while i < len(s0) and j < len(s1):
+        lo = s0[i] if s0[i] > s1[j] else s1[j]
+        hi = e0[i] if e0[i] < e1[j] else e1[j]
+        if lo < hi:
+            starts.append(lo)
+            ends.append(hi)
+        if e0[i] < e1[j]: # the session ending first can not overlap anything later
+            i += 1
+        else:
+            j += 1
+    return starts, ends
+
+# the times any of the calendars is open, overlapping and touching sessions are merged
+def union(*calendars):
+    starts, ends = [], []
+    for s, e in heapq.merge(*[zip(c.starts, c.ends) for c in calendars]):
+        if ends and s <= ends[-1]:
+            if e > ends[-1]:
+                ends[-1] = e
+        else:
+            starts.append(s)
+            ends.append(e)
+    return Calendar(starts, ends)
+
+def utc(t):
+    return datetime.fromtimestamp(t, pytz.utc)
+
+# ib's hours, '20200427:0930-20200427:1600;20200428:CLOSED;...' in the time zone tz
+def parse(ibHours, tz):
+    if not isinstance(ibHours, str):
+        fatal.errorAndExit('trading hours is a string')
+    sessions = []
+    for range_ in ibHours.split(';'):
+        if range_ == '' or range_.endswith('CLOSED'): # skip closed days
+            continue
+        ts = range_.split('-')
+        if len(ts) != 2:
+            fatal.errorAndExit('only two timestamps per range: {}     {}'.format(ts, ibHours))
+        start = tz.localize(datetime.strptime(ts[0], '%Y%m%d:%H%M')).timestamp()
+        end = tz.localize(datetime.strptime(ts[1], '%Y%m%d:%H%M')).timestamp()
+        if end < start:
+            fatal.errorAndExit('should get a valid timerange: {}'.format(range_))
+        sessions.append((start, end))
+    sessions.sort()
+    return Calendar([s for s, e in sessions], [e for s, e in sessions])
+
+# conId to ((hours, timeZoneId), Calendar)
+calendars = {}
+
+# the Calendar of the trading hours of ContractDetails, parsed again only when they change
+def calendar(cd):
+    key = (cd.tradingHours, cd.timeZoneId)
+    conId = cd.contract.conId if cd.contract is not None else None
+    cached = calendars.get(conId)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    if not isinstance(cd.timeZoneId, str):
+        fatal.errorAndExit('timeZoneId should be a string')
+    c = parse(cd.tradingHours, pytz.timezone(cd.timeZoneId))
+    calendars[conId] = (key, c)
+    return c
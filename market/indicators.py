@@ -0,0 +1,64 @@
+# indicator series shared between backtests over the same data
+#
+# an ema series only depends on its interval and where it is seeded, not on the
+# watch/stop/profit parameters, so a sweep calculates each series once and every
+# combination using that interval reads it from the cache.
+import logging
+
+import numpy as np
+
+from market import data
+
+# ema series as the Crossover calculates it in a backtest:
+#   seeded with the sma of [start, start+interval) and the close at start+interval,
+#   that value is stored at resume-1 and then updated for every bar from resume on
+#
+# note the short ema is seeded at start+shortInterval but resumes after the long seed,
+# see the FIXME in Crossover.initIndicators.  kept as is so the engines agree.
+# indexes before resume-1 are nan
+def calcEMASeries(close, interval, start, resume):
+    ema = np.full(len(close), np.nan)
+    closes = close.tolist()
+    sma = data.calcSMA(interval, closes, start)
+    prevEMA = data.calcEMA(closes[start+interval], sma, interval)
+    s = (2/ (interval+1) )
+    out = [prevEMA]
+    for v in closes[resume:]:
+        prevEMA = (v - prevEMA) * s + prevEMA # same as data.calcEMA, inlined
+        out.append(prevEMA)
+    ema[resume-1:] = out
+    return ema
+
+# the ema keys (interval, start, resume) a Crossover backtest uses
+def crossoverKeys(shortInterval, longInterval, start):
+    base = start + longInterval
+    return [(shortInterval, start, base+1), (longInterval, start, base+1)]
+
+class EMACache:
+    close: np.ndarray
+    series: dict # (interval, start, resume) to the ema series
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, close, series=None):
+        self.close = close
+        self.series = {} if series is None else series
+
+    def __repr__(self):
+        return 'series:{},hits:{},misses:{}'.format(len(self.series), self.hits, self.misses)
+
+    def ema(self, interval, start, resume):
+        key = (interval, start, resume)
+        try:
+            ema = self.series[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            ema = self.series[key] = calcEMASeries(self.close, interval, start, resume)
+            logging.info('calculated ema series for {}'.format(key))
+        return ema
+
+    # returns the init bar (Crossover.curEmaIndex after initIndicators), the short and long series
+    def crossover(self, shortInterval, longInterval, start):
+        shortKey, longKey = crossoverKeys(shortInterval, longInterval, start)
+        return start + longInterval, self.ema(*shortKey), self.ema(*longKey)
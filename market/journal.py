@@ -0,0 +1,195 @@
+# journal of the realtime bars the daemon saw, and a replay of it through the Crossover
+#
+# every realtime bar update (wContract.midpointBars/bidBars) is appended to a binary
+# file of fixed size records, one file per contract and day.  replaying feeds the bars
+# back through Crossover.checkForEntry on a clock driven by its sleepFunc instead of
+# the wall clock, so a day of trading replays in seconds.
+from datetime import datetime, timezone
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+from market import bars
+from market import data
+from market import detector
+
+defaultDir = os.path.join(os.path.expanduser('~'), '.ibJournal')
+
+magic = b'RTBJ'
+version = 1
+headerFormat = '<4sHH8x' # magic, version, record size
+headerSize = struct.calcsize(headerFormat)
+# kind, received (epoch), then the RealTimeBar fields with the bar time as epoch
+recordFormat = '<B8di'
+recordSize = struct.calcsize(recordFormat)
+recordDtype = np.dtype([('kind', '<u1'), ('received', '<f8'), ('time', '<f8'), ('open_', '<f8'), ('high', '<f8'), ('low', '<f8'),
+        ('close', '<f8'), ('volume', '<f8'), ('wap', '<f8'), ('count', '<i4')])
+
+kinds = {'MIDPOINT': 0, 'BID': 1, 'ASK': 2, 'TRADES': 3}
+
+# seconds per realtime bar, the only size ib offers
+realtimeBarSize = 5
+
+def journalPath(journalDir, localSymbol, day=None):
+    day = datetime.now(timezone.utc) if day is None else day
+    return os.path.join(journalDir, localSymbol, '{}.rtbj'.format(day.strftime('%Y%m%d')))
+
+# one file per contract and utc day of the bar times, see journalPath
+class Recorder:
+    journalDir: str
+    localSymbol: str
+    path: str = None
+    day: str = None # yyyymmdd (utc) of the file open at path
+    f: object = None
+    records: int = 0
+
+    def __init__(self, journalDir, localSymbol):
+        self.journalDir = journalDir
+        self.localSymbol = localSymbol
+        self.openDay(datetime.now(timezone.utc))
+
+    # switch to the file of the day of dt, appending when it already exists
+    def openDay(self, dt):
+        self.close()
+        self.day = dt.astimezone(timezone.utc).strftime('%Y%m%d')
+        self.path = journalPath(self.journalDir, self.localSymbol, dt.astimezone(timezone.utc))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.f = open(self.path, 'ab')
+        if new:
+            self.f.write(struct.pack(headerFormat, magic, version, recordSize))
+            self.f.flush()
+
+    def __repr__(self):
+        return 'path:{},records:{}'.format(self.path, self.records)
+
+    # RealTimeBarList.updateEvent handler
+    def update(self, bb, hasNewBar):
+        if not hasNewBar or len(bb) == 0:
+            return
+        b = bb[-1]
+        if b.time.astimezone(timezone.utc).strftime('%Y%m%d') != self.day:
+            self.openDay(b.time)
+            logging.warn('journaling realtime bars to {}'.format(self.path))
+        self.f.write(struct.pack(recordFormat, kinds.get(bb.whatToShow, 255), time.time(), b.time.timestamp(),
+            b.open_, b.high, b.low, b.close, b.volume, b.wap, b.count))
+        self.f.flush() # a bar every 5 seconds per list, cheap enough to never lose one
+        self.records += 1
+
+    # start recording the realtime bars of a wContract (after wContract.realtimeBars)
+    def attach(self, wc):
+        for bb in [wc.midpointBars, wc.bidBars]:
+            if bb is not None:
+                bb.updateEvent += self.update
+        logging.warn('journaling realtime bars to {}'.format(self.path))
+
+    def detach(self, wc):
+        for bb in [wc.midpointBars, wc.bidBars]:
+            if bb is not None:
+                bb.updateEvent -= self.update
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+# the records of a journal as a record array, a torn last record is dropped
+def read(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    m, v, size = struct.unpack_from(headerFormat, raw)
+    if m != magic or v != version or size != recordSize:
+        raise ValueError('not a version {} realtime bar journal: {}'.format(version, path))
+    n = (len(raw) - headerSize) //recordSize
+    return np.frombuffer(raw, dtype=recordDtype, count=n, offset=headerSize).view(np.recarray)
+
+# stands in for a wContract during a replay, the realtime bars come from the journal
+# as the clock is moved along by sleep
+class ReplayContract:
+    symbol: str = None
+    localSymbol: str = None
+    records: np.recarray
+    next: int = 0 # first record not yet delivered
+    clock: float # epoch
+    realtimeRings: dict # whatToShow to bars.RealtimeRing, as a wContract
+
+    def __init__(self, records, localSymbol=None):
+        self.records = records
+        self.localSymbol = localSymbol
+        self.clock = float(records[0].time) if len(records) else 0.0
+        self.realtimeRings = {'MIDPOINT': bars.RealtimeRing(), 'BID': bars.RealtimeRing()}
+
+    def __repr__(self):
+        return 'localSymbol:{},clock:{},delivered:{}/{}'.format(self.localSymbol, self.clock, self.next, len(self.records))
+
+    def finished(self):
+        return self.next >= len(self.records)
+
+    # deliver every bar that had ended by the clock
+    def advanceTo(self, clock):
+        self.clock = clock
+        ends = self.records.time[self.next:] + realtimeBarSize
+        stop = self.next + int(np.searchsorted(ends, clock, side='right'))
+        rings = {kinds[k]: ring for k, ring in self.realtimeRings.items()}
+        for r in self.records[self.next:stop]:
+            ring = rings.get(r.kind)
+            if ring is not None:
+                ring.push(r.time, r.open_, r.high, r.low, r.close)
+        self.next = stop
+
+    # sleepFunc for Crossover.checkForEntry
+    def sleep(self, seconds):
+        self.advanceTo(self.clock + seconds)
+
+    def realtimeLowBid(self):
+        return self.realtimeRings['BID'].lastLow()
+    def realtimeHighMidpoint(self):
+        return self.realtimeRings['MIDPOINT'].lastHigh()
+    def realtimeLowMidpoint(self):
+        return self.realtimeRings['MIDPOINT'].lastLow()
+    def realtimeMidpoint(self):
+        return self.realtimeRings['MIDPOINT'].lastClose()
+
+# the midpoint records rolled up into bars of barSize seconds (bars.Bar), what the daemon
+# would have gotten from historical data
+def rollUp(records, barSize):
+    mid = records[records.kind == kinds['MIDPOINT']]
+    rolled = []
+    if len(mid) == 0:
+        return rolled
+    starts = mid.time - mid.time % barSize
+    edges = np.flatnonzero(np.diff(starts)) + 1
+    for group in np.split(np.arange(len(mid)), edges):
+        bar = bars.Bar(float(mid.open_[group[0]]))
+        bar.high = float(mid.high[group].max())
+        bar.low = float(mid.low[group].min())
+        bar.close = float(mid.close[group[-1]])
+        bar.date = datetime.fromtimestamp(float(starts[group[0]]), timezone.utc)
+        rolled.append(bar)
+    return rolled
+
+# run a journal through a live (not backTest) Crossover
+#   histData initializes the indicators, by default the journal's own first bars are
+#   rolled up for it (2 long intervals and one bar)
+# returns the entries found as [(clock, entryAction, entryPrice)]
+def replayCrossover(records, barSizeStr, shortInterval, longInterval, watchCount, histData=None, localSymbol=None):
+    barSize = data.barSizeToDuration[barSizeStr]['value']
+    rc = ReplayContract(records, localSymbol)
+    start = rc.clock
+    if histData is None:
+        histData = rollUp(records, barSize)[:longInterval*2 + 1]
+        if len(histData) < longInterval*2 + 1:
+            raise ValueError('journal is too short to warm up a long interval of {}'.format(longInterval))
+        start = histData[-1].date.timestamp() + barSize
+    dataStore = detector.Crossover(barSizeStr, rc, shortInterval, longInterval, watchCount)
+    dataStore.initIndicators(histData)
+    rc.advanceTo(start)
+    entries = []
+    while not rc.finished():
+        entryAction, entryPrice = dataStore.checkForEntry(None, rc.sleep)
+        if entryPrice is not None:
+            entries.append((rc.clock, entryAction, entryPrice))
+    return entries
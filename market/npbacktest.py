@@ -0,0 +1,241 @@
+#  numpy engine for the Crossover backtest
+#
+#  follows the same rules as backtest.backtest driving a detector.Crossover, but the
+#  indicators and the watch/entry signals are calculated for the whole series at once
+#  instead of bar by bar.  convert the historical data once with toArrays, then call
+#  backtest for each parameter combination.
+import heapq
+import logging
+import math
+
+import numpy as np
+
+from market import data
+from market import indicators
+from market import order
+from market import ticks
+
+# number of bars looked at per step when searching for a position's exit, doubles each step
+exitChunk = 256
+
+# pull the columns we need out of historical data (BarData or bars.Bar)
+def toArrays(dataStream):
+    n = len(dataStream)
+    high = np.fromiter((b.high for b in dataStream), dtype=np.float64, count=n)
+    low = np.fromiter((b.low for b in dataStream), dtype=np.float64, count=n)
+    close = np.fromiter((b.close for b in dataStream), dtype=np.float64, count=n)
+    return high, low, close
+
+# where Crossover.initIndicators starts the sma during a backtest
+def startIndex(n, barSize, byPeriod=None):
+    if byPeriod:
+        return n-1 - int(byPeriod *60*60 /barSize)
+    return 0
+
+# macd signal line as Crossover.updateMacdSignal builds it, starting from the init bar
+def calcMacdSignal(macd, base, macdSize=9):
+    signal = np.full(len(macd), np.nan)
+    values = macd[base:].tolist()
+    if len(values) < macdSize:
+        return signal
+    prevSignal = data.calcSMA(macdSize, values, 0)
+    out = [prevSignal]
+    for v in values[macdSize:]:
+        prevSignal = data.calcEMA(v, prevSignal, macdSize)
+        out.append(prevSignal)
+    signal[base+macdSize-1:] = out
+    return signal
+
+# returns the init bar (Crossover.curEmaIndex after initIndicators) and the indicator series
+#   emaCache is an indicators.EMACache over close, shared between runs on the same data
+def calcIndicators(close, shortInterval, longInterval, start, macdSize=9, emaCache=None):
+    if emaCache is None:
+        emaCache = indicators.EMACache(close)
+    base, short, long_ = emaCache.crossover(shortInterval, longInterval, start)
+    macd = short - long_
+    signal = calcMacdSignal(macd, base, macdSize)
+    return base, short, long_, macd, signal
+
+# the watch rules from Crossover.checkForEntry as array operations
+#
+#   a watch starts on a bar where the short ema crosses above the long ema (sell side
+#   watches are dropped right away).  it survives a bar if the close stays above the
+#   long ema, rises over the previous close and the short ema is at least 0.125 over
+#   the long.  once it has lasted watchCount bars, enter if the close rose over the watch.
+#
+# bars base+1 .. end-1 are examined, returns the indexes of the entry bars
+def findEntries(close, short, long_, base, end, watchCount):
+    n = len(close)
+    if watchCount < 2 or end - base < 2:
+        return np.empty(0, dtype=np.int64)
+    cur, prev = slice(base+1, end), slice(base, end-1)
+    above = short > long_
+    crossed = np.zeros(n, dtype=bool)
+    crossed[cur] = (above[cur] != above[prev]) & above[cur]
+    ok = np.zeros(n, dtype=bool)
+    ok[cur] = ~(close[cur] < long_[cur]) & ~(close[cur] <= close[prev]) & ~(long_[cur] + 0.125 > short[cur])
+    broken = np.cumsum(~ok)
+
+    starts = np.flatnonzero(crossed)
+    entries = starts + watchCount - 1
+    keep = entries < end
+    starts, entries = starts[keep], entries[keep]
+    keep = (broken[entries] == broken[starts]) & (close[entries] > close[starts])
+    return entries[keep]
+
+# prices for the bracket as order.CreateBracketOrder and backtest.backtest set them up
+# returns limit, stop and profit prices plus the trailing function (None when not trailing),
+# which takes an array of closes
+def bracketPrices(od):
+    inc = od.wContract.priceIncrement
+    conf = od.config
+    buy = od.entryAction == 'BUY'
+    lmt = ticks.Round(od.entryPrice, inc)
+    profit = ticks.Round(order.calculateProfitPrice(od, od.entryAction), inc)
+    trail = None
+    stop = None
+    if conf.trail:
+        if conf.stopPercent is not None:
+            pct = (100.0 - conf.stopPercent) if buy else (100.0 + conf.stopPercent)
+            stop = ticks.Round(lmt *pct/100.0, inc)
+            trail = lambda c: ticks.RoundArray(c * pct/100.0, inc)
+        elif conf.stopTarget:
+            stop = lmt - conf.stopTarget if buy else lmt + conf.stopTarget
+            offset = -conf.stopTarget if buy else conf.stopTarget
+            trail = lambda c: ticks.RoundArray(c + offset, inc)
+    else:
+        stop = ticks.Round(order.calculateStopPrice(od, od.entryAction), inc)
+    return lmt, stop, profit, trail
+
+def amountAt(entryAction, lmt, price):
+    if entryAction == 'BUY':
+        return price - lmt
+    return lmt - price
+
+# stop in effect for each check in bars, as book.PositionBook.check trails it
+# returns the stops and the stop in effect after the last bar
+def trailStops(close, bars, lmt, stop, trail):
+    closes = close[bars]
+    moved = closes > lmt
+    values = np.zeros(len(bars))
+    values[moved] = trail(closes[moved])
+    lastMoved = np.maximum.accumulate(np.where(moved, np.arange(len(bars)), -1))
+    before = np.concatenate(([-1], lastMoved[:-1]))
+    stops = np.where(before >= 0, values[np.maximum(before, 0)], stop)
+    after = values[lastMoved[-1]] if lastMoved[-1] >= 0 else stop
+    return stops, after
+
+# bar start for the resolver, dates from fills.toDates
+def barStart(dates, i):
+    if dates is None or np.isnan(dates[i]):
+        return None
+    return dates[i]
+
+# first check where the position closes, mirroring book.PositionBook.check
+#   checked against bars s+1 .. last, then last once more (the check after the loop)
+# returns the position in the checks and the amount per unit, or None, None if still open
+def findExit(high, low, close, s, last, entryAction, lmt, stop, profit, trail, resolver=None, dates=None):
+    bars = np.append(np.arange(s+1, last+1), last)
+    pos = 0
+    chunk = exitChunk
+    while pos < len(bars):
+        b = bars[pos:pos+chunk]
+        if trail is None:
+            stops = stop
+        else:
+            stops, stop = trailStops(close, b, lmt, stop, trail)
+        hit = (low[b] <= stops) | (high[b] >= profit)
+        if hit.any():
+            k = int(hit.argmax())
+            bar = b[k]
+            atStop = stops if trail is None else float(stops[k])
+            if low[bar] <= atStop and high[bar] >= profit and resolver is not None:
+                if resolver.firstHit(barStart(dates, bar), entryAction, atStop, profit) == 'profit':
+                    return pos+k, amountAt(entryAction, lmt, profit)
+            if low[bar] <= atStop:
+                return pos+k, amountAt(entryAction, lmt, atStop)
+            return pos+k, amountAt(entryAction, lmt, profit)
+        pos += chunk
+        chunk *= 2
+    return None, None
+
+# run the entries through the position rules of backtest.backtest
+def simulate(wc, conf, high, low, close, entries, end, resolver=None, dates=None):
+    totals = {'gl': 0, 'tf': 0, 'mf': 0, 'op': 0, 'lo': 0}
+    last = end-1 # last bar examined by the loop, also checked again after it
+    events = [] # (bar, phase, seq, amount, cost, qty), closes (phase 0) come before entries
+    openUntil = [] # heap of bars at which the open positions close
+    leftover = []
+    for seq, i in enumerate(entries.tolist()):
+        while openUntil and openUntil[0] <= i:
+            heapq.heappop(openUntil)
+        od = order.OrderDetails(float(low[i]), conf, wc, 'BUY')
+        od.config.qty = order.calculateQty(od)
+        if len(openUntil) >= od.config.openPositions:
+            continue
+        qty = od.config.qty
+        lmt, stop, profit, trail = bracketPrices(od)
+        # see backtest.checkTradeExecution, opened and closed in the next bar
+        opened = True
+        if lmt <= high[i+1] and stop >= low[i+1]:
+            opened = resolver is not None and resolver.stoppedAfterEntry(barStart(dates, i+1), od.entryAction, lmt, stop) == False
+        if not opened:
+            events.append((i, 1, seq, amountAt(od.entryAction, lmt, stop) *qty, None, None))
+            continue
+        events.append((i, 1, seq, None, lmt * qty, qty))
+        k, amount = findExit(high, low, close, i, last, od.entryAction, lmt, stop, profit, trail, resolver, dates)
+        if k is None:
+            leftover.append((od.entryAction, lmt, qty))
+            heapq.heappush(openUntil, math.inf)
+            continue
+        exitAt = i+1+k if i+1+k <= last else end # past the loop is the check after it
+        heapq.heappush(openUntil, exitAt)
+        events.append((exitAt, 0, seq, amount * qty, lmt * qty, qty))
+
+    events.sort(key=lambda e: e[:3])
+    for bar, phase, seq, amount, cost, qty in events:
+        if phase == 0:
+            totals['gl'] += amount
+            if totals['tf'] > totals['mf']:
+                totals['mf'] = totals['tf']
+            totals['tf'] -= cost
+        elif cost is None:
+            totals['gl'] += amount
+        else:
+            totals['tf'] += cost
+            totals['op'] += qty
+    for entryAction, lmt, qty in leftover:
+        totals['lo'] = amountAt(entryAction, lmt, close[end].item()) *qty
+    return totals
+
+# same totals as backtest.backtest for a Crossover with the given parameters
+#   high, low, close from toArrays
+#   byPeriod is the Crossover.byPeriod (hours of bars to examine)
+#   emaCache is an indicators.EMACache over close, pass the same one for every combination
+#   resolver is a fills.IntrabarResolver for ambiguous bars, dates (fills.toDates) is then needed
+def backtest(wc, conf, high, low, close, shortInterval, longInterval, watchCount, byPeriod=None, emaCache=None, resolver=None, dates=None):
+    barSize = data.barSizeToDuration[conf.barSizeStr]['value']
+    start = startIndex(len(close), barSize, byPeriod)
+    base, short, long_, macd, signal = calcIndicators(close, shortInterval, longInterval, start, emaCache=emaCache)
+    end = len(close)-1
+    entries = findEntries(close, short, long_, base, end, watchCount)
+    logging.info('found {} entries for sI:{}, lI:{}, w:{}'.format(len(entries), shortInterval, longInterval, watchCount))
+    return simulate(wc, conf, high, low, close, entries, end, resolver, dates)
+
+# backtest over bars first .. stop-1 only, as if the data ended at stop-1
+#   the emas come from an indicators.EMACache over the whole series, calculated from the
+#   first bar, so every window starts with warmed up indicators instead of seeding its own
+def backtestWindow(wc, conf, high, low, close, shortInterval, longInterval, watchCount, first, stop, emaCache, resolver=None, dates=None):
+    base, short, long_ = emaCache.crossover(shortInterval, longInterval, 0)
+    base = max(base, first)
+    end = stop-1
+    entries = findEntries(close, short, long_, base, end, watchCount)
+    logging.info('found {} entries for sI:{}, lI:{}, w:{} in bars {}-{}'.format(len(entries), shortInterval, longInterval, watchCount, first, end))
+    return simulate(wc, conf, high, low, close, entries, end, resolver, dates)
+
+# used to compare the engine against backtest.backtest
+def sameTotals(t0, t1):
+    for k in t0:
+        if not math.isclose(t0[k], t1[k], rel_tol=1e-9, abs_tol=1e-6):
+            return False
+    return True
@@ -1,7 +1,11 @@
 import copy
 import logging
+import time
+
+from ib_insync import util
 
 from market import fatal
+from market import ticks
 
 from market.contract import wContract
 from market.config import Config
@@ -37,35 +41,11 @@ class BracketOrder:
             pieces.append('{}:{}'.format(k, v))
         return ','.join(pieces)
 
-import decimal
-from decimal import Decimal
-def convertToTwoDecimalsAsFloat(p):
-    return float( Decimal.from_float(p).quantize(Decimal('0.01')) )
-
-# some instruments are traded on an increment other than a penny
-# in cases of less than a penny, the contract module attempts to trade
-# on the penny.
-# in the case of ES for example, we have to trade on the quarter
-import math
-def roundToTickSize(p, inc):
-    if inc == 0.01:
-        return p
-    minD = 999999999
-    parts = math.modf(p)
-    intP = parts[1]
-    j = int(0)
-    m = None
-    d = None
-    while j <= int(1/inc):
-        d = abs(p - intP - inc * j)
-        if d < minD:
-            minD = d
-            m = j
-        j += 1
-    return m * inc + intP
-
-def Round(p, inc):
-    return convertToTwoDecimalsAsFloat( roundToTickSize(p, inc) )
+# Round on the increment of the market rule for p when the contract has several
+def RoundPrice(wc, p):
+    if wc.tickRule is not None and len(wc.tickRule.increments) > 1:
+        return wc.tickRule.round(p)
+    return ticks.Round(p, wc.priceIncrement)
 
 def calculateProfitPrice(od, entryAction):
     if od.config.percents:
@@ -136,7 +116,7 @@ def CreateBracketOrder(orderDetails, account=None):
     orders.entryOrder.action = orderDetails.entryAction
     orders.entryOrder.totalQuantity = qty
     orders.entryOrder.orderType = 'LMT'
-    orders.entryOrder.lmtPrice = Round(orderDetails.entryPrice, orderDetails.wContract.priceIncrement)
+    orders.entryOrder.lmtPrice = RoundPrice(orderDetails.wContract, orderDetails.entryPrice)
     orders.entryOrder.tif = 'DAY'
 
     exitPrice = calculateProfitPrice(orderDetails, orderDetails.entryAction)
@@ -146,7 +126,7 @@ def CreateBracketOrder(orderDetails, account=None):
     orders.exitOrder.action = exitAction
     orders.exitOrder.totalQuantity = qty
     orders.exitOrder.orderType = 'LMT'
-    orders.exitOrder.lmtPrice = Round(exitPrice, orderDetails.wContract.priceIncrement)
+    orders.exitOrder.lmtPrice = RoundPrice(orderDetails.wContract, exitPrice)
     orders.exitOrder.tif = 'GTC'
     orders.exitOrder.outsideRth = orderDetails.config.exitOutsideRth
 
@@ -158,7 +138,7 @@ def CreateBracketOrder(orderDetails, account=None):
         orders.dayOrder.action = exitAction
         orders.dayOrder.totalQuantity = qty
         orders.dayOrder.orderType = 'LOC'
-        orders.dayOrder.lmtPrice = Round(dayPrice, orderDetails.wContract.priceIncrement)
+        orders.dayOrder.lmtPrice = RoundPrice(orderDetails.wContract, dayPrice)
         orders.dayOrder.tif = 'DAY'
         orders.dayOrder.outsideRth = orderDetails.config.exitOutsideRth
 
@@ -179,7 +159,7 @@ def CreateBracketOrder(orderDetails, account=None):
     else:
         stopPrice = calculateStopPrice(orderDetails, orderDetails.entryAction)
         orders.stopOrder.orderType = 'STP'
-        orders.stopOrder.auxPrice = Round(stopPrice, orderDetails.wContract.priceIncrement)
+        orders.stopOrder.auxPrice = RoundPrice(orderDetails.wContract, stopPrice)
 
     orderDetails.entryPrice = orders.entryOrder.lmtPrice # for debugging clarity
     logging.info('created bracket orders: %s', orders)
@@ -195,6 +175,90 @@ def CreateBracketOrder(orderDetails, account=None):
 # of reduced intraday margin for securities – generally 25% of the long stock value. But keep in mind this requirement reverts to the 
 # Reg T 50% of stock value to hold overnight.
 from market import account
+
+# initial margin after an order, from what if orders, keyed by (conId, action, quantity).
+# the what if round trip is on the pre-trade path of every FUT order, so the result is
+# kept and refreshed in the background every refreshEvery seconds and shortly after
+# the account values change (a fill changes the margin).  a key with no result newer
+# than maxAge is a miss, which asks the gateway there and then
+class MarginCache:
+    ibc: object # ib_insync.IB
+    refreshEvery: float
+    maxAge: float
+    margins: dict # key to (initMarginAfter, epoch received)
+    orders: dict # key to (Contract, the what if Order) to refresh it with
+    pending: set # keys with a what if in flight
+    timer: object = None # asyncio.TimerHandle of the next refresh
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, ibc, refreshEvery=60, maxAge=300):
+        self.ibc = ibc
+        self.refreshEvery = refreshEvery
+        self.maxAge = maxAge
+        self.margins = {}
+        self.orders = {}
+        self.pending = set()
+        ibc.accountValueEvent += self.accountValueChanged
+        self.schedule(refreshEvery)
+
+    def __repr__(self):
+        return 'margins:{},hits:{},misses:{},pending:{}'.format(len(self.margins), self.hits, self.misses, len(self.pending))
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = util.getLoop().call_later(delay, self.refresh)
+
+    # a burst of account values comes at once, refresh once a second after the first
+    def accountValueChanged(self, v):
+        if self.orders and (self.timer is None or self.timer.when() - util.getLoop().time() > 1):
+            self.schedule(1)
+
+    # re-ask the gateway for every key, the answers come in whatIfDone
+    def refresh(self):
+        self.timer = None
+        for key, (contract, wio) in self.orders.items():
+            if key in self.pending or not self.ibc.isConnected():
+                continue
+            self.pending.add(key)
+            future = self.ibc.whatIfOrderAsync(contract, wio)
+            future.add_done_callback(lambda f, key=key: self.whatIfDone(key, f))
+        self.schedule(self.refreshEvery)
+
+    def whatIfDone(self, key, future):
+        self.pending.discard(key)
+        try:
+            os = future.result()
+            self.margins[key] = (float(os.initMarginAfter), time.time())
+        except Exception as e: # cancelled, an error from the gateway, or no margin in the answer
+            logging.warn('could not refresh the margin of {}: {}'.format(key, e))
+
+    # initMarginAfter of the entry order, from the cache when recent enough
+    def initMargin(self, contract, entryOrder):
+        key = (contract.conId, entryOrder.action, float(entryOrder.totalQuantity))
+        if key not in self.orders: # margin on futures does not move with the limit price
+            self.orders[key] = (contract, whatIfOrder(entryOrder))
+        cached = self.margins.get(key)
+        if cached is not None and time.time() - cached[1] <= self.maxAge:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        os = self.ibc.whatIfOrder(*self.orders[key])
+        if not os.initMarginAfter or not isinstance(os.initMarginAfter, str):
+            fatal.errorAndExit('got back invalid format: {} {} {}'.format(os, contract, entryOrder))
+        ima = float( os.initMarginAfter )
+        self.margins[key] = (ima, time.time())
+        return ima
+
+# a MarginCache per connection, made on first use
+marginCaches = {}
+def marginCache(ibc):
+    c = marginCaches.get(ibc)
+    if c is None:
+        c = marginCaches[ibc] = MarginCache(ibc)
+    return c
+
 def adequateFunds(orderDetails, orders):
     qty = calculateQty(orderDetails)
     availableFunds = account.availableFunds(orderDetails.wContract.ibClient, orderDetails.config.account)
@@ -202,18 +266,13 @@ def adequateFunds(orderDetails, orders):
     lhs = orderDetails.entryPrice * qty
     af_rhs = availableFunds - orderDetails.config.bufferAmt
     bp_rhs = buyingPower - orderDetails.config.bufferAmt
-    os = None
     if orderDetails.wContract.contract.secType == 'FUT':
-        wio = whatIfOrder(orders.entryOrder)
-        os = orderDetails.wContract.ibClient.whatIfOrder(orderDetails.wContract.contract, wio)
-        if not os.initMarginAfter or not isinstance(os.initMarginAfter, str):
-            fatal.errorAndExit('got back invalid format: {} {} {}'.format(os, orderDetails, order))
-        ima = float( os.initMarginAfter )
+        ima = marginCache(orderDetails.wContract.ibClient).initMargin(orderDetails.wContract.contract, orders.entryOrder)
         lhs += ima
     if lhs < af_rhs and lhs < bp_rhs:
         logging.warn('detected adequate funds {} {} {}'.format(lhs, af_rhs, bp_rhs))
         return True
-    logging.error('not enough funds: {} {} {}'.format(os, orderDetails, orders))
+    logging.error('not enough funds: {} {}'.format(orderDetails, orders))
     return False
 
 def whatIfOrder(order):
@@ -0,0 +1,186 @@
+# sweep results, stored in sqlite with a typed column per parameter and metric
+#
+# bin/backTest.py records every combination of a sweep as a run.  the helpers answer
+# what processScriptOutput/findUnion/filterBest/getBestValue used to work out by
+# re-parsing the logged 'lI:.., sI:..; gl:..' lines, using indexed queries instead.
+import logging
+import os
+import re
+import sqlite3
+import time
+
+defaultPath = os.path.join(os.path.expanduser('~'), '.ibSweeps.sqlite')
+
+# pD is the period (Crossover.byPeriod) the combination was run over
+params = {'pD': 'REAL', 'lI': 'INTEGER', 'sI': 'INTEGER', 'w': 'INTEGER', 'sT': 'REAL', 'pT': 'REAL'}
+# the backtest totals, plus er (gl per unit opened) and r (gl as a percent of max funds)
+metrics = {'gl': 'REAL', 'tf': 'REAL', 'mf': 'REAL', 'op': 'INTEGER', 'lo': 'REAL', 'er': 'REAL', 'r': 'REAL'}
+
+# a combination across periods, eg lI, sI, w, sT, pT
+keyParams = ['lI', 'sI', 'w', 'sT', 'pT']
+keyCols = ', '.join(keyParams)
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, createdAt REAL, symbol TEXT, localSymbol TEXT, detector TEXT, endDate TEXT, duration INTEGER)',
+    'CREATE TABLE IF NOT EXISTS results (run INTEGER NOT NULL REFERENCES runs(run), {}, {})'.format(
+        ', '.join('{} {}'.format(k, t) for k, t in params.items()),
+        ', '.join('{} {}'.format(k, t) for k, t in metrics.items())),
+    'CREATE INDEX IF NOT EXISTS resultsByGl ON results (run, gl DESC)',
+    'CREATE INDEX IF NOT EXISTS resultsByPeriod ON results (run, pD, gl DESC)',
+    'CREATE INDEX IF NOT EXISTS resultsByParams ON results (run, {}, pD)'.format(keyCols),
+    # per combination across the periods of a run, filled in by summarize
+    #   minGrowth is the smallest gl/previous gl going from a period to the next longer one
+    'CREATE TABLE IF NOT EXISTS stability (run INTEGER NOT NULL REFERENCES runs(run), {}, periods INTEGER, minGl REAL, minGrowth REAL, gl REAL)'.format(
+        ', '.join('{} {}'.format(k, params[k]) for k in keyParams)),
+    'CREATE INDEX IF NOT EXISTS stabilityByGrowth ON stability (run, minGrowth, gl DESC)',
+]
+
+# the id used in the sweep log lines, eg lI:40,sI:15,w:15,sT:5,pT:7
+def key(row):
+    return ','.join('{}:{}'.format(k, row[k]) for k in keyParams)
+
+# turn a filter like 'lI:40,sI:15,w:(5|15),sT.*' (what filterBest took as a regex)
+# into sql.  parameters are matched in order, anything from a .* on matches all
+def parseFilter(spec):
+    where = []
+    args = []
+    for piece in spec.split(','):
+        piece = piece.strip()
+        if piece == '' or piece.startswith('.*'):
+            break
+        m = re.fullmatch(r'(\w+)(?::\(?([^()]*?)\)?)?(\.\*)?', piece)
+        if m is None or m.group(1) not in params:
+            raise ValueError('cannot parse filter {} at {}'.format(spec, piece))
+        if m.group(2) is not None:
+            values = m.group(2).split('|')
+            where.append('{} IN ({})'.format(m.group(1), ','.join('?' *len(values))))
+            args += [float(v) for v in values]
+        if m.group(3) is not None:
+            break
+    return ' AND '.join(where) if where else '1', args
+
+def checkMetric(metric):
+    if metric not in metrics:
+        raise ValueError('unknown metric {}'.format(metric))
+    return metric
+
+class Store:
+    path: str
+    db: sqlite3.Connection
+    pending: list # rows not yet written, see add/flush
+    batchSize: int = 10000
+
+    def __init__(self, path=defaultPath):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        for s in schema:
+            self.db.execute(s)
+        self.db.commit()
+        self.pending = []
+
+    def __repr__(self):
+        return 'path:{},pending:{}'.format(self.path, len(self.pending))
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def newRun(self, symbol=None, localSymbol=None, detector=None, endDate=None, duration=None):
+        c = self.db.execute('INSERT INTO runs (createdAt, symbol, localSymbol, detector, endDate, duration) VALUES (?, ?, ?, ?, ?, ?)',
+                (time.time(), symbol, localSymbol, detector, endDate, duration))
+        self.db.commit()
+        logging.warn('recording sweep results as run {} in {}'.format(c.lastrowid, self.path))
+        return c.lastrowid
+
+    def latestRun(self):
+        return self.db.execute('SELECT MAX(run) FROM runs').fetchone()[0]
+
+    # combination is (p, lI, sI, w, sT, pT) as from sweep.combinations
+    def add(self, run, combination, totals):
+        er = totals['gl']/totals['op'] if totals['op'] else None
+        r = totals['gl']/totals['mf']*100 if totals['mf'] > 0 else 0
+        self.pending.append((run,) + tuple(combination) + (totals['gl'], totals['tf'], totals['mf'], totals['op'], totals['lo'], er, r))
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        cols = ['run'] + list(params) + list(metrics)
+        self.db.executemany('INSERT INTO results ({}) VALUES ({})'.format(', '.join(cols), ','.join('?' *len(cols))), self.pending)
+        self.db.commit()
+        self.pending = []
+
+    # best n combinations by metric, in one period or across all of them
+    def top(self, n=30, run=None, period=None, metric='gl'):
+        run = self.latestRun() if run is None else run
+        sql = 'SELECT * FROM results WHERE run = ?'
+        args = [run]
+        if period is not None:
+            sql += ' AND pD = ?'
+            args.append(period)
+        sql += ' ORDER BY {} DESC LIMIT ?'.format(checkMetric(metric))
+        return self.db.execute(sql, args + [n]).fetchall()
+
+    # rows matching a parseFilter spec, best first
+    def where(self, spec, run=None, metric='gl'):
+        run = self.latestRun() if run is None else run
+        where, args = parseFilter(spec)
+        sql = 'SELECT * FROM results WHERE run = ? AND {} ORDER BY pD, {} DESC'.format(where, checkMetric(metric))
+        return self.db.execute(sql, [run] + args).fetchall()
+
+    # the combinations in the top n of any period (was findUnion)
+    def union(self, n=30, run=None, metric='gl'):
+        run = self.latestRun() if run is None else run
+        union = {}
+        for (period,) in self.db.execute('SELECT DISTINCT pD FROM results WHERE run = ?', [run]).fetchall():
+            for r in self.top(n, run, period, metric):
+                union[key(r)] = r
+        return list(union.values())
+
+    # fill in the stability table for a run, done once when the sweep is finished
+    def summarize(self, run):
+        self.flush()
+        self.db.execute('DELETE FROM stability WHERE run = ?', [run])
+        self.db.execute(('INSERT INTO stability SELECT run, {0}, COUNT(*), MIN(gl), MIN(gl / prevGl), MAX(lastGl) FROM ('
+                'SELECT run, {0}, gl, LAG(gl) OVER w AS prevGl, '
+                'LAST_VALUE(gl) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS lastGl '
+                'FROM results WHERE run = ? WINDOW w AS (PARTITION BY {0} ORDER BY pD)) '
+                'GROUP BY {0}').format(keyCols), [run])
+        self.db.execute('ANALYZE')
+        self.db.commit()
+
+    # combinations that made at least minGl (> 0) in every period and grew by more than mult
+    # from each period to the next longer one, ranked by the gain in the longest period.
+    # stricter than the old getFromIn, which only held the last step to mult
+    def stable(self, mult, run=None, minGl=1):
+        run = self.latestRun() if run is None else run
+        if self.db.execute('SELECT 1 FROM stability WHERE run = ? LIMIT 1', [run]).fetchone() is None:
+            self.summarize(run)
+        sql = 'SELECT * FROM stability WHERE run = ? AND minGrowth > ? AND periods > 1 AND minGl >= ? ORDER BY gl DESC'
+        return self.db.execute(sql, [run, mult, minGl]).fetchall()
+
+    # stable combinations from the top n of any period making more than threshold (was getBestValue)
+    def best(self, mults=[1.5, 2, 2.5, 3], threshold=20000, n=30, run=None):
+        run = self.latestRun() if run is None else run
+        union = set(key(r) for r in self.union(n, run))
+        best = {}
+        for mult in mults:
+            best[mult] = [r for r in self.stable(mult, run) if key(r) in union and r['gl'] > threshold]
+        return best
+
+# load the old '../esData' output, lines of 'lI:40,sI:15,w:15,sT:5,pT:7 <days>:<gl>'
+def importScriptOutput(store, path='../esData'):
+    run = store.newRun(detector='Crossover')
+    with open(path, 'r') as f:
+        for line in f:
+            kv = line.split()
+            if len(kv) != 2:
+                continue
+            ps = dict(p.split(':') for p in kv[0].split(','))
+            period, gl = kv[1].split(':')
+            combination = (float(period),) + tuple(float(ps[k]) for k in keyParams)
+            store.add(run, combination, {'gl': float(gl), 'tf': 0, 'mf': 0, 'op': 0, 'lo': 0})
+    store.summarize(run)
+    return run
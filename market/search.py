@@ -0,0 +1,77 @@
+# adaptive search over the sweep grid, instead of backtesting every combination
+#
+# successive halving: a random sample of the grid is run over a short stretch of the
+# history (a Crossover.byPeriod), the best 1/eta of it goes on to a stretch eta times
+# longer, and so on until the last rung runs over all of it.  the grid neighbours of
+# the survivors join at the next rung, so the search keeps looking around what works
+# instead of only within the first sample.
+import itertools
+import logging
+import math
+import random
+
+# the axes of the grid, in the order of a combination after the period
+axes = ['lI', 'sI', 'w', 'sT', 'pT']
+
+class Grid:
+    values: list # per axis, the values to search
+
+    def __init__(self, longIntervals, shortIntervals, watchCounts, stopTargets, profitTargets):
+        self.values = [list(longIntervals), list(shortIntervals), list(watchCounts), list(stopTargets), list(profitTargets)]
+
+    def __repr__(self):
+        return ','.join('{}:{}'.format(a, v) for a, v in zip(axes, self.values))
+
+    def valid(self, point):
+        return self.values[1][point[1]] <= self.values[0][point[0]] # sI <= lI, as sweep.combinations
+
+    # points are tuples of indexes into values
+    def points(self):
+        return [p for p in itertools.product(*[range(len(v)) for v in self.values]) if self.valid(p)]
+
+    def neighbours(self, point):
+        for axis in range(len(axes)):
+            for step in [-1, 1]:
+                n = list(point)
+                n[axis] += step
+                if 0 <= n[axis] < len(self.values[axis]) and self.valid(n):
+                    yield tuple(n)
+
+    # (p, lI, sI, w, sT, pT) as from sweep.combinations
+    def combination(self, point, period):
+        return (period,) + tuple(v[i] for v, i in zip(self.values, point))
+
+# byPeriod (hours) for each rung, shortest first, None (all of the history) for the last
+def rungPeriods(hours, rungs, eta=3):
+    return [hours /eta**k for k in range(rungs-1, 0, -1)] + [None]
+
+# returns [(combination, totals)] of the last rung, best first, and the number of backtests run
+#   evaluate takes a list of combinations and returns [(combination, totals)] in that order,
+#   eg a sweep.sweep over the bars
+#   sample is how many grid points start at the first rung, defaults to a 20th of the grid
+#   neighbours is how many of the survivors of each rung have their neighbours added
+def successiveHalving(evaluate, grid, periods, sample=None, eta=3, neighbours=3, seed=None, metric='gl'):
+    points = grid.points()
+    if sample is None:
+        sample = max(eta **(len(periods)-1), len(points) //20)
+    r = random.Random(seed)
+    candidates = r.sample(points, min(sample, len(points)))
+    seen = set(candidates)
+    evaluations = 0
+    ranked = []
+    for rung, period in enumerate(periods):
+        results = evaluate([grid.combination(p, period) for p in candidates])
+        evaluations += len(candidates)
+        ranked = sorted(zip(candidates, (t for c, t in results)), key=lambda pt: pt[1][metric], reverse=True)
+        logging.warn('rung {} over {} hours: {} combinations, best {} {}'.format(rung, period, len(candidates),
+            grid.combination(ranked[0][0], period) if ranked else None, ranked[0][1] if ranked else None))
+        if rung == len(periods)-1:
+            break
+        keep = max(1, math.ceil(len(ranked) /eta))
+        candidates = [p for p, t in ranked[:keep]]
+        for p, t in ranked[:neighbours]:
+            for n in grid.neighbours(p):
+                if n not in seen:
+                    seen.add(n)
+                    candidates.append(n)
+    return [(grid.combination(p, periods[-1]), t) for p, t in ranked], evaluations
@@ -0,0 +1,199 @@
+# run the backtest parameter sweep on a pool of processes
+#
+# the historical bars are copied once into shared memory and each worker attaches to
+# the block when it starts, so a task only carries its parameters.  for the Crossover
+# every ema series the combinations need is calculated once up front and shared the
+# same way.  results come back in the order of the combinations.
+import contextlib
+import copy
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+
+import numpy as np
+
+from market import backtest
+from market import bars
+from market import cache
+from market import contract
+from market import data
+from market import detector
+from market import fills
+from market import indicators
+from market import npbacktest
+
+columns = ['open', 'high', 'low', 'close']
+
+# same order as the nested loops in bin/backTest.py
+def combinations(periods, longIntervals, shortIntervals, watchCounts, stopTargets, profitTargets):
+    for p in periods:
+        for lI in longIntervals:
+            for sI in shortIntervals:
+                if sI > lI:
+                    continue
+                for w in watchCounts:
+                    for sT in stopTargets:
+                        for pT in profitTargets:
+                            yield p, lI, sI, w, sT, pT
+
+# copy rows (a 2-d array) into a shared memory block
+def share(rows):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, rows.nbytes))
+    shared = np.ndarray(rows.shape, dtype=np.float64, buffer=shm.buf)
+    shared[:] = rows
+    return shm
+
+def attach(shmName, shape):
+    shm = shared_memory.SharedMemory(name=shmName)
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+# one row per column, then the bar start times (fills.toDates)
+def barRows(dataStream):
+    n = len(dataStream)
+    rows = np.empty((len(columns)+1, n))
+    if isinstance(dataStream, np.recarray):
+        for i, c in enumerate(columns + ['date']):
+            rows[i] = dataStream[c]
+        return rows
+    for i, c in enumerate(columns):
+        rows[i] = np.fromiter((getattr(b, c) for b in dataStream), dtype=np.float64, count=n)
+    rows[-1] = fills.toDates(dataStream)
+    return rows
+
+# every ema series the Crossover combinations use, returns the keys and one row per key
+def emaRows(conf, close, combinations):
+    barSize = data.barSizeToDuration[conf.barSizeStr]['value']
+    emaCache = indicators.EMACache(close)
+    for p, lI, sI, w, sT, pT in combinations:
+        start = npbacktest.startIndex(len(close), barSize, p)
+        for key in indicators.crossoverKeys(sI, lI, start):
+            emaCache.ema(*key)
+    keys = list(emaCache.series)
+    rows = np.empty((len(keys), len(close)))
+    for i, key in enumerate(keys):
+        rows[i] = emaCache.series[key]
+    return keys, rows
+
+# per process state, set up once by the pool initializer
+class Worker:
+    shms: list # attached shared memory, kept open for the life of the worker
+    shared: np.ndarray # one row per column, then the bar start times
+    emaCache: indicators.EMACache = None
+    resolver: fills.IntrabarResolver = None
+    wc: contract.BacktestContract
+    conf: object
+    vectorized: bool
+    dataStream: list = None # bars.Bar (a bars.barDtype array for threeBarPattern), only built for the loop engine
+
+    def __init__(self, barsShm, n, emaShm, emaKeys, fineShm, fineN, resolverBarSize, wc, conf, vectorized):
+        shm, self.shared = attach(barsShm, (len(columns)+1, n))
+        self.shms = [shm]
+        if emaShm is not None:
+            shm, emas = attach(emaShm, (len(emaKeys), n))
+            self.shms.append(shm)
+            self.emaCache = indicators.EMACache(self.shared[3], dict(zip(emaKeys, emas)))
+        if fineShm is not None:
+            shm, fine = attach(fineShm, (3, fineN))
+            self.shms.append(shm)
+            self.resolver = fills.IntrabarResolver(fine[0], fine[1], fine[2], resolverBarSize)
+        self.wc = wc
+        self.conf = conf
+        self.vectorized = vectorized
+        if not vectorized or conf.detector != 'Crossover':
+            self.dataStream = self.makeBars()
+
+    def makeBars(self):
+        if self.conf.detector == 'threeBarPattern':
+            return bars.anotateArray(bars.fromColumns(self.shared[-1], *self.shared[:len(columns)]))
+        dataStream = []
+        for o, h, l, c, d in zip(*[self.shared[i].tolist() for i in range(len(columns)+1)]):
+            bar = bars.Bar(0)
+            bar.open, bar.high, bar.low, bar.close = o, h, l, c
+            if d == d: # not nan
+                bar.date = cache.toDatetime(d)
+            dataStream.append(bar)
+        return dataStream
+
+    def withTargets(self, stopTarget, profitTarget):
+        conf = copy.copy(self.conf)
+        conf.profitTarget = profitTarget
+        conf.stopTarget = stopTarget
+        return conf
+
+    def run(self, combination):
+        p, lI, sI, w, sT, pT = combination
+        conf = self.withTargets(sT, pT)
+        if conf.detector == 'Crossover' and self.vectorized:
+            high, low, close = self.shared[1], self.shared[2], self.shared[3]
+            return combination, npbacktest.backtest(self.wc, conf, high, low, close, sI, lI, w, p, self.emaCache, self.resolver, self.shared[-1])
+        dataStore = None
+        if conf.detector == 'Crossover':
+            dataStore = detector.Crossover(conf.barSizeStr, self.wc, sI, lI, w)
+            dataStore.backTest = True
+            dataStore.byPeriod = p
+            dataStore.emaCache = self.emaCache
+            dataStore.initIndicators(self.dataStream)
+        return combination, backtest.backtest(self.wc, self.dataStream, dataStore, conf, p, self.resolver)
+
+    # a Crossover combination over bars first..stop-1 only, see walkforward.py
+    def runWindow(self, task):
+        first, stop, combination = task
+        p, lI, sI, w, sT, pT = combination
+        conf = self.withTargets(sT, pT)
+        high, low, close = self.shared[1], self.shared[2], self.shared[3]
+        return task, npbacktest.backtestWindow(self.wc, conf, high, low, close, sI, lI, w, first, stop, self.emaCache, self.resolver, self.shared[-1])
+
+worker = None
+
+def initWorker(*args):
+    global worker
+    worker = Worker(*args)
+
+def runCombination(combination):
+    return worker.run(combination)
+
+def runWindow(task):
+    return worker.runWindow(task)
+
+# a process pool with the bars (and the ema series, fine bars) shared with every worker
+#   workers defaults to the number of cpus
+#   combinations are what the ema series are calculated for
+#   resolver is a fills.IntrabarResolver, its fine bars are shared with the workers too
+@contextlib.contextmanager
+def pool(wc, conf, dataStream, combinations, workers=None, vectorized=None, resolver=None):
+    if workers is None:
+        workers = os.cpu_count()
+    rows = barRows(dataStream)
+    shms = [share(rows)]
+    emaShm, emaKeys = None, None
+    if conf.detector == 'Crossover':
+        emaKeys, emas = emaRows(conf, rows[3], combinations)
+        shms.append(share(emas))
+        emaShm = shms[1].name
+        del emas
+        logging.warn('calculated {} ema series for the sweep'.format(len(emaKeys)))
+    fineShm, fineN, resolverBarSize = None, 0, None
+    if resolver is not None:
+        shms.append(share(np.vstack((resolver.dates, resolver.high, resolver.low)).astype(np.float64)))
+        fineShm, fineN, resolverBarSize = shms[-1].name, len(resolver.dates), resolver.barSize
+    try:
+        initargs = (shms[0].name, len(dataStream), emaShm, emaKeys, fineShm, fineN, resolverBarSize, contract.backtestContract(wc), conf, vectorized)
+        with multiprocessing.Pool(workers, initializer=initWorker, initargs=initargs) as p:
+            yield p
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+def chunksize(tasks, workers=None):
+    return max(1, tasks // ((workers or os.cpu_count()) *8))
+
+# returns [(combination, totals)] in the order of combinations
+#   workers defaults to the number of cpus
+#   resolver is a fills.IntrabarResolver, its fine bars are shared with the workers too
+def sweep(wc, conf, dataStream, combinations, workers=None, vectorized=None, resolver=None):
+    combinations = list(combinations)
+    logging.warn('sweeping {} combinations over {} workers'.format(len(combinations), workers or os.cpu_count()))
+    with pool(wc, conf, dataStream, combinations, workers, vectorized, resolver) as p:
+        return p.map(runCombination, combinations, chunksize(len(combinations), workers))
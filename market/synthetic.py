@@ -0,0 +1,32 @@
+# synthetic historical bars, for running backtests without a gateway
+#
+# a random walk in price increments whose drift and volatility change every so often
+# (regimes), so there are trends for the Crossover and chop for the three bar pattern.
+import random
+
+from market import bars
+from market import cache
+
+# drift and volatility (in price increments per bar) a regime is picked from
+drifts = [-0.3, -0.1, 0.0, 0.0, 0.1, 0.3]
+volatilities = [0.5, 1.0, 2.0, 4.0]
+
+# returns n bars.Bar with dates, one every barSize seconds starting at startTime (epoch)
+#   regimeLength is the mean number of bars a regime lasts
+def randomWalk(n, seed=None, price=3000.0, priceIncrement=0.25, barSize=60, regimeLength=600, startTime=1577836800):
+    r = random.Random(seed)
+    dataStream = []
+    drift, volatility, left = 0.0, 1.0, 0
+    for i in range(n):
+        if left <= 0:
+            drift, volatility = r.choice(drifts), r.choice(volatilities)
+            left = int(r.expovariate(1.0/regimeLength)) + 1
+        left -= 1
+        bar = bars.Bar(price)
+        price = max(priceIncrement, price + round(r.gauss(drift, volatility)) *priceIncrement)
+        bar.close = price
+        bar.high = max(bar.open, bar.close) + round(abs(r.gauss(0, volatility/2))) *priceIncrement
+        bar.low = max(priceIncrement, min(bar.open, bar.close) - round(abs(r.gauss(0, volatility/2))) *priceIncrement)
+        bar.date = cache.toDatetime(startTime + i *barSize)
+        dataStream.append(bar)
+    return dataStream
@@ -0,0 +1,90 @@
+# rounding prices to the ticks a contract trades on
+#
+# in the case of ES for example, we have to trade on the quarter.  prices are taken in
+# decimal as they print (repr), not as their binary value, so 2.675 is a tie between
+# 2.67 and 2.68 though its binary value is a little under.  the nearest tick comes from
+# one division rather than a scan of the ticks, and the array versions do the same for
+# the backtests in integer units.
+import bisect
+import decimal
+from decimal import Decimal
+
+import numpy as np
+
+from market import fatal
+
+# the nearest multiple of inc in decimal (prices as they print, not their binary
+# value), a tie goes to the tick nearer zero (down for a price).  float() first, the repr
+# of a numpy scalar is 'np.float64(..)' with numpy 2
+def roundToTickSize(p, inc):
+    i = incrementOf(inc)
+    return float( (Decimal(repr(float(p))) / i).to_integral_value(decimal.ROUND_HALF_DOWN) * i )
+
+# increments are few, their Decimal is kept
+increments = {}
+def incrementOf(inc):
+    d = increments.get(inc)
+    if d is None:
+        d = increments[inc] = Decimal(repr(float(inc)))
+    return d
+
+penny = Decimal('0.01')
+def Round(p, inc):
+    r = roundToTickSize(p, inc)
+    if inc < 0.01: # finer than the penny, trade on the penny
+        r = float( Decimal(repr(r)).quantize(penny, decimal.ROUND_HALF_DOWN) )
+    return r
+
+# roundToTickSize for an array of prices: in integer units of a ten thousandth of the
+# smallest digit of inc, so float noise in the prices does not decide a tie
+def roundArrayToTickSize(prices, inc):
+    exp = -incrementOf(inc).as_tuple().exponent
+    scale = 10.0 **(max(exp, 0) + 4)
+    units = np.rint(np.asarray(prices, dtype=np.float64) * scale)
+    step = np.rint(inc * scale)
+    q = np.floor(units /step)
+    r = units - q *step
+    q += (2 *r > step) | ((2 *r == step) & (units < 0)) # ties toward zero
+    return q *step /scale
+
+def RoundArray(prices, inc):
+    r = roundArrayToTickSize(prices, inc)
+    if inc < 0.01:
+        r = roundArrayToTickSize(r, 0.01)
+    return r
+
+# the increments of a market rule (wContract.marketRule), each applies from its lowEdge
+# up to the next one
+class TickRule:
+    __slots__ = ('lowEdges', 'increments')
+    lowEdges: list
+    increments: list
+
+    def __init__(self, priceIncrements):
+        rule = sorted((float(pi.lowEdge), float(pi.increment)) for pi in priceIncrements)
+        if not rule:
+            fatal.errorAndExit('empty market rule')
+        self.lowEdges = [e for e, i in rule]
+        self.increments = [i for e, i in rule]
+
+    def __repr__(self):
+        return ','.join('{}:{}'.format(e, i) for e, i in zip(self.lowEdges, self.increments))
+
+    def increment(self, p):
+        return self.increments[max(bisect.bisect_right(self.lowEdges, abs(p)) - 1, 0)]
+
+    def round(self, p):
+        return Round(p, self.increment(p))
+
+    def roundArray(self, prices):
+        prices = np.asarray(prices, dtype=np.float64)
+        if len(self.increments) == 1:
+            return RoundArray(prices, self.increments[0])
+        band = np.maximum(np.searchsorted(self.lowEdges, np.abs(prices), side='right') - 1, 0)
+        out = np.empty_like(prices)
+        for k, inc in enumerate(self.increments):
+            at = band == k
+            if at.any():
+                out[at] = RoundArray(prices[at], inc)
+        return out
+
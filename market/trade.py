@@ -1,11 +1,115 @@
 import logging
 import sys
+import time
 
+from ib_insync import util
 from ib_insync.order import OrderStatus
 
 from market import rand
 
-def PlaceBracketTrade(orders, orderDetails):
+# fill tracking for a bracket placed by SubmitBracketTrade, driven by the order events
+# instead of polling the status.  filled resolves (with the state) once the entry fills,
+# is cancelled or fillTimeout passes, closed once an exit leg fills or every leg is done.
+# a fill after the timeout still moves the state on, so it is never missed
+class BracketTrade:
+    orderDetails: object # order.OrderDetails
+    trades: list # ib_insync.Trade per leg, entry first
+    entry: object # ib_insync.Trade
+    state: str = 'Submitted' # then Filled or TimedOut or Cancelled, Filled then Closed
+    submitted: float # epoch
+    filledAt: float = None # epoch
+    filled: object # asyncio.Future
+    closed: object # asyncio.Future
+    timer: object = None # asyncio.TimerHandle of the fill timeout
+
+    def __init__(self, trades, orderDetails, fillTimeout):
+        self.orderDetails = orderDetails
+        self.trades = trades
+        self.entry = trades[0]
+        self.submitted = time.time()
+        loop = util.getLoop()
+        self.filled = loop.create_future()
+        self.closed = loop.create_future()
+        # held strongly (eventkit keeps weak references by default) so the bracket lives
+        # as long as its legs can still fire, close() takes the handlers off
+        self.entry.filledEvent.connect(self.entryFilled, keep_ref=True)
+        self.entry.cancelledEvent.connect(self.entryCancelled, keep_ref=True)
+        for t in trades[1:]:
+            t.filledEvent.connect(self.exitFilled, keep_ref=True)
+            t.cancelledEvent.connect(self.exitCancelled, keep_ref=True)
+        if fillTimeout is not None:
+            self.timer = loop.call_later(fillTimeout, self.timedOut)
+        if self.entry.orderStatus.status == OrderStatus.Filled: # filled before the handlers were on
+            self.entryFilled(self.entry)
+
+    def __repr__(self):
+        return 'state:{},symbol:{},orderId:{},submitted:{},filledAt:{}'.format(self.state, self.entry.contract.symbol,
+                self.entry.order.orderId, self.submitted, self.filledAt)
+
+    def resolve(self, future, state):
+        if not future.done():
+            future.set_result(state)
+
+    def entryFilled(self, t):
+        if self.state == 'TimedOut':
+            logging.warn('entry {} filled {:.3f}s after it was placed, after the timeout'.format(t.order.orderId, time.time() - self.submitted))
+        self.state = 'Filled'
+        self.filledAt = time.time()
+        if self.timer is not None:
+            self.timer.cancel()
+        self.resolve(self.filled, self.state)
+        CheckTradeExecution(self.trades, self.orderDetails)
+
+    def entryCancelled(self, t):
+        self.state = 'Cancelled'
+        if self.timer is not None:
+            self.timer.cancel()
+        self.resolve(self.filled, self.state)
+        CheckTradeExecution(self.trades, self.orderDetails)
+        if all(t_.isDone() for t_ in self.trades):
+            self.close()
+
+    def timedOut(self):
+        if self.state == 'Submitted':
+            self.state = 'TimedOut'
+            logging.warn('entry {} not filled {:.3f}s after it was placed, still watching it'.format(self.entry.order.orderId, time.time() - self.submitted))
+            self.resolve(self.filled, self.state)
+            CheckTradeExecution(self.trades, self.orderDetails)
+
+    def exitFilled(self, t):
+        self.state = 'Closed'
+        logging.warn('bracket {} closed by its {} {} at {}'.format(self.entry.order.orderId, t.order.orderType, t.order.action, t.orderStatus.avgFillPrice))
+        self.close()
+
+    def exitCancelled(self, t):
+        if all(t_.isDone() for t_ in self.trades):
+            self.close()
+
+    # resolves closed and takes the handlers off every leg, ib_insync keeps the trades
+    # for the session and the handlers would otherwise keep the BracketTrade alive with them
+    def close(self):
+        self.resolve(self.closed, self.state)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.entry.filledEvent -= self.entryFilled
+        self.entry.cancelledEvent -= self.entryCancelled
+        for t in self.trades[1:]:
+            t.filledEvent -= self.exitFilled
+            t.cancelledEvent -= self.exitCancelled
+
+    def done(self):
+        return self.filled.done()
+
+    # for a loop not running async: wait on the client until filled resolves
+    def wait(self, ibc, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.filled.done() and (deadline is None or time.time() < deadline):
+            ibc.waitOnUpdate(timeout=None if deadline is None else deadline - time.time())
+        return self.state
+
+# places every leg of the bracket without waiting on the client, the entry's fill is
+# tracked by the returned BracketTrade
+def SubmitBracketTrade(orders, orderDetails, fillTimeout=3):
     #oca=[]
     orders.entryOrder.orderId = orderDetails.wContract.ibClient.client.getReqId()
     for orderType, order in orders.__dict__.items():
@@ -18,30 +122,20 @@ def PlaceBracketTrade(orders, orderDetails):
     #logging.info('oca %s, ocaR: %s', oca, ocaR)
 
     trades = []
-    bos = None
     for orderType, order in orders.__dict__.items():
         t = orderDetails.wContract.ibClient.placeOrder(orderDetails.wContract.contract, order)
         if orderType == 'entryOrder':
-            bos = t.orderStatus
-        trades.append(t)
-    orderDetails.wContract.ibClient.sleep(0)
-
-    n = 0
-    while n < 3 and bos.status != OrderStatus.Filled:
-        n += 1
-        orderDetails.wContract.ibClient.sleep(1)
-        if n > 1:
-            logging.debug('waiting on an order fill')
-
-    orderDetails.wContract.ibClient.sleep(0)
-
-    stop = None
-    if orderDetails.config.trail:
-        stop = orders.stopOrder.trailingPercent
-    else:
-        stop = orders.stopOrder.auxPrice
-    orderDetails.wContract.ibClient.sleep(0)
-    return trades
+            trades.insert(0, t)
+        else:
+            trades.append(t)
+    return BracketTrade(trades, orderDetails, fillTimeout)
+
+# places the bracket and waits for the entry to fill, up to fillTimeout
+def PlaceBracketTrade(orders, orderDetails, fillTimeout=3):
+    bt = SubmitBracketTrade(orders, orderDetails, fillTimeout)
+    bt.wait(orderDetails.wContract.ibClient, fillTimeout)
+    bt.timedOut() # the timer may not have run yet
+    return bt.trades
 
 def CheckTradeExecution(trades, orderDetails):
     ids = []
@@ -0,0 +1,81 @@
+# walk-forward optimization of the Crossover parameters
+#
+# the history is split into rolling windows of an in-sample part followed by an
+# out-of-sample part.  every combination is run over each in-sample part, the best
+# one is then run over the out-of-sample part that follows it.  the ema series are
+# calculated once over all of the history (see npbacktest.backtestWindow), so a
+# window starts from the indicators as they stood at its first bar.  all the windows
+# are run together on the sweep pool.
+import logging
+
+from market import data
+from market import sweep
+
+class Window:
+    first: int # first in-sample bar
+    split: int # first out-of-sample bar
+    stop: int # one past the last out-of-sample bar
+    best: tuple = None # combination picked in-sample, (p, lI, sI, w, sT, pT)
+    inSample: dict = None # totals of best in-sample
+    outOfSample: dict = None # totals of best out-of-sample
+
+    def __init__(self, first, split, stop):
+        self.first = first
+        self.split = split
+        self.stop = stop
+
+    def __repr__(self):
+        return 'bars:{}-{}-{},best:{},inSample:{},outOfSample:{}'.format(self.first, self.split, self.stop, self.best, self.inSample, self.outOfSample)
+
+# windows over n bars, inSample/outOfSample/step are in hours like Crossover.byPeriod
+#   step defaults to outOfSample so the out-of-sample parts follow each other
+def windows(n, barSize, inSample, outOfSample, step=None):
+    perHour = 60*60 /barSize
+    inBars, outBars = int(inSample *perHour), int(outOfSample *perHour)
+    stepBars = outBars if step is None else int(step *perHour)
+    if inBars < 1 or outBars < 1 or stepBars < 1:
+        raise ValueError('window sizes of {}/{}/{} hours are less than a bar'.format(inSample, outOfSample, step))
+    ws = []
+    first = 0
+    while first + inBars + outBars <= n:
+        ws.append(Window(first, first + inBars, first + inBars + outBars))
+        first += stepBars
+    return ws
+
+# out-of-sample totals added up over the windows, mf is the most funds used in any one
+def aggregate(ws):
+    totals = {'gl': 0, 'tf': 0, 'mf': 0, 'op': 0, 'lo': 0}
+    for w in ws:
+        if w.outOfSample is None:
+            continue
+        for k in ['gl', 'tf', 'op', 'lo']:
+            totals[k] += w.outOfSample[k]
+        totals['mf'] = max(totals['mf'], w.outOfSample['mf'])
+    return totals
+
+# returns the windows, with what was picked and how it did, and the aggregated totals
+#   combinations as from sweep.combinations, the period is not used
+#   metric is the totals key the in-sample runs are ranked by
+def walkForward(wc, conf, dataStream, combinations, inSample, outOfSample, step=None, workers=None, resolver=None, metric='gl'):
+    if conf.detector != 'Crossover':
+        raise ValueError('walk-forward only runs the Crossover, not {}'.format(conf.detector))
+    combinations = [(None,) + tuple(c[1:]) for c in combinations]
+    barSize = data.barSizeToDuration[conf.barSizeStr]['value']
+    ws = windows(len(dataStream), barSize, inSample, outOfSample, step)
+    if not ws:
+        logging.error('{} bars are not enough for a {}+{} hour window'.format(len(dataStream), inSample, outOfSample))
+        return ws, aggregate(ws)
+    logging.warn('walking forward over {} windows of {} combinations'.format(len(ws), len(combinations)))
+    with sweep.pool(wc, conf, dataStream, combinations, workers, True, resolver) as p:
+        tasks = [(w.first, w.split, c) for w in ws for c in combinations]
+        best = {}
+        for (first, split, c), totals in p.imap(sweep.runWindow, tasks, sweep.chunksize(len(tasks), workers)):
+            if first not in best or totals[metric] > best[first][1][metric]:
+                best[first] = (c, totals)
+        for w in ws:
+            w.best, w.inSample = best[w.first]
+        tasks = [(w.split, w.stop, w.best) for w in ws]
+        for w, (task, totals) in zip(ws, p.map(sweep.runWindow, tasks)):
+            w.outOfSample = totals
+            logging.warn('window {}'.format(w))
+    return ws, aggregate(ws)